@@ -0,0 +1,186 @@
+import apache_beam as beam
+from apache_beam.io.filesystems import FileSystems
+import json
+import logging
+import math
+
+# Rows per row group of the merged validated file
+ROW_GROUP_SIZE = 100000
+
+
+def _geo_metadata(parquet_file):
+    metadata = parquet_file.schema_arrow.metadata or {}
+    return json.loads(metadata[b'geo']) if b'geo' in metadata else None
+
+
+def read_row_group(path, index):
+    """One row group of a GeoParquet file as a GeoDataFrame, attributes keeping their Arrow types"""
+    import geopandas as gpd
+    import pandas as pd
+    import pyarrow.parquet as pq
+    from pyproj import CRS
+
+    with FileSystems.open(path) as f:
+        parquet_file = pq.ParquetFile(f)
+        geo = _geo_metadata(parquet_file)
+        table = parquet_file.read_row_group(index)
+
+    primary = geo['primary_column']
+    column = geo['columns'][primary]
+    # The bbox covering is derived from the geometry, the validated file gets its own
+    covering = {path[0] for path in column.get('covering', {}).get('bbox', {}).values()}
+    crs = column.get('crs', 'OGC:CRS84')
+    if isinstance(crs, dict):
+        crs = CRS.from_json_dict(crs)
+
+    geometry = gpd.GeoSeries.from_wkb(table.column(primary).to_numpy(zero_copy_only=False), crs=crs)
+    attributes = table.select([name for name in table.column_names if name != primary and name not in covering])
+    # Arrow types survive the round trip, so every part is written with the source file's schema
+    df = attributes.to_pandas(types_mapper=pd.ArrowDtype)
+    return gpd.GeoDataFrame(df, geometry=geometry.values, crs=crs)
+
+
+class PlanRowGroupsDoFn(beam.DoFn):
+    def __init__(self, input_bucket):
+        self.input_bucket = input_bucket
+
+    def process(self, dataset):
+        import pyarrow.parquet as pq
+        path = f'gs://{self.input_bucket}/raw/{dataset}/current.parquet'
+        with FileSystems.open(path) as f:
+            metadata = pq.ParquetFile(f).metadata
+        logging.info(f'Splitting {path} into {metadata.num_row_groups} row groups '
+                     f'({metadata.num_rows:,} rows)')
+        for index in range(metadata.num_row_groups):
+            yield {'dataset': dataset, 'source': path, 'row_group': index}
+
+
+class ReadRowGroupDoFn(beam.DoFn):
+    def process(self, element):
+        gdf = read_row_group(element['source'], element['row_group'])
+        logging.info(f"Read row group {element['row_group']} of {element['source']} ({len(gdf):,} rows)")
+        yield {**element, 'data': gdf}
+
+
+class ReadRowGroups(beam.PTransform):
+    """Read the raw GeoParquet file of each dataset as one element per row group.
+
+    The row groups are planned from the file footer alone and reshuffled
+    before they are read, so reading and everything after it fan out
+    across workers instead of staying fused to the single planning step.
+    """
+
+    def __init__(self, input_bucket):
+        super().__init__()
+        self.input_bucket = input_bucket
+
+    def expand(self, datasets):
+        return (datasets
+                | 'Plan Row Groups' >> beam.ParDo(PlanRowGroupsDoFn(self.input_bucket))
+                | 'Distribute Row Groups' >> beam.Reshuffle()
+                | 'Read Row Group' >> beam.ParDo(ReadRowGroupDoFn()))
+
+
+class WritePartDoFn(beam.DoFn):
+    def __init__(self, output_bucket):
+        self.output_bucket = output_bucket
+
+    def process(self, element):
+        dataset = element['dataset']
+        # Named by row group, so a retried bundle overwrites its own part
+        part_path = f"gs://{self.output_bucket}/validated/{dataset}/parts/part-{element['row_group']:05d}.parquet"
+        element['data'].to_parquet(part_path, compression='zstd', compression_level=3, index=False)
+        yield dataset, {'part': part_path, 'source': element['source'],
+                        'row_group': element['row_group'], 'stats': element['stats']}
+
+
+class MergePartsDoFn(beam.DoFn):
+    def __init__(self, output_bucket):
+        self.output_bucket = output_bucket
+
+    def _merged_geo(self, parts_geo, source_geo, names):
+        """Geo metadata of the first part, with the bboxes and geometry types of all parts"""
+        geo = parts_geo[0]
+        primary = geo['columns'][geo['primary_column']]
+        bboxes = [g['columns'][g['primary_column']].get('bbox') for g in parts_geo]
+        bboxes = [b for b in bboxes if b and all(math.isfinite(v) for v in b)]
+        if bboxes:
+            primary['bbox'] = [min(b[0] for b in bboxes), min(b[1] for b in bboxes),
+                               max(b[2] for b in bboxes), max(b[3] for b in bboxes)]
+        primary['geometry_types'] = sorted({t for g in parts_geo
+                                            for t in g['columns'][g['primary_column']].get('geometry_types', [])})
+        # Further geometry columns declared by the source, e.g. geometry_25832, stay declared
+        for name, column in (source_geo or {}).get('columns', {}).items():
+            if name != source_geo['primary_column'] and name in names:
+                geo['columns'][name] = column
+        return geo
+
+    def process(self, keyed):
+        import pandas as pd
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        dataset, parts = keyed
+        parts = sorted(parts, key=lambda part: part['row_group'])
+        output_path = f'gs://{self.output_bucket}/validated/{dataset}/current.parquet'
+        logging.info(f'Merging {len(parts)} parts into {output_path}')
+
+        schemas, parts_geo = [], []
+        for part in parts:
+            with FileSystems.open(part['part']) as f:
+                parquet_file = pq.ParquetFile(f)
+                schemas.append(parquet_file.schema_arrow)
+                parts_geo.append(_geo_metadata(parquet_file))
+        with FileSystems.open(parts[0]['source']) as f:
+            source_geo = _geo_metadata(pq.ParquetFile(f))
+        schema = pa.unify_schemas(schemas)
+        geo = self._merged_geo(parts_geo, source_geo, set(schema.names))
+        schema = schema.with_metadata({**(schema.metadata or {}), b'geo': json.dumps(geo).encode()})
+
+        # Parts are streamed through one row group at a time, small ones combined
+        with FileSystems.create(output_path) as sink:
+            with pq.ParquetWriter(sink, schema, compression='zstd', compression_level=3) as writer:
+                pending, pending_rows = [], 0
+                for part in parts:
+                    with FileSystems.open(part['part']) as f:
+                        parquet_file = pq.ParquetFile(f)
+                        for index in range(parquet_file.num_row_groups):
+                            table = parquet_file.read_row_group(index).select(schema.names).cast(schema)
+                            pending.append(table)
+                            pending_rows += table.num_rows
+                            if pending_rows >= ROW_GROUP_SIZE:
+                                writer.write_table(pa.concat_tables(pending), row_group_size=ROW_GROUP_SIZE)
+                                pending, pending_rows = [], 0
+                if pending:
+                    writer.write_table(pa.concat_tables(pending), row_group_size=ROW_GROUP_SIZE)
+
+        stats = {}
+        for part in parts:
+            for key, value in part['stats'].items():
+                stats[key] = stats.get(key, 0) + value
+        logging.info(f'{dataset}: {stats}')
+
+        # Write stats
+        stats_path = f'gs://{self.output_bucket}/validated/{dataset}/validation_stats.csv'
+        pd.DataFrame([stats]).to_csv(stats_path, index=False)
+
+        FileSystems.delete([part['part'] for part in parts])
+        yield {'dataset': dataset, 'path': output_path, 'stats': stats}
+
+
+class WriteValidatedDataset(beam.PTransform):
+    """Write validated row groups as parts in parallel, then merge them into one validated file per dataset.
+
+    The merge only streams row groups from the parts into the final
+    ``current.parquet``, so the single step left at the end is I/O.
+    """
+
+    def __init__(self, output_bucket):
+        super().__init__()
+        self.output_bucket = output_bucket
+
+    def expand(self, elements):
+        return (elements
+                | 'Write Parts' >> beam.ParDo(WritePartDoFn(self.output_bucket))
+                | 'Group Parts' >> beam.GroupByKey()
+                | 'Merge Parts' >> beam.ParDo(MergePartsDoFn(self.output_bucket)))
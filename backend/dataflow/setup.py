@@ -10,4 +10,5 @@ setup(
         'shapely',
     ],
     packages=find_packages(),
+    py_modules=['parquet_io', 'validate_geometries'],
 ) 
\ No newline at end of file
@@ -0,0 +1,130 @@
+import apache_beam as beam
+from apache_beam.options.pipeline_options import PipelineOptions
+import logging
+
+from parquet_io import ReadRowGroups, WriteValidatedDataset
+
+# Validation rules per dataset:
+# - geometry_types: allowed geometry types
+# - area_m2: (min, max) area in square metres, measured in area_crs
+# - required: attributes that may not be null
+# Missing, invalid (after a buffer(0) repair) and empty geometries are always rejected.
+RULES = {
+    'cadastral': {
+        'geometry_types': ('Polygon', 'MultiPolygon'),
+        'area_m2': (0.1, 100_000_000),  # Area between 0.1m² and 100km²
+        'required': ('bfe_number',),
+    },
+    'wetlands': {
+        'geometry_types': ('Polygon', 'MultiPolygon'),
+        'required': ('gridcode',),
+    },
+    'water_projects': {
+        'geometry_types': ('Polygon', 'MultiPolygon'),
+        'area_m2': (1, 10_000_000),  # Area between 1m² and 10km²
+        'required': ('layer_name',),
+    },
+}
+# Geometries are stored in EPSG:4326, areas are measured in the sources' own UTM zone
+AREA_CRS = 'EPSG:25832'
+
+
+class ValidateGeometriesOptions(PipelineOptions):
+    @classmethod
+    def _add_argparse_args(cls, parser):
+        parser.add_argument('--dataset')
+        parser.add_argument('--input_bucket')
+        parser.add_argument('--output_bucket')
+
+
+def apply_rules(gdf, rules):
+    """Rows of ``gdf`` passing ``rules``, with invalid geometries repaired, and the validation stats.
+
+    Every rule is a vectorized shapely or pandas predicate over the whole
+    frame. A rejected row is counted against the first rule it fails, so
+    the ``rejected_*`` counts add up to the rows dropped.
+    """
+    import geopandas as gpd
+    import numpy as np
+    import shapely
+
+    geometries = np.asarray(gdf.geometry.values)
+    missing = shapely.is_missing(geometries)
+
+    # Fix invalid geometries
+    invalid = ~missing & ~shapely.is_valid(geometries)
+    if invalid.any():
+        geometries = geometries.copy()
+        geometries[invalid] = shapely.buffer(geometries[invalid], 0)
+
+    checks = [
+        ('missing_geometry', lambda: missing),
+        ('invalid_geometry', lambda: ~shapely.is_valid(geometries)),
+        ('empty_geometry', lambda: shapely.is_empty(geometries)),
+    ]
+    if 'geometry_types' in rules:
+        allowed = [shapely.GeometryType[name.upper()] for name in rules['geometry_types']]
+        checks.append(('geometry_type', lambda: ~np.isin(shapely.get_type_id(geometries), allowed)))
+    if 'area_m2' in rules:
+        minimum, maximum = rules['area_m2']
+
+        def area_out_of_bounds():
+            area = gpd.GeoSeries(geometries, crs=gdf.crs)
+            if area.crs is not None and area.crs.is_geographic:
+                area = area.to_crs(AREA_CRS)
+            area = shapely.area(np.asarray(area.values))
+            return ~((area >= minimum) & (area <= maximum))
+        checks.append(('area', area_out_of_bounds))
+    for column in rules.get('required', ()):
+        if column not in gdf.columns:
+            logging.error(f'Required attribute {column} is not in the data, rejecting every row')
+            checks.append((f'missing_{column}', lambda: np.ones(len(gdf), dtype=bool)))
+        else:
+            checks.append((f'missing_{column}', lambda column=column: gdf[column].isna().to_numpy(dtype=bool)))
+
+    keep = np.ones(len(gdf), dtype=bool)
+    stats = {'total_rows': len(gdf), 'repaired_geometries': int(invalid.sum())}
+    for name, check in checks:
+        failed = check() & keep
+        stats[f'rejected_{name}'] = int(failed.sum())
+        keep &= ~failed
+    stats['valid_geometries'] = int(keep.sum())
+
+    validated = gdf[keep].copy()
+    validated[gdf.geometry.name] = gpd.GeoSeries(geometries[keep], index=validated.index, crs=gdf.crs)
+    return validated, stats
+
+
+class ValidateGeometriesDoFn(beam.DoFn):
+    def __init__(self, rules):
+        self.rules = rules
+
+    def process(self, element):
+        gdf, stats = apply_rules(element['data'], self.rules)
+        rejected = {name: count for name, count in stats.items() if name.startswith('rejected_') and count}
+        logging.info(f"{element['dataset']}: {stats['valid_geometries']:,} of {stats['total_rows']:,} rows valid"
+                     + (f", rejected {rejected}" if rejected else ""))
+        element['data'] = gdf
+        element['stats'] = stats
+        yield element
+
+
+def run(argv=None, dataset=None):
+    """Build and run the pipeline, validating ``--dataset`` (or ``dataset``) with its rules."""
+    pipeline_options = PipelineOptions(argv)
+    options = pipeline_options.view_as(ValidateGeometriesOptions)
+    dataset = options.dataset or dataset
+    if dataset not in RULES:
+        raise ValueError(f'No validation rules for dataset {dataset!r}, expected one of {sorted(RULES)}')
+
+    with beam.Pipeline(options=pipeline_options) as p:
+        (p
+         | 'Create Dataset' >> beam.Create([dataset])
+         | 'Read Row Groups' >> ReadRowGroups(options.input_bucket)
+         | 'Validate Geometries' >> beam.ParDo(ValidateGeometriesDoFn(RULES[dataset]))
+         | 'Write Results' >> WriteValidatedDataset(options.output_bucket)
+        )
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    run()
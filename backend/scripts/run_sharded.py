@@ -0,0 +1,77 @@
+"""Run a sync as N local worker processes, then compact their shards.
+
+Mirrors a Cloud Run job with N tasks: every worker runs sync_app.py with
+CLOUD_RUN_TASK_INDEX/CLOUD_RUN_TASK_COUNT set, and once all of them
+succeeded a final sync_app.py run with SYNC_STEP=compact publishes the
+result. Storage defaults to the local backend.
+
+    python scripts/run_sharded.py cadastral --tasks 4
+"""
+import argparse
+from pathlib import Path
+import logging
+import os
+import subprocess
+import sys
+import time
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger(__name__)
+
+backend_dir = Path(__file__).parent.parent
+
+
+def run_workers(sync_type, tasks, env):
+    """Start one sync_app.py process per shard and wait for all of them"""
+    workers = []
+    for index in range(tasks):
+        worker_env = dict(env, SYNC_TYPE=sync_type, SYNC_STEP='sync',
+                          CLOUD_RUN_TASK_INDEX=str(index), CLOUD_RUN_TASK_COUNT=str(tasks))
+        workers.append(subprocess.Popen([sys.executable, 'sync_app.py'], cwd=backend_dir, env=worker_env))
+    failed = []
+    for index, worker in enumerate(workers):
+        if worker.wait() != 0:
+            failed.append(index)
+    return failed
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sync_type', help="Source to sync, as in SYNC_TYPE (e.g. cadastral or all)")
+    parser.add_argument('--tasks', type=int, default=os.cpu_count() or 2, help="Number of worker processes")
+    parser.add_argument('--storage', default=os.getenv('STORAGE_BACKEND', 'local'),
+                        help="Storage backend of the workers (local or gcs; memory is not shared between processes)")
+    parser.add_argument('--skip-compact', action='store_true', help="Only run the workers")
+    args = parser.parse_args()
+
+    if args.storage == 'memory':
+        logger.error("The memory backend is private to each process, use local or gcs")
+        return 1
+    env = dict(os.environ, STORAGE_BACKEND=args.storage)
+
+    start = time.time()
+    logger.info(f"Syncing {args.sync_type} with {args.tasks} workers")
+    failed = run_workers(args.sync_type, args.tasks, env)
+    if failed:
+        # Rerunning resumes every shard from its checkpoint
+        logger.error(f"Workers {failed} failed after {time.time() - start:.1f}s, not compacting")
+        return 1
+    logger.info(f"All {args.tasks} workers finished in {time.time() - start:.1f}s")
+    if args.skip_compact:
+        return 0
+
+    compact_env = dict(env, SYNC_TYPE=args.sync_type, SYNC_STEP='compact',
+                       CLOUD_RUN_TASK_INDEX='0', CLOUD_RUN_TASK_COUNT='1')
+    if subprocess.run([sys.executable, 'sync_app.py'], cwd=backend_dir, env=compact_env).returncode != 0:
+        logger.error("Compaction failed")
+        return 1
+    logger.info(f"Sharded sync of {args.sync_type} finished in {time.time() - start:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -22,18 +22,19 @@ from src.config import SOURCES
 
 shutdown = asyncio.Event()
 
-def handle_shutdown(signum, frame):
+def handle_shutdown(signum):
     logger.info(f"Received signal {signum}. Starting graceful shutdown...")
     shutdown.set()
 
-signal.signal(signal.SIGTERM, handle_shutdown)
-signal.signal(signal.SIGINT, handle_shutdown)
-
 async def main() -> Optional[int]:
     """Sync wetlands data to Cloud Storage"""
     load_dotenv()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, handle_shutdown, sig)
     try:
         wetlands = Wetlands(SOURCES["wetlands"])
+        wetlands.shutdown = shutdown
         total_synced = await wetlands.sync()  # No conn parameter
         logger.info(f"Total records synced: {total_synced:,}")
         return total_synced
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from google.cloud import storage
+import asyncio
 import geopandas as gpd
 from shapely.geometry import shape
 import pyarrow as pa
@@ -9,16 +9,29 @@ import time
 import os
 import pandas as pd
 from .sources.utils.geometry_validator import validate_and_transform_geometries
+from .sources.utils.sharding import Shard
+from .sources.utils.storage import StorageBackend, get_storage_backend
 
 logger = logging.getLogger(__name__)
 
+class SyncInterrupted(Exception):
+    """A sync stopped early on shutdown after checkpointing its progress"""
+    pass
+
 class Source(ABC):
     """Abstract base class for data sources"""
     
-    def __init__(self, config):
+    def __init__(self, config, storage: Optional[StorageBackend] = None):
         self.config = config
-        self.storage_client = storage.Client()
-        self.bucket = self.storage_client.bucket('landbrugsdata-raw-data')
+        self.storage = storage or get_storage_backend(config)
+        # Set by the sync scripts on SIGTERM, checked between pages
+        self.shutdown: Optional[asyncio.Event] = None
+        # This worker's share of a sync split across Cloud Run tasks
+        self.shard = Shard.from_env()
+    
+    @property
+    def stop_requested(self) -> bool:
+        return self.shutdown is not None and self.shutdown.is_set()
     
     @abstractmethod
     async def fetch(self):
@@ -29,3 +42,11 @@ class Source(ABC):
     async def sync(self) -> Optional[int]:
         """Sync data to storage, returns number of records synced or None on failure"""
         pass
+
+    async def compact(self) -> Optional[int]:
+        """Publish the finished shards of a sharded sync, returns the number of records published.
+
+        Sources that do not shard their syncs have nothing to compact.
+        """
+        logger.info(f"{type(self).__name__} does not shard its sync, nothing to compact")
+        return None
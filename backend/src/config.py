@@ -40,7 +40,9 @@ SOURCES = {
         "create_combined": True,
         "combined_timeout": 3600,
         "bucket": "landbrugsdata-raw-data",
-        "create_dissolved": True
+        "create_dissolved": True,
+        # Dissolve each layer on its own instead of all layers together
+        "dissolve_by_layer": False
     },
     "crops": {
         "name": "Danish Agricultural Crop Codes",
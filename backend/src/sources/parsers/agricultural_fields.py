@@ -1,14 +1,15 @@
 import logging
 import aiohttp
-import geopandas as gpd
-import asyncio
-import xml.etree.ElementTree as ET
-from ...base import Source
+from ...base import Source, SyncInterrupted
 import time
-import os
 import ssl
-from ..utils.geometry_validator import validate_and_transform_geometries
-import pandas as pd
+from ..utils.arcgis_pbf import detect_query_format, read_query_response
+from ..utils.geometry_validator import validate_in_chunks
+from ..utils.feature_batch import FeatureBatch
+from ..utils.pagination import ArcGISObjectIdPaging, Paginator
+from ..utils.memory import MemoryGovernor
+from ..utils.part_sink import PartFileSink
+from ..utils.pipeline import Pipeline, batch_pages
 
 logger = logging.getLogger(__name__)
 
@@ -27,8 +28,8 @@ class AgriculturalFields(Source):
         'Markblok': 'block_id'
     }
     
-    def __init__(self, config):
-        super().__init__(config)
+    def __init__(self, config, storage=None):
+        super().__init__(config, storage)
         self.batch_size = 2000
         self.max_concurrent = 5
         self.storage_batch_size = 10000
@@ -45,111 +46,80 @@ class AgriculturalFields(Source):
         self.ssl_context.verify_mode = ssl.CERT_NONE
         self.ssl_context.options |= 0x4
         
-        self.request_semaphore = asyncio.Semaphore(self.max_concurrent)
+        self.paginator = self._get_paginator()
         self.start_time = None
         self.features_processed = 0
-        self.bucket = self.storage_client.bucket(config['bucket'])
         logger.info(f"Initialized with batch_size={self.batch_size}, "
                    f"max_concurrent={self.max_concurrent}, "
                    f"storage_batch_size={self.storage_batch_size}")
 
-    async def _get_total_count(self, session):
-        """Get total number of features"""
-        params = {
-            'f': 'json',
-            'where': '1=1',
-            'returnCountOnly': 'true'
-        }
-        
-        try:
-            url = self.config['url']
-            logger.info(f"Fetching total count from {url}")
-            async with session.get(url, params=params, ssl=self.ssl_context) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    total = data.get('count', 0)
-                    logger.info(f"Total features available: {total:,}")
-                    return total
-                else:
-                    logger.error(f"Error getting count: {response.status}")
-                    response_text = await response.text()
-                    logger.error(f"Response: {response_text[:500]}...")
-                    return 0
-        except Exception as e:
-            logger.error(f"Error getting total count: {str(e)}", exc_info=True)
-            return 0
+    def _get_paginator(self, exclude=None, id_range=None):
+        """Page by OBJECTID ranges within this shard's range, leaving out the id ranges in ``exclude``"""
+        return Paginator(
+            ArcGISObjectIdPaging(exclude=exclude, id_range=id_range, shard=self.shard),
+            self.config['url'],
+            self._parse_page,
+            page_size=self.batch_size,
+            base_params={
+                'f': 'json',
+                'where': '1=1',
+                'returnGeometry': 'true',
+                'outFields': '*'
+            },
+            max_concurrent=self.max_concurrent,
+            max_retries=self.max_retries,
+            request_kwargs={'ssl': self.ssl_context},
+            name='agricultural_fields'
+        )
 
-    async def _fetch_chunk(self, session, start_index, retry_count=0):
-        """Fetch a chunk of features with retry logic"""
-        params = {
-            'f': 'json',
-            'where': '1=1',
-            'returnGeometry': 'true',
-            'outFields': '*',
-            'resultOffset': str(start_index),
-            'resultRecordCount': str(self.batch_size)
-        }
+    async def _parse_page(self, response, start_index):
+        """Parse one ArcGIS query page into a FeatureBatch"""
+        chunk_start = time.time()
+        # Typed columns and polygons straight from the PBF or JSON body, holes assigned by ring orientation
+        batch = await read_query_response(response)
+        if not len(batch):
+            logger.warning(f"No features returned at index {start_index}")
+            return batch
+            
+        batch = FeatureBatch(batch.attributes.rename(columns=self.COLUMN_MAPPING), batch.geometry)
         
-        async with self.request_semaphore:
-            try:
-                chunk_start = time.time()
-                url = self.config['url']
-                logger.debug(f"Fetching from URL: {url} (attempt {retry_count + 1})")
-                async with session.get(url, params=params, ssl=self.ssl_context) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        features = data.get('features', [])
-                        
-                        if not features:
-                            logger.warning(f"No features returned at index {start_index}")
-                            return None
-                            
-                        logger.debug(f"Creating GeoDataFrame from {len(features)} features")
-                        
-                        # Convert ArcGIS REST API features to GeoJSON format
-                        geojson_features = []
-                        for feature in features:
-                            geojson_feature = {
-                                'type': 'Feature',
-                                'properties': feature['attributes'],
-                                'geometry': {
-                                    'type': 'Polygon',
-                                    'coordinates': feature['geometry']['rings']
-                                }
-                            }
-                            geojson_features.append(geojson_feature)
-                        
-                        gdf = gpd.GeoDataFrame.from_features(geojson_features)
-                        gdf = gdf.rename(columns=self.COLUMN_MAPPING)
-                        
-                        # Set the CRS to EPSG:25832 (the coordinate system used by the API)
-                        gdf.set_crs(epsg=25832, inplace=True)
-                        
-                        chunk_time = time.time() - chunk_start
-                        logger.debug(f"Processed {len(features)} features in {chunk_time:.2f}s")
-                        return gdf
-                    else:
-                        logger.error(f"Error response {response.status} at index {start_index}")
-                        response_text = await response.text()
-                        logger.error(f"Response: {response_text[:500]}...")
-                        
-                        if response.status >= 500 and retry_count < self.max_retries:
-                            await asyncio.sleep(2 ** retry_count)
-                            return await self._fetch_chunk(session, start_index, retry_count + 1)
-                        return None
-                        
-            except ssl.SSLError as e:
-                logger.error(f"SSL Error at index {start_index}: {str(e)}")
-                if retry_count < self.max_retries:
-                    await asyncio.sleep(2 ** retry_count)
-                    return await self._fetch_chunk(session, start_index, retry_count + 1)
-                return None
-            except Exception as e:
-                logger.error(f"Error fetching chunk at index {start_index}: {str(e)}")
-                if retry_count < self.max_retries:
-                    await asyncio.sleep(2 ** retry_count)
-                    return await self._fetch_chunk(session, start_index, retry_count + 1)
-                return None
+        chunk_time = time.time() - chunk_start
+        logger.debug(f"Processed {len(batch)} features in {chunk_time:.2f}s")
+        return batch
+
+    async def _fetch_pages(self, session, total_features):
+        """Yield (OBJECTID range, FeatureBatch) per page, the range is None for pages that failed"""
+        async for page in self.paginator.pages(session, total_features, shutdown=self.shutdown):
+            yield (self.paginator.page_range(page.offset) if page.items is not None else None), page.items
+
+    async def _validate(self, features, dataset):
+        """Validate and transform the geometries of a batch, off the event loop"""
+        gdf = features.to_geodataframe(crs="EPSG:25832")
+        gdf.columns = [col.replace('.', '_').replace('(', '_').replace(')', '_') for col in gdf.columns]
+        return await validate_in_chunks(gdf, dataset)
+
+    async def _validate_batches(self, batches):
+        """Pipeline stage validating batches, passing on their OBJECTID ranges"""
+        async for features, ranges in batches:
+            self.features_processed += len(features)
+            yield (await self._validate(features, 'agricultural_fields') if features else None), ranges
+
+    async def _write_batches(self, batches, total_features):
+        """Pipeline stage appending validated batches to the sink"""
+        async for gdf, ranges in batches:
+            if gdf is not None:
+                logger.info(f"Writing batch of {len(gdf):,} features")
+            await self.write_to_storage(gdf, 'agricultural_fields', ranges)
+            
+            elapsed = time.time() - self.start_time
+            speed = self.features_processed / elapsed
+            remaining = total_features - self.features_processed
+            eta_minutes = (remaining / speed) / 60 if speed > 0 else 0
+            
+            logger.info(
+                f"Progress: {self.features_processed:,}/{total_features:,} "
+                f"({speed:.1f} features/second, ETA: {eta_minutes:.1f} minutes)"
+            )
 
     async def sync(self):
         """Sync agricultural fields data"""
@@ -157,42 +127,56 @@ class AgriculturalFields(Source):
         self.start_time = time.time()
         self.features_processed = 0
         self.is_sync_complete = False
+        self.sink = await PartFileSink.resume(self.storage, 'agricultural_fields', shard=self.shard)
+        # Checkpointed OBJECTID ranges are left out of the page plan
+        self.paginator = self._get_paginator(exclude=self.sink.completed_ranges('agricultural_fields'),
+                                             id_range=self.sink.state.get('id_range'))
         
         try:
             conn = aiohttp.TCPConnector(limit=self.max_concurrent, ssl=self.ssl_context)
             async with aiohttp.ClientSession(timeout=self.timeout_config, connector=conn) as session:
-                total_features = await self._get_total_count(session)
+                self.paginator.base_params['f'] = await detect_query_format(
+                    session, self.config['url'], self.paginator.request_kwargs
+                )
+                total_features = await self.paginator.get_total_count(session)
                 logger.info(f"Found {total_features:,} total features")
+                if self.shard.is_sharded:
+                    # Saved with the next part, so a resumed shard keeps its id range
+                    self.sink.state['id_range'] = self.paginator.protocol.id_range
+                    logger.info(f"{self.shard.label}: OBJECTID range {self.paginator.protocol.id_range}")
                 
-                features_batch = []
+                # Fetching, validation and uploads overlap, each stage waiting on the next when it falls behind
+                # Batch sizes and pages in flight follow the memory in use
+                governor = MemoryGovernor('agricultural_fields')
+                governor.add('batch_size', self.storage_batch_size, minimum=self.batch_size,
+                             maximum=self.storage_batch_size * 4)
+                governor.add('max_concurrent', self.max_concurrent,
+                             on_change=lambda value: setattr(self.paginator, 'max_concurrent', value))
+                pipeline = Pipeline('agricultural_fields', governor=governor)
+                pipeline.add('fetch', self._fetch_pages(session, total_features))
+                pipeline.add('batch', lambda pages: batch_pages(pages, lambda: governor['batch_size']),
+                             queue_size=self.max_concurrent)
+                pipeline.add('validate', self._validate_batches)
+                pipeline.add('write', lambda batches: self._write_batches(batches, total_features))
+                await pipeline.run()
                 
-                for start_index in range(0, total_features, self.batch_size):
-                    chunk = await self._fetch_chunk(session, start_index)
-                    if chunk is not None:
-                        features_batch.extend(chunk.to_dict('records'))
-                        self.features_processed += len(chunk)
-                        
-                        # Write batch if it's large enough or it's the last batch
-                        is_last_batch = (start_index + self.batch_size) >= total_features
-                        if len(features_batch) >= self.storage_batch_size or is_last_batch:
-                            logger.info(f"Writing batch of {len(features_batch):,} features (is_last_batch: {is_last_batch})")
-                            self.is_sync_complete = is_last_batch  # Only set True for last batch
-                            await self.write_to_storage(features_batch, 'agricultural_fields')
-                            features_batch = []  # Clear batch after writing
-                            
-                            elapsed = time.time() - self.start_time
-                            speed = self.features_processed / elapsed
-                            remaining = total_features - self.features_processed
-                            eta_minutes = (remaining / speed) / 60 if speed > 0 else 0
-                            
-                            logger.info(
-                                f"Progress: {self.features_processed:,}/{total_features:,} "
-                                f"({speed:.1f} features/second, ETA: {eta_minutes:.1f} minutes)"
-                            )
+                if self.stop_requested:
+                    # Everything fetched was checkpointed, a restarted job resumes from here
+                    raise SyncInterrupted(f"Stopped after {self.features_processed:,} features, progress checkpointed")
+                
+                # Publish the final file
+                self.is_sync_complete = True
+                await self.write_to_storage(None, 'agricultural_fields')
+                
+                self.paginator.log_stats()
+                if self.paginator.failed_offsets:
+                    logger.error(f"Failed to fetch OBJECTID ranges: {[self.paginator.page_range(o) for o in self.paginator.failed_offsets]}")
                 
                 logger.info(f"Sync completed. Total processed: {self.features_processed:,}")
                 return self.features_processed
                 
+        except SyncInterrupted:
+            raise
         except Exception as e:
             logger.error(f"Error in sync: {str(e)}")
             raise
@@ -200,45 +184,42 @@ class AgriculturalFields(Source):
     async def fetch(self):
         return await self.sync()
 
-    async def write_to_storage(self, features, dataset):
-        """Write features to GeoParquet in Cloud Storage"""
-        if not features:
+    async def compact(self):
+        """Publish the OBJECTID range shards of a sharded sync as one file"""
+        self.sink = await PartFileSink.combine_shards(self.storage, 'agricultural_fields')
+        if self.sink is None:
+            logger.info("No agricultural fields shards to compact")
+            return None
+        
+        ranges = sorted(state['id_range'] for state in self.sink.state['shards'])
+        mismatched = [[a[1], b[0]] for a, b in zip(ranges, ranges[1:]) if a[1] != b[0]]
+        if mismatched:
+            # Shards planned from different id lists, ids between them were missed or fetched twice
+            logger.warning(f"OBJECTID ranges of the shards do not meet at: {mismatched}")
+        return await self.sink.publish()
+
+    async def write_to_storage(self, features, dataset, pages=None):
+        """Write features to GeoParquet in Cloud Storage, checkpointing the OBJECTID ranges they came from.
+
+        ``features`` is a GeoDataFrame the sync pipeline already validated, or None.
+        """
+        pages = {dataset: pages} if pages else None
+        if features is None and not pages and not self.is_sync_complete:
             return
         
         try:
-            # Create GeoDataFrame from ArcGIS features
-            gdf = gpd.GeoDataFrame(features, crs="EPSG:25832")
-            gdf.columns = [col.replace('.', '_').replace('(', '_').replace(')', '_') for col in gdf.columns]
-            
-            # Validate and transform geometries
-            gdf = validate_and_transform_geometries(gdf, dataset)
-            
-            # Handle working/final files
-            temp_working = f"/tmp/{dataset}_working.parquet"
-            working_blob = self.bucket.blob(f'raw/{dataset}/working.parquet')
-            
-            if working_blob.exists():
-                working_blob.download_to_filename(temp_working)
-                existing_gdf = gpd.read_parquet(temp_working)
-                logger.info(f"Appending {len(gdf):,} features to existing {len(existing_gdf):,}")
-                combined_gdf = pd.concat([existing_gdf, gdf], ignore_index=True)
-            else:
-                combined_gdf = gdf
-                
-            # Write working file
-            combined_gdf.to_parquet(temp_working)
-            working_blob.upload_from_filename(temp_working)
-            logger.info(f"Updated working file now has {len(combined_gdf):,} features")
-            
-            # If sync complete, create final file
-            if self.is_sync_complete:
-                logger.info(f"Sync complete - writing final file with {len(combined_gdf):,} features")
-                final_blob = self.bucket.blob(f'raw/{dataset}/current.parquet')
-                final_blob.upload_from_filename(temp_working)
-                working_blob.delete()
+            if features is not None:
+                # Append batch as an immutable part file
+                await self.sink.write(features, pages)
+            elif pages:
+                await self.sink.save(pages)
             
-            # Cleanup
-            os.remove(temp_working)
+            # If sync complete, publish the final file, or leave the shard's parts for compaction
+            if self.is_sync_complete and self.sink.shard is not None:
+                await self.sink.finish()
+            elif self.is_sync_complete:
+                logger.info(f"Sync complete - publishing final file with {self.sink.total_rows:,} features")
+                await self.sink.publish()
             
         except Exception as e:
             logger.error(f"Error writing to storage: {str(e)}")
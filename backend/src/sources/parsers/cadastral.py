@@ -1,24 +1,24 @@
-from pathlib import Path
-import asyncio
 import os
-import xml.etree.ElementTree as ET
 from datetime import datetime
 import logging
 import aiohttp
-from shapely.geometry import Polygon, MultiPolygon
-from shapely import wkt
-import geopandas as gpd
-from google.cloud import storage
-import time
-import backoff
-from aiohttp import ClientError, ClientTimeout
+import shapely
 from dotenv import load_dotenv
-from tqdm import tqdm
-import psutil
 import pandas as pd
+import json
 
-from ...base import Source
-from ..utils.geometry_validator import validate_and_transform_geometries
+from ...base import Source, SyncInterrupted
+from ..utils.geometry_validator import validate_in_chunks
+from ..utils.feature_batch import FeatureBatch
+from ..utils.gml_geometry import PolygonBatch, make_valid_polygons
+from ..utils.gml_stream import GMLFeatureStream
+from ..utils.pagination import Paginator, WFSPaging
+from ..utils.part_sink import PartFileSink
+from ..utils.pipeline import Pipeline, batch_pages
+from ..utils.process_pool import run_in_process, spooled_body
+from ..utils.keyset import KeySet
+from ..utils.memory import MemoryGovernor
+from ..utils.tiling import DENMARK_EXTENT_25832, TileFetcher, TileGrid
 
 logger = logging.getLogger(__name__)
 
@@ -29,25 +29,109 @@ def clean_value(value):
     value = value.strip()
     return value if value else None
 
+# Raw text is collected per feature and converted per page, one column at a time
+FIELD_MAPPING = {
+    'BFEnummer': ('bfe_number', 'int'),
+    'forretningshaendelse': ('business_event', 'str'),
+    'forretningsproces': ('business_process', 'str'),
+    'senesteSagLokalId': ('latest_case_id', 'str'),
+    'id_lokalId': ('id_local', 'str'),
+    'id_namespace': ('id_namespace', 'str'),
+    'registreringFra': ('registration_from', 'datetime'),
+    'virkningFra': ('effect_from', 'datetime'),
+    'virkningsaktoer': ('authority', 'str'),
+    'arbejderbolig': ('is_worker_housing', 'bool'),
+    'erFaelleslod': ('is_common_lot', 'bool'),
+    'hovedejendomOpdeltIEjerlejligheder': ('has_owner_apartments', 'bool'),
+    'udskiltVej': ('is_separated_road', 'bool'),
+    'landbrugsnotering': ('agricultural_notation', 'str')
+}
+
+NAMESPACES = {
+    'wfs': 'http://www.opengis.net/wfs/2.0',
+    'mat': 'http://data.gov.dk/schemas/matrikel/1',
+    'gml': 'http://www.opengis.net/gml/3.2'
+}
+FEATURE_TAG = f"{{{NAMESPACES['mat']}}}SamletFastEjendom_Gaeldende"
+FIELD_TAGS = {
+    f"{{{NAMESPACES['mat']}}}{xml_field}": db_field
+    for xml_field, (db_field, _) in FIELD_MAPPING.items()
+}
+
+def _parse_feature(feature_elem):
+    """Collect the raw text of the mapped fields of a single feature"""
+    feature = {}
+    for elem in feature_elem.iter():
+        db_field = FIELD_TAGS.get(elem.tag)
+        if db_field is not None and db_field not in feature and elem.text:
+            feature[db_field] = elem.text
+    return feature
+
+def _convert_columns(df):
+    """Convert the raw text columns of a page to their types in bulk"""
+    for db_field, kind in FIELD_MAPPING.values():
+        if db_field not in df:
+            df[db_field] = None
+        values = df[db_field].astype('string').str.strip().replace('', pd.NA)
+        if kind == 'int':
+            df[db_field] = pd.to_numeric(values, errors='coerce').astype('Int64')
+        elif kind == 'datetime':
+            df[db_field] = pd.to_datetime(values, utc=True, errors='coerce', format='ISO8601')
+        elif kind == 'bool':
+            df[db_field] = values.str.lower().eq('true').astype('boolean').mask(values.isna())
+        else:
+            df[db_field] = values.astype(object).where(values.notna(), None)
+    return df[[db_field for db_field, _ in FIELD_MAPPING.values()]]
+
+def parse_page(content, start_index):
+    """Parse one WFS page body, as bytes or a spooled file path, into a FeatureBatch.
+
+    A module-level function so pages can be parsed in the process pool.
+    """
+    records = []
+    element_count = 0
+    # Datafordeler serves 3D coordinates, x and y are kept
+    geometries = PolygonBatch(dims=3)
+    stream = GMLFeatureStream(content)
+    for feature_elem in stream:
+        if feature_elem.tag != FEATURE_TAG:
+            continue
+        element_count += 1
+        records.append(_parse_feature(feature_elem))
+        geometries.add(feature_elem.find('.//mat:geometri/gml:MultiSurface', NAMESPACES))
+
+    df = _convert_columns(pd.DataFrame.from_records(records, index=range(len(records))))
+    built = make_valid_polygons(geometries.build())
+
+    # Add validation of required fields
+    missing_bfe = df['bfe_number'].isna().to_numpy()
+    missing_geometry = shapely.is_missing(built)
+    if missing_bfe.any():
+        logger.warning(f"Chunk {start_index}: {missing_bfe.sum()} features missing required field bfe_number")
+    if missing_geometry.any():
+        logger.warning(f"Chunk {start_index}: {missing_geometry.sum()} features without a valid geometry")
+    valid = ~(missing_bfe | missing_geometry)
+    features = FeatureBatch(df[valid], built[valid], source_count=element_count)
+
+    # Add validation of returned features count
+    number_returned = stream.attributes.get('numberReturned', '0')
+    logger.info(f"WFS reports {number_returned} features returned in chunk {start_index}")
+
+    valid_count = len(features)
+    logger.info(f"Chunk {start_index}: parsed {valid_count} valid features out of {element_count} elements")
+
+    # Validate that we're getting reasonable numbers
+    if valid_count == 0 and element_count > 0:
+        logger.warning(f"No valid features parsed from {element_count} elements - possible parsing issue")
+    elif valid_count < element_count * 0.5:  # If we're losing more than 50% of features
+        logger.warning(f"Low feature parsing success rate: {valid_count}/{element_count}")
+
+    return features
+
 class Cadastral(Source):
-    def __init__(self, config):
-        super().__init__(config)
-        self.field_mapping = {
-            'BFEnummer': ('bfe_number', int),
-            'forretningshaendelse': ('business_event', str),
-            'forretningsproces': ('business_process', str),
-            'senesteSagLokalId': ('latest_case_id', str),
-            'id_lokalId': ('id_local', str),
-            'id_namespace': ('id_namespace', str),
-            'registreringFra': ('registration_from', lambda x: datetime.fromisoformat(x.replace('Z', '+00:00'))),
-            'virkningFra': ('effect_from', lambda x: datetime.fromisoformat(x.replace('Z', '+00:00'))),
-            'virkningsaktoer': ('authority', str),
-            'arbejderbolig': ('is_worker_housing', lambda x: x.lower() == 'true'),
-            'erFaelleslod': ('is_common_lot', lambda x: x.lower() == 'true'),
-            'hovedejendomOpdeltIEjerlejligheder': ('has_owner_apartments', lambda x: x.lower() == 'true'),
-            'udskiltVej': ('is_separated_road', lambda x: x.lower() == 'true'),
-            'landbrugsnotering': ('agricultural_notation', str)
-        }
+    def __init__(self, config, storage=None):
+        super().__init__(config, storage)
+        self.field_mapping = FIELD_MAPPING
         
         load_dotenv()
         self.username = os.getenv('DATAFORDELER_USERNAME')
@@ -60,9 +144,22 @@ class Cadastral(Source):
         self.max_concurrent = int(os.getenv('CADASTRAL_MAX_CONCURRENT', '5'))
         self.request_timeout = int(os.getenv('CADASTRAL_REQUEST_TIMEOUT', '300'))
         self.total_timeout = int(os.getenv('CADASTRAL_TOTAL_TIMEOUT', '7200'))
-        self.requests_per_second = int(os.getenv('CADASTRAL_REQUESTS_PER_SECOND', '2'))
-        self.last_request_time = {}
-        self.request_semaphore = asyncio.Semaphore(self.max_concurrent)
+        # Shared by all requests to datafordeler.dk, not per task
+        self.requests_per_second = float(os.getenv('CADASTRAL_REQUESTS_PER_SECOND', '10'))
+        self.max_page_retries = int(os.getenv('CADASTRAL_MAX_PAGE_RETRIES', '3'))
+        # auto: incremental when a high-water mark exists, otherwise full
+        self.sync_mode = os.getenv('CADASTRAL_SYNC_MODE', 'auto').lower()
+        self.detect_deletes = os.getenv('CADASTRAL_DETECT_DELETES', 'true').lower() == 'true'
+        self.key_page_size = int(os.getenv('CADASTRAL_KEY_PAGE_SIZE', '10000'))
+        # auto: BBOX tiles for full syncs, startIndex paging for the small incremental ones
+        self.fetch_mode = os.getenv('CADASTRAL_FETCH_MODE', 'auto').lower()
+        self.tile_depth = int(os.getenv('CADASTRAL_TILE_DEPTH', '4'))
+        self.tile_grid = TileGrid(DENMARK_EXTENT_25832)
+        self.fetcher = None
+        self.state_path = 'raw/cadastral/_sync_state.json'
+        self.incremental_since = None
+        self.current_keys = None
+        self.total_processed = 0
         
         self.request_timeout_config = aiohttp.ClientTimeout(
             total=self.request_timeout,
@@ -78,15 +175,15 @@ class Cadastral(Source):
         
         self.timeout = aiohttp.ClientTimeout(total=self.request_timeout)
         
-        self.namespaces = {
-            'wfs': 'http://www.opengis.net/wfs/2.0',
-            'mat': 'http://data.gov.dk/schemas/matrikel/1',
-            'gml': 'http://www.opengis.net/gml/3.2'
-        }
+        self.namespaces = NAMESPACES
+        self.feature_tag = FEATURE_TAG
+        
+        self.paginator = self._get_paginator()
+        self.checkpoint_stream = 'cadastral'
 
-    def _get_base_params(self):
+    def _get_base_params(self, since=None):
         """Get base WFS request parameters without pagination"""
-        return {
+        params = {
             'username': self.username,
             'password': self.password,
             'SERVICE': 'WFS',
@@ -95,278 +192,238 @@ class Cadastral(Source):
             'TYPENAMES': 'mat:SamletFastEjendom_Gaeldende',
             'SRSNAME': 'EPSG:25832'
         }
+        if since is not None:
+            params['FILTER'] = self._get_registration_filter(since)
+        return params
+
+    def _get_fes_filter(self, *predicates):
+        """Wrap FES predicates in a filter, combined with fes:And when there are several"""
+        body = ''.join(predicates)
+        if len(predicates) > 1:
+            body = f'<fes:And>{body}</fes:And>'
+        return (
+            '<fes:Filter xmlns:fes="http://www.opengis.net/fes/2.0" '
+            'xmlns:mat="http://data.gov.dk/schemas/matrikel/1" '
+            f'xmlns:gml="http://www.opengis.net/gml/3.2">{body}</fes:Filter>'
+        )
+
+    def _get_registration_predicate(self, since):
+        """Features registered at or after the high-water mark"""
+        # >= rather than >, re-fetching features at the mark is harmless as merges are upserts
+        return (
+            '<fes:PropertyIsGreaterThanOrEqualTo>'
+            '<fes:ValueReference>mat:registreringFra</fes:ValueReference>'
+            f'<fes:Literal>{since.isoformat()}</fes:Literal>'
+            '</fes:PropertyIsGreaterThanOrEqualTo>'
+        )
+
+    def _get_registration_filter(self, since):
+        """FES filter for features registered at or after the high-water mark"""
+        return self._get_fes_filter(self._get_registration_predicate(since))
 
-    def _get_params(self, start_index=0):
-        """Get WFS request parameters with pagination"""
+    def _get_tile_params(self, bounds, since=None):
+        """Restrict a request to one tile, as BBOX or, with a high-water mark, as a FES filter"""
+        minx, miny, maxx, maxy = bounds
+        if since is None:
+            return {'BBOX': f'{minx},{miny},{maxx},{maxy},urn:ogc:def:crs:EPSG::25832'}
+        # WFS 2.0 does not allow BBOX and FILTER in one request
+        bbox = (
+            '<fes:BBOX>'
+            '<fes:ValueReference>mat:geometri</fes:ValueReference>'
+            '<gml:Envelope srsName="urn:ogc:def:crs:EPSG::25832">'
+            f'<gml:lowerCorner>{minx} {miny}</gml:lowerCorner>'
+            f'<gml:upperCorner>{maxx} {maxy}</gml:upperCorner>'
+            '</gml:Envelope>'
+            '</fes:BBOX>'
+        )
+        return {'FILTER': self._get_fes_filter(bbox, self._get_registration_predicate(since))}
+
+    def _get_tile_fetcher(self, since=None):
+        return TileFetcher(
+            self.config['url'],
+            self._parse_page,
+            self.tile_grid,
+            lambda bounds: self._get_tile_params(bounds, since),
+            capacity=self.page_size,
+            base_params=self._get_base_params(),
+            max_concurrent=self.max_concurrent,
+            max_retries=self.max_page_retries,
+            timeout=self.request_timeout_config,
+            requests_per_second=self.requests_per_second,
+            name='cadastral (tiles)' if since is None else 'cadastral (tiles, incremental)'
+        )
+
+    def _get_paginator(self, since=None):
+        return Paginator(
+            WFSPaging(),
+            self.config['url'],
+            self._parse_page,
+            page_size=self.page_size,
+            base_params=self._get_base_params(since),
+            max_concurrent=self.max_concurrent,
+            max_retries=self.max_page_retries,
+            timeout=self.request_timeout_config,
+            requests_per_second=self.requests_per_second,
+            name='cadastral' if since is None else 'cadastral (incremental)'
+        )
+
+    def _get_key_paginator(self):
+        """Paginator fetching only BFE numbers, used to detect deleted properties"""
         params = self._get_base_params()
-        params.update({
-            'startIndex': str(start_index),
-            'count': str(self.page_size)
-        })
-        return params
+        params['PROPERTYNAME'] = 'mat:BFEnummer'
+        return Paginator(
+            WFSPaging(),
+            self.config['url'],
+            self._parse_key_page,
+            page_size=self.key_page_size,
+            base_params=params,
+            max_concurrent=self.max_concurrent,
+            max_retries=self.max_page_retries,
+            timeout=self.request_timeout_config,
+            requests_per_second=self.requests_per_second,
+            name='cadastral (keys)'
+        )
 
-    def _parse_geometry(self, geom_elem):
-        """Parse GML geometry to WKT"""
-        try:
-            pos_lists = geom_elem.findall('.//gml:posList', self.namespaces)
-            if not pos_lists:
-                return None
-
-            polygons = []
-            for pos_list in pos_lists:
-                if not pos_list.text:
-                    continue
-
-                coords = [float(x) for x in pos_list.text.strip().split()]
-                # Keep the original 3D coordinate handling - take x,y and skip z
-                pairs = [(coords[i], coords[i+1]) 
-                        for i in range(0, len(coords), 3)]
-
-                if len(pairs) < 4:
-                    logger.warning(f"Not enough coordinate pairs ({len(pairs)}) to form a polygon")
-                    continue
-
-                try:
-                    # Check if the polygon is closed (first point equals last point)
-                    if pairs[0] != pairs[-1]:
-                        pairs.append(pairs[0])  # Close the polygon
-                    
-                    polygon = Polygon(pairs)
-                    if polygon.is_valid:
-                        polygons.append(polygon)
-                    else:
-                        # Try to fix invalid polygon
-                        from shapely.ops import make_valid
-                        fixed_polygon = make_valid(polygon)
-                        if fixed_polygon.geom_type in ('Polygon', 'MultiPolygon'):
-                            polygons.append(fixed_polygon)
-                        else:
-                            logger.warning(f"Could not create valid polygon, got {fixed_polygon.geom_type}")
-                except Exception as e:
-                    logger.warning(f"Error creating polygon: {str(e)}")
-                    continue
-
-            if not polygons:
-                return None
-
-            if len(polygons) == 1:
-                final_geom = polygons[0]
-            else:
-                try:
-                    final_geom = MultiPolygon(polygons)
-                except Exception as e:
-                    logger.warning(f"Error creating MultiPolygon: {str(e)}, falling back to first valid polygon")
-                    final_geom = polygons[0]
+    async def _parse_key_page(self, response, start_index):
+        """Parse BFE numbers from a PROPERTYNAME=mat:BFEnummer page"""
+        keys = []
+        async for feature_elem in GMLFeatureStream(response):
+            elem = feature_elem.find('mat:BFEnummer', self.namespaces)
+            if elem is not None and elem.text and elem.text.strip():
+                keys.append(int(elem.text))
+        return keys
 
-            return wkt.dumps(final_geom)
+    async def _load_state(self):
+        if not await self.storage.exists(self.state_path):
+            return None
+        state = json.loads(await self.storage.read_bytes(self.state_path))
+        if state.get('high_water_mark'):
+            state['high_water_mark'] = datetime.fromisoformat(state['high_water_mark'])
+        return state
 
-        except Exception as e:
-            logger.error(f"Error parsing geometry: {str(e)}")
+    async def _save_state(self, high_water_mark, mode, rows):
+        state = {
+            'high_water_mark': high_water_mark.isoformat() if high_water_mark else None,
+            'mode': mode,
+            'rows': rows,
+            'updated': datetime.now().astimezone().isoformat()
+        }
+        await self.storage.write_bytes(self.state_path, json.dumps(state), content_type='application/json')
+        logger.info(f"Saved cadastral high-water mark {state['high_water_mark']}")
+
+    async def _fetch_current_keys(self, session):
+        """All BFE numbers currently in the layer, or None if some pages failed"""
+        paginator = self._get_key_paginator()
+        total = await paginator.get_total_count(session)
+        keys = []
+        async for page in paginator.pages(session, total):
+            if page.items:
+                keys.extend(page.items)
+        paginator.log_stats()
+        if paginator.failed_offsets:
+            logger.error("Could not fetch all BFE numbers, skipping delete detection for this run")
             return None
+        logger.info(f"Fetched {len(keys):,} current BFE numbers")
+        return keys
 
-    def _parse_feature(self, feature_elem):
-        """Parse a single feature"""
-        try:
-            feature = {}
-            
-            # Add validation of the feature element
-            if feature_elem is None:
-                logger.warning("Received None feature element")
-                return None
-            
-            # Parse all mapped fields
-            for xml_field, (db_field, converter) in self.field_mapping.items():
-                elem = feature_elem.find(f'.//mat:{xml_field}', self.namespaces)
-                if elem is not None and elem.text:
-                    try:
-                        value = clean_value(elem.text)
-                        if value is not None:
-                            feature[db_field] = converter(value)
-                    except (ValueError, TypeError) as e:
-                        logger.warning(f"Error converting field {xml_field}: {str(e)}")
-                        continue
-
-            # Parse geometry
-            geom_elem = feature_elem.find('.//mat:geometri/gml:MultiSurface', self.namespaces)
-            if geom_elem is not None:
-                geometry_wkt = self._parse_geometry(geom_elem)
-                if geometry_wkt:
-                    feature['geometry'] = geometry_wkt
-                else:
-                    logger.warning("Failed to parse geometry for feature")
+    async def _parse_page(self, response, start_index):
+        """Parse one WFS page into a FeatureBatch in the process pool"""
+        # The worker streams the body from a spooled file, the page is never held whole
+        async with spooled_body(response) as path:
+            return await run_in_process(parse_page, path, start_index)
 
-            # Add validation of required fields
-            if not feature.get('bfe_number'):
-                logger.warning("Missing required field: bfe_number")
-            if not feature.get('geometry'):
-                logger.warning("Missing required field: geometry")
+    def _checkpoint_mark(self, max_registered):
+        """Keep the newest registration seen with the checkpoint, saved on the next write"""
+        if max_registered is not None:
+            self.sink.state['max_registered'] = max_registered.isoformat()
 
-            return feature if feature.get('bfe_number') and feature.get('geometry') else None
+    async def _fetch_pages(self, session):
+        """Yield (checkpoint range, FeatureBatch) per finished page or tile.
 
-        except Exception as e:
-            logger.error(f"Error parsing feature: {str(e)}")
-            return None
+        The range is None for pages that failed. Tiles are deduplicated on
+        bfe_number, including against the parts of a resumed run.
+        """
+        if self.fetcher is not None:
+            keys = KeySet(await self.sink.read_keys('bfe_number'))
+            # Shards take every n-th tile in Morton order, spreading dense areas across them
+            async for result in self.fetcher.tiles(session, self.shard.select(self.tile_grid.tiles(self.tile_depth)),
+                                                   completed=self.sink.completed_ranges(self.checkpoint_stream),
+                                                   shutdown=self.shutdown):
+                items = result.items
+                if len(items):
+                    new = keys.add_new(items.attributes['bfe_number'].to_numpy(dtype='int64'))
+                    if not new.all():
+                        # Properties crossing a tile border come back from every tile they touch
+                        items = FeatureBatch(items.attributes[new], items.geometry[new], source_count=items.source_count)
+                yield result.key_range, items
+            return
 
-    async def _get_total_count(self, session):
-        """Get total number of features from first page metadata"""
-        params = self._get_base_params()
-        params.update({
-            'startIndex': '0',
-            'count': '1'  # Just get one feature to check metadata
-        })
-        
-        try:
-            logger.info("Getting total count from first page metadata...")
-            async with session.get(self.config['url'], params=params) as response:
-                response.raise_for_status()
-                text = await response.text()
-                root = ET.fromstring(text)
-                
-                # Handle case where numberMatched might be '*'
-                number_matched = root.get('numberMatched', '0')
-                number_returned = root.get('numberReturned', '0')
-                
-                logger.info(f"WFS response metadata - numberMatched: {number_matched}, numberReturned: {number_returned}")
-                
-                if number_matched == '*':
-                    # If server doesn't provide exact count, fetch a larger page to estimate
-                    logger.warning("Server returned '*' for numberMatched, fetching sample to estimate...")
-                    params['count'] = '1000'
-                    async with session.get(self.config['url'], params=params) as sample_response:
-                        sample_text = await sample_response.text()
-                        sample_root = ET.fromstring(sample_text)
-                        feature_count = len(sample_root.findall('.//mat:SamletFastEjendom_Gaeldende', self.namespaces))
-                        # Estimate conservatively
-                        return feature_count * 2000  # Adjust multiplier based on expected data size
-                
-                if not number_matched.isdigit():
-                    raise ValueError(f"Invalid numberMatched value: {number_matched}")
-                    
-                total_available = int(number_matched)
-                
-                # Add sanity check for unreasonable numbers
-                if total_available > 5000000:  # Adjust threshold as needed
-                    logger.warning(f"Unusually high feature count: {total_available:,}. This may indicate an issue.")
-                    
-                return total_available
-                
-        except Exception as e:
-            logger.error(f"Error getting total count: {str(e)}")
-            raise
+        total_features = await self.paginator.get_total_count(session)
+        if total_features is None:
+            logger.warning("Server returned '*' for numberMatched, paging until the first short page")
+        else:
+            logger.info(f"Found {total_features:,} total features")
+            # Add sanity check for unreasonable numbers
+            if total_features > 5000000 and self.incremental_since is None:
+                logger.warning(f"Unusually high feature count: {total_features:,}. This may indicate an issue.")
+        async for page in self.paginator.pages(session, total_features,
+                                               skip=self.shard.skipper(self.sink.skipper(self.checkpoint_stream)),
+                                               shutdown=self.shutdown):
+            yield (self.paginator.page_range(page.offset) if page.items is not None else None), page.items
 
-    async def _wait_for_rate_limit(self):
-        """Ensure we don't exceed requests_per_second"""
-        worker_id = id(asyncio.current_task())
-        if worker_id in self.last_request_time:
-            elapsed = time.time() - self.last_request_time[worker_id]
-            if elapsed < 1.0 / self.requests_per_second:
-                await asyncio.sleep(1.0 / self.requests_per_second - elapsed)
-        self.last_request_time[worker_id] = time.time()
-
-    @backoff.on_exception(
-        backoff.expo,
-        (ClientError, asyncio.TimeoutError),
-        max_tries=3,
-        max_time=60
-    )
-    async def _fetch_chunk(self, session, start_index, timeout=None):
-        """Fetch a chunk of features with rate limiting and retries"""
-        async with self.request_semaphore:
-            await self._wait_for_rate_limit()
-            
-            params = self._get_params(start_index)
-            
-            try:
-                logger.info(f"Fetching chunk at index {start_index}")
-                async with session.get(
-                    self.config['url'], 
-                    params=params,
-                    timeout=timeout or self.request_timeout_config
-                ) as response:
-                    if response.status == 429:  # Too Many Requests
-                        retry_after = int(response.headers.get('Retry-After', 5))
-                        logger.warning(f"Rate limited, waiting {retry_after} seconds")
-                        await asyncio.sleep(retry_after)
-                        raise ClientError("Rate limited")
-                    
-                    response.raise_for_status()
-                    content = await response.text()
-                    root = ET.fromstring(content)
-                    
-                    # Add validation of returned features count
-                    number_returned = root.get('numberReturned', '0')
-                    logger.info(f"WFS reports {number_returned} features returned in this chunk")
-                    
-                    features = []
-                    feature_elements = root.findall('.//mat:SamletFastEjendom_Gaeldende', self.namespaces)
-                    logger.info(f"Found {len(feature_elements)} feature elements in XML")
-                    
-                    for feature_elem in feature_elements:
-                        feature = self._parse_feature(feature_elem)
-                        if feature:
-                            features.append(feature)
-                    
-                    valid_count = len(features)
-                    logger.info(f"Chunk {start_index}: parsed {valid_count} valid features out of {len(feature_elements)} elements")
-                    
-                    # Validate that we're getting reasonable numbers
-                    if valid_count == 0 and len(feature_elements) > 0:
-                        logger.warning(f"No valid features parsed from {len(feature_elements)} elements - possible parsing issue")
-                    elif valid_count < len(feature_elements) * 0.5:  # If we're losing more than 50% of features
-                        logger.warning(f"Low feature parsing success rate: {valid_count}/{len(feature_elements)}")
-                    
-                    return features
-                    
-            except Exception as e:
-                logger.error(f"Error fetching chunk at index {start_index}: {str(e)}")
-                raise
-
-    @backoff.on_exception(
-        backoff.expo,
-        Exception,  # Consider narrowing this to specific storage exceptions
-        max_tries=3,
-        max_time=300
-    )
-    async def write_to_storage(self, features, dataset):
-        """Write features to GeoParquet in Cloud Storage"""
-        if not features:
+    async def _validate(self, features, dataset):
+        """Validate and transform the geometries of a batch, off the event loop"""
+        gdf = features.to_geodataframe(crs="EPSG:25832")
+        return await validate_in_chunks(gdf, dataset)
+
+    async def _validate_batches(self, batches):
+        """Pipeline stage validating batches, passing on their ranges and the newest registration so far"""
+        max_registered = self.sink.state.get('max_registered')
+        max_registered = datetime.fromisoformat(max_registered) if max_registered else None
+        async for features, ranges in batches:
+            if features:
+                self.total_processed += len(features)
+                registered = features.attributes['registration_from'].max()
+                if pd.notna(registered) and (max_registered is None or registered > max_registered):
+                    max_registered = registered.to_pydatetime()
+            yield (await self._validate(features, 'cadastral') if features else None), ranges, max_registered
+
+    async def _write_batches(self, batches):
+        """Pipeline stage appending validated batches to the sink"""
+        async for gdf, ranges, max_registered in batches:
+            if gdf is not None:
+                logger.info(f"Writing batch of {len(gdf):,} features")
+            self._checkpoint_mark(max_registered)
+            await self.write_to_storage(gdf, 'cadastral', ranges)
+            logger.info(f"Progress: {self.total_processed:,} features")
+
+    async def write_to_storage(self, features, dataset, pages=None):
+        """Write features to GeoParquet in Cloud Storage, checkpointing the page or tile ranges they came from.
+
+        ``features`` is a GeoDataFrame the sync pipeline already validated, or None.
+        """
+        pages = {self.checkpoint_stream: pages} if pages else None
+        if features is None and not pages and not self.is_sync_complete:
             return
             
         try:
-            # Create DataFrame from WKT features
-            df = pd.DataFrame([{k:v for k,v in f.items() if k != 'geometry'} for f in features])
-            geometries = [wkt.loads(f['geometry']) for f in features]
-            gdf = gpd.GeoDataFrame(df, geometry=geometries, crs="EPSG:25832")
-            
-            # Validate and transform geometries
-            gdf = validate_and_transform_geometries(gdf, dataset)
-            
-            # Handle working/final files
-            temp_working = f"/tmp/{dataset}_working.parquet"
-            working_blob = self.bucket.blob(f'raw/{dataset}/working.parquet')
+            if features is not None:
+                # Append batch as an immutable part file
+                await self.sink.write(features, pages)
+            elif pages:
+                await self.sink.save(pages)
             
-            if working_blob.exists():
-                working_blob.download_to_filename(temp_working)
-                existing_gdf = gpd.read_parquet(temp_working)
-                logger.info(f"Appending {len(gdf):,} features to existing {len(existing_gdf):,}")
-                combined_gdf = pd.concat([existing_gdf, gdf], ignore_index=True)
-            else:
-                combined_gdf = gdf
-                
-            # Write working file
-            combined_gdf.to_parquet(temp_working)
-            working_blob.upload_from_filename(temp_working)
-            logger.info(f"Updated working file now has {len(combined_gdf):,} features")
-            
-            # If sync complete, create final file
-            if self.is_sync_complete:
-                logger.info(f"Sync complete - writing final file with {len(combined_gdf):,} features")
-                final_blob = self.bucket.blob(f'raw/{dataset}/current.parquet')
-                final_blob.upload_from_filename(temp_working)
-                working_blob.delete()
-            
-            # Cleanup
-            os.remove(temp_working)
+            # If sync complete, publish the final file, or leave the shard's parts for compaction
+            if self.is_sync_complete and self.sink.shard is not None:
+                await self.sink.finish()
+            elif self.is_sync_complete:
+                if self.incremental_since is None:
+                    logger.info(f"Sync complete - publishing final file with {self.sink.total_rows:,} features")
+                    # Shards fetch overlapping tile borders, so keep one row per property
+                    await self.sink.publish(key='bfe_number')
+                else:
+                    logger.info(f"Sync complete - merging {self.sink.total_rows:,} changed features")
+                    await self.sink.publish_merged('bfe_number', keep_keys=self.current_keys)
             
         except Exception as e:
             logger.error(f"Error writing to storage: {str(e)}")
@@ -376,51 +433,141 @@ class Cadastral(Source):
         """Sync cadastral data to Cloud Storage"""
         logger.info("Starting cadastral sync...")
         self.is_sync_complete = False
+        self.sink = await PartFileSink.resume(self.storage, 'cadastral', shard=self.shard)
+        self.incremental_since = None
+        self.current_keys = None
         
         try:
+            if 'mode' in self.sink.state:
+                # A resumed run keeps the mode and mark it started with
+                high_water_mark = self.sink.state.get('since')
+                high_water_mark = datetime.fromisoformat(high_water_mark) if high_water_mark else None
+            else:
+                state = await self._load_state() if self.sync_mode != 'full' else None
+                high_water_mark = state.get('high_water_mark') if state else None
+            self.sink.state['mode'] = 'full' if high_water_mark is None else 'incremental'
+            self.sink.state['since'] = high_water_mark.isoformat() if high_water_mark else None
+            
+            if high_water_mark is not None:
+                self.incremental_since = high_water_mark
+                logger.info(f"Incremental sync of features registered since {high_water_mark.isoformat()}")
+            elif self.sync_mode == 'incremental':
+                raise ValueError("CADASTRAL_SYNC_MODE=incremental but no high-water mark is stored, run a full sync first")
+            else:
+                logger.info("Full sync")
+            
+            # A resumed run keeps its fetch mode, the checkpointed ranges depend on it
+            fetch_mode = self.sink.state.get('fetch_mode') or self.fetch_mode
+            if fetch_mode not in ('tiles', 'offset'):
+                fetch_mode = 'offset' if self.incremental_since is not None else 'tiles'
+            self.sink.state['fetch_mode'] = fetch_mode
+            if fetch_mode == 'tiles':
+                self.fetcher = self._get_tile_fetcher(self.incremental_since)
+                self.checkpoint_stream = 'cadastral_tiles'
+                logger.info(f"Fetching BBOX tiles of at most {self.page_size:,} features, "
+                            f"starting from depth {self.tile_depth}")
+            else:
+                self.fetcher = None
+                self.paginator = self._get_paginator(self.incremental_since)
+                self.checkpoint_stream = 'cadastral'
+            
             async with aiohttp.ClientSession(timeout=self.total_timeout_config) as session:
-                total_features = await self._get_total_count(session)
-                logger.info(f"Found {total_features:,} total features")
+                # Sharded syncs leave the merge, and so the delete detection, to compact()
+                if self.incremental_since is not None and self.detect_deletes and self.sink.shard is None:
+                    self.current_keys = await self._fetch_current_keys(session)
+                
+                # Fetching, validation and uploads overlap, each stage waiting on the next when it falls behind
+                # Batch sizes and pages in flight follow the memory in use
+                fetcher = self.fetcher if self.fetcher is not None else self.paginator
+                governor = MemoryGovernor('cadastral')
+                governor.add('batch_size', self.batch_size, minimum=min(self.page_size, self.batch_size),
+                             maximum=self.batch_size * 4)
+                governor.add('max_concurrent', self.max_concurrent,
+                             on_change=lambda value: setattr(fetcher, 'max_concurrent', value))
                 
-                features_batch = []
-                total_processed = 0
-                failed_chunks = []
+                self.total_processed = 0
+                pipeline = Pipeline('cadastral', governor=governor)
+                pipeline.add('fetch', self._fetch_pages(session))
+                pipeline.add('batch', lambda pages: batch_pages(pages, lambda: governor['batch_size']),
+                             queue_size=self.max_concurrent)
+                pipeline.add('validate', self._validate_batches)
+                pipeline.add('write', self._write_batches)
+                await pipeline.run()
                 
-                for start_index in range(0, total_features, self.page_size):
-                    try:
-                        chunk = await self._fetch_chunk(session, start_index)
-                        if chunk:
-                            features_batch.extend(chunk)
-                            total_processed += len(chunk)
-                            
-                            # Log progress every 10,000 features
-                            if total_processed % 10000 == 0:
-                                logger.info(f"Progress: {total_processed:,}/{total_features:,} features ({(total_processed/total_features)*100:.1f}%)")
-                            
-                            # Write batch if it's large enough or it's the last batch
-                            is_last_batch = (start_index + self.page_size) >= total_features
-                            if len(features_batch) >= self.batch_size or is_last_batch:
-                                logger.info(f"Writing batch of {len(features_batch):,} features (is_last_batch: {is_last_batch})")
-                                self.is_sync_complete = is_last_batch
-                                await self.write_to_storage(features_batch, 'cadastral')
-                                features_batch = []
-                                
-                    except Exception as e:
-                        logger.error(f"Error processing batch at {start_index}: {str(e)}")
-                        failed_chunks.append(start_index)
-                        continue
+                if self.stop_requested:
+                    # Everything fetched was checkpointed, a restarted job resumes from here
+                    raise SyncInterrupted(f"Stopped after {self.total_processed:,} features, progress checkpointed")
                 
-                if failed_chunks:
-                    logger.error(f"Failed to process chunks starting at indices: {failed_chunks}")
+                if self.fetcher is not None:
+                    self.fetcher.log_stats()
+                    failed = [self.tile_grid.label(tile) for tile in self.fetcher.failed_tiles]
+                else:
+                    self.paginator.log_stats()
+                    failed = self.paginator.failed_offsets
+                if self.sink.shard is not None:
+                    # Checked by compact() before it advances the high-water mark
+                    self.sink.state['failed'] = failed
+                
+                # Publish the final file
+                self.is_sync_complete = True
+                await self.write_to_storage(None, 'cadastral')
+                
+                if failed:
+                    logger.error(f"Failed to process {'tiles' if self.fetcher is not None else 'chunks starting at indices'}: {failed}")
+                    # Changes in the failed pages would be skipped by a later mark
+                    logger.warning("Not advancing the high-water mark because some pages failed")
+                elif self.sink.shard is None:
+                    max_registered = self.sink.state.get('max_registered')
+                    max_registered = datetime.fromisoformat(max_registered) if max_registered else None
+                    await self._save_state(
+                        max(filter(None, [max_registered, self.incremental_since]), default=None),
+                        'full' if self.incremental_since is None else 'incremental',
+                        self.sink.total_rows
+                    )
                 
-                logger.info(f"Sync completed. Total processed: {total_processed:,} features")
-                return total_processed
+                logger.info(f"Sync completed. Total processed: {self.total_processed:,} features")
+                return self.total_processed
                 
+        except SyncInterrupted:
+            raise
         except Exception as e:
             self.is_sync_complete = False
             logger.error(f"Error in sync: {str(e)}")
             raise
 
+    async def compact(self):
+        """Publish the shards of a sharded sync and advance the high-water mark"""
+        self.sink = await PartFileSink.combine_shards(self.storage, 'cadastral')
+        if self.sink is None:
+            logger.info("No cadastral shards to compact")
+            return None
+        
+        shard_states = self.sink.state['shards']
+        modes = {(state.get('mode'), state.get('since')) for state in shard_states}
+        if len(modes) > 1:
+            raise ValueError(f"Shards ran different sync modes, cannot compact them together: {sorted(modes, key=str)}")
+        mode, since = modes.pop()
+        self.incremental_since = datetime.fromisoformat(since) if since else None
+        self.current_keys = None
+        if self.incremental_since is not None and self.detect_deletes:
+            async with aiohttp.ClientSession(timeout=self.total_timeout_config) as session:
+                self.current_keys = await self._fetch_current_keys(session)
+        
+        if self.incremental_since is None:
+            total_rows = await self.sink.publish(key='bfe_number')
+        else:
+            logger.info(f"Merging {self.sink.total_rows:,} changed features from {len(shard_states)} shards")
+            total_rows = await self.sink.publish_merged('bfe_number', keep_keys=self.current_keys)
+        
+        failed = [item for state in shard_states for item in state.get('failed') or []]
+        if failed:
+            logger.error(f"Shards failed to process: {failed}")
+            logger.warning("Not advancing the high-water mark because some pages failed")
+        else:
+            marks = [datetime.fromisoformat(state['max_registered']) for state in shard_states if state.get('max_registered')]
+            await self._save_state(max(filter(None, marks + [self.incremental_since]), default=None), mode, total_rows)
+        return total_rows
+
     async def fetch(self):
         """Implement abstract method - using sync() instead"""
         logger.info("Fetch method called - using sync() instead")
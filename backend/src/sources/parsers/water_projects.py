@@ -1,24 +1,20 @@
-from pathlib import Path
 import asyncio
-import os
-import xml.etree.ElementTree as ET
-from datetime import datetime
 import logging
 import aiohttp
-from shapely.geometry import Polygon, MultiPolygon
-from shapely import wkt
-from shapely.ops import unary_union
-import geopandas as gpd
+import shapely
 import pandas as pd
-from google.cloud import storage
-import time
-import backoff
-from aiohttp import ClientError, ClientTimeout
-from dotenv import load_dotenv
-from tqdm import tqdm
+from aiohttp import ClientTimeout
 
-from ...base import Source
-from ..utils.geometry_validator import validate_and_transform_geometries
+from ...base import Source, SyncInterrupted
+from ..utils.geometry_validator import validate_in_chunks
+from ..utils.arcgis_pbf import detect_query_format, read_query_response
+from ..utils.feature_batch import FeatureBatch
+from ..utils.gml_geometry import PolygonBatch
+from ..utils.gml_stream import GMLFeatureStream
+from ..utils.pagination import ArcGISObjectIdPaging, Paginator, WFSPaging
+from ..utils.part_sink import PartFileSink
+from ..utils.rate_limit import get_host_limiter
+from ..utils.tiled_union import tiled_union
 
 logger = logging.getLogger(__name__)
 
@@ -30,10 +26,13 @@ def clean_value(value):
     return value if value else None
 
 class WaterProjects(Source):
-    def __init__(self, config):
-        super().__init__(config)
+    def __init__(self, config, storage=None):
+        super().__init__(config, storage)
         self.batch_size = 100
+        self.arcgis_page_size = 1000
+        # Pages in flight per layer; each host's limiter caps the total per host
         self.max_concurrent = 3
+        self.max_concurrent_per_host = 4
         self.request_timeout = 300
         self.storage_batch_size = 5000  # Size for storage batches
         
@@ -65,8 +64,6 @@ class WaterProjects(Source):
             "Klima_lavbund_demarkation___offentlige_projekter:0"
         ]
         
-        self.request_semaphore = asyncio.Semaphore(self.max_concurrent)
-        
         self.url_mapping = {
             'vandprojekter:kla_projektforslag': 'https://wfs2-miljoegis.mim.dk/vandprojekter/wfs',
             'vandprojekter:kla_projektomraader': 'https://wfs2-miljoegis.mim.dk/vandprojekter/wfs',
@@ -77,82 +74,44 @@ class WaterProjects(Source):
             'Klima_lavbund_demarkation___offentlige_projekter:0': 'arcgis'
         }
 
-    def _get_params(self, layer, start_index=0):
-        """Get WFS request parameters"""
+    def _get_base_params(self, layer):
+        """Get WFS request parameters without pagination"""
         return {
             'SERVICE': 'WFS',
             'REQUEST': 'GetFeature',
             'VERSION': '2.0.0',
             'TYPENAMES': layer,
-            'STARTINDEX': str(start_index),
-            'COUNT': str(self.batch_size),
             'SRSNAME': 'urn:ogc:def:crs:EPSG::25832'
         }
 
-    def _parse_geometry(self, geom_elem):
-        """Parse GML geometry into WKT and calculate area"""
-        try:
-            gml_ns = '{http://www.opengis.net/gml/3.2}'
-            
-            multi_surface = geom_elem.find(f'.//{gml_ns}MultiSurface')
-            if multi_surface is None:
-                logger.error("No MultiSurface element found")
-                return None
-            
-            polygons = []
-            for surface_member in multi_surface.findall(f'.//{gml_ns}surfaceMember'):
-                polygon = surface_member.find(f'.//{gml_ns}Polygon')
-                if polygon is None:
-                    continue
-                    
-                pos_list = polygon.find(f'.//{gml_ns}posList')
-                if pos_list is None or not pos_list.text:
-                    continue
-                    
-                try:
-                    coords = [float(x) for x in pos_list.text.strip().split()]
-                    coords = [(coords[i], coords[i+1]) for i in range(0, len(coords), 2)]
-                    if len(coords) >= 4:  # Ensure we have enough coordinates
-                        polygons.append(Polygon(coords))
-                except Exception as e:
-                    logger.error(f"Failed to parse coordinates: {str(e)}")
-                    continue
-            
-            if not polygons:
-                return None
-            
-            geom = MultiPolygon(polygons) if len(polygons) > 1 else polygons[0]
-            area_ha = geom.area / 10000  # Convert square meters to hectares
-            
-            return {
-                'wkt': geom.wkt,
-                'area_ha': area_ha
-            }
-            
-        except Exception as e:
-            logger.error(f"Error parsing geometry: {str(e)}")
-            return None
+    def _get_paginator(self, layer, url):
+        """Build the WFS paginator for one layer"""
+        async def parse_page(response, start_index):
+            return await self._parse_page(response, layer)
 
-    def _parse_feature(self, feature, layer_name):
-        """Parse a single feature into a dictionary"""
-        try:
-            namespace = feature.tag.split('}')[0].strip('{')
-            
-            geom_elem = feature.find(f'{{%s}}the_geom' % namespace) or feature.find(f'{{%s}}wkb_geometry' % namespace)
-            if geom_elem is None:
-                logger.warning(f"No geometry found in feature for layer {layer_name}")
-                return None
+        return Paginator(
+            WFSPaging(),
+            url,
+            parse_page,
+            page_size=self.batch_size,
+            base_params=self._get_base_params(layer),
+            max_concurrent=self.max_concurrent,
+            timeout=self.request_timeout_config,
+            name=layer,
+            limiter=get_host_limiter(url, max_concurrency=self.max_concurrent_per_host)
+        )
 
-            geometry_data = self._parse_geometry(geom_elem)
-            if geometry_data is None:
-                logger.warning(f"Failed to parse geometry for layer {layer_name}")
-                return None
+    def _get_geometry_element(self, feature):
+        namespace = feature.tag.split('}')[0].strip('{')
+        geom_elem = feature.find(f'{{{namespace}}}the_geom')
+        if geom_elem is None:
+            geom_elem = feature.find(f'{{{namespace}}}wkb_geometry')
+        return geom_elem
 
-            data = {
-                'layer_name': layer_name,
-                'geometry': geometry_data['wkt'],
-                'area_ha': geometry_data['area_ha']
-            }
+    def _parse_feature(self, feature, layer_name):
+        """Parse the attributes of a single feature, the geometry is built per page"""
+        try:
+            data = {'layer_name': layer_name}
             
             for elem in feature:
                 if not elem.tag.endswith(('the_geom', 'wkb_geometry')):
@@ -179,266 +138,213 @@ class WaterProjects(Source):
             logger.error(f"Error parsing feature in layer {layer_name}: {str(e)}", exc_info=True)
             return None
 
-    @backoff.on_exception(
-        backoff.expo,
-        (ClientError, asyncio.TimeoutError),
-        max_tries=3
-    )
-    async def _fetch_chunk(self, session, layer, start_index):
-        """Fetch a chunk of features with retries"""
-        async with self.request_semaphore:
-            params = self._get_params(layer, start_index)
-            url = self.url_mapping.get(layer, self.config['url'])
-            
-            try:
-                async with session.get(
-                    url, 
-                    params=params,
-                    timeout=self.request_timeout_config
-                ) as response:
-                    if response.status != 200:
-                        logger.error(f"Error fetching chunk. Status: {response.status}")
-                        error_text = await response.text()
-                        logger.error(f"Error response: {error_text[:500]}")
-                        return None
-                    
-                    text = await response.text()
-                    root = ET.fromstring(text)
-                    
-                    features = []
-                    namespaces = {}
-                    for elem in root.iter():
-                        if '}' in elem.tag:
-                            ns_url = elem.tag.split('}')[0].strip('{')
-                            namespaces['ns'] = ns_url
-                            break
-                    
-                    for member in root.findall('.//ns:member', namespaces=namespaces):
-                        for feature in member:
-                            parsed = self._parse_feature(feature, layer)
-                            if parsed and parsed.get('geometry'):
-                                features.append(parsed)
-                    
-                    return features
-                    
-            except Exception as e:
-                logger.error(f"Error fetching chunk: {str(e)}")
-                raise
+    async def _parse_page(self, response, layer):
+        """Parse one WFS page of a layer into a FeatureBatch"""
+        features = []
+        element_count = 0
+        geometries = PolygonBatch(dims=2)
+        async for feature in GMLFeatureStream(response):
+            element_count += 1
+            geom_elem = self._get_geometry_element(feature)
+            if geom_elem is None:
+                logger.warning(f"No geometry found in feature for layer {layer}")
+                continue
+            parsed = self._parse_feature(feature, layer)
+            if parsed:
+                geometries.add(geom_elem)
+                features.append(parsed)
+        
+        built = geometries.build()
+        missing = shapely.is_missing(built)
+        if missing.any():
+            logger.warning(f"Failed to parse {missing.sum()} geometries for layer {layer}")
+        df = pd.DataFrame.from_records(features, index=range(len(features)))
+        df['area_ha'] = shapely.area(built) / 10000  # Convert square meters to hectares
+        return FeatureBatch(df[~missing], built[~missing], source_count=element_count)
+
+    async def write_to_storage(self, features, dataset, pages=None):
+        """Write features to GeoParquet in Cloud Storage.
 
-    async def write_to_storage(self, features, dataset):
-        """Write features to GeoParquet in Cloud Storage"""
-        if not features:
+        ``pages`` maps each layer to the checkpoint ranges of the pages the features came from.
+        """
+        pages = {layer: ranges for layer, ranges in pages.items() if ranges} if pages else None
+        if not features and not pages and not self.is_sync_complete:
             return
         
         try:
-            # Create DataFrame from features
-            df = pd.DataFrame(features)
-            geometries = [wkt.loads(f['geometry']) for f in features]
-            gdf = gpd.GeoDataFrame(df, geometry=geometries, crs="EPSG:25832")
-            
-            # Validate and transform geometries
-            gdf = validate_and_transform_geometries(gdf, dataset)
-            
-            # Handle working/final files
-            temp_working = f"/tmp/{dataset}_working.parquet"
-            working_blob = self.bucket.blob(f'raw/{dataset}/working.parquet')
-            
-            if working_blob.exists():
-                working_blob.download_to_filename(temp_working)
-                existing_gdf = gpd.read_parquet(temp_working)
-                logger.info(f"Appending {len(gdf):,} features to existing {len(existing_gdf):,}")
-                combined_gdf = pd.concat([existing_gdf, gdf], ignore_index=True)
-            else:
-                combined_gdf = gdf
-            
-            # Write working file
-            combined_gdf.to_parquet(temp_working)
-            working_blob.upload_from_filename(temp_working)
-            logger.info(f"Updated working file now has {len(combined_gdf):,} features")
+            if features:
+                gdf = features.to_geodataframe(crs="EPSG:25832")
+                
+                # Validate and transform geometries, off the event loop
+                gdf = await validate_in_chunks(gdf, dataset)
+                
+                # Append batch as an immutable part file
+                await self.sink.write(gdf, pages)
+            elif pages:
+                await self.sink.save(pages)
             
             # If sync complete, create final files
-            if hasattr(self, 'is_sync_complete') and self.is_sync_complete:
+            if self.is_sync_complete and self.sink.total_rows:
                 logger.info(f"Sync complete - writing final files")
+                combined_gdf = await self.sink.read_all()
                 
-                # Write regular final file
-                final_blob = self.bucket.blob(f'raw/{dataset}/current.parquet')
-                final_blob.upload_from_filename(temp_working)
-                
-                # Create dissolved version
+                # Create dissolved version, unioned tile by tile in the process pool
                 logger.info("Creating dissolved version...")
-                dissolved = unary_union(combined_gdf.geometry.values)
-                dissolved_gdf = gpd.GeoDataFrame(geometry=[dissolved], crs=combined_gdf.crs)
+                by = 'layer_name' if self.config.get('dissolve_by_layer') else None
+                dissolved_gdf = await tiled_union(combined_gdf, by=by)
                 
-                # Write dissolved version
-                temp_dissolved = f"/tmp/{dataset}_dissolved.parquet"
-                dissolved_gdf.to_parquet(temp_dissolved)
-                dissolved_blob = self.bucket.blob(f'raw/{dataset}/dissolved_current.parquet')
-                dissolved_blob.upload_from_filename(temp_dissolved)
+                # Write dissolved version, one row per polygon in spatial order with a bbox column to filter on
+                await self.sink.write_file(dissolved_gdf, 'dissolved_current.parquet',
+                                           covering=True, row_group_size=10_000)
                 logger.info("Dissolved version created and saved")
                 
-                # Cleanup
-                working_blob.delete()
-                os.remove(temp_dissolved)
-            
-            # Cleanup working file
-            if os.path.exists(temp_working):
-                os.remove(temp_working)
+                # Write regular final file last, so a restart during the dissolve reuses the parts
+                await self.sink.publish()
             
         except Exception as e:
             logger.error(f"Error writing to storage: {str(e)}")
             raise
 
-    async def _fetch_arcgis_features(self, session, layer, url):
-        """Fetch features from ArcGIS REST service"""
-        try:
-            params = {
+    def _get_arcgis_paginator(self, layer, url, exclude=None):
+        """Build the OBJECTID-range paginator for an ArcGIS layer, leaving out the ids in ``exclude``"""
+        async def parse_page(response, start_index):
+            return await self._parse_arcgis_page(response, layer)
+
+        return Paginator(
+            ArcGISObjectIdPaging(exclude=exclude),
+            f"{url}/{layer.split(':')[1]}/query",
+            parse_page,
+            page_size=self.arcgis_page_size,
+            base_params={
                 'f': 'json',
                 'where': '1=1',
                 'outFields': '*',
                 'geometryPrecision': '6',
                 'outSR': '25832',
                 'returnGeometry': 'true'
-            }
+            },
+            max_concurrent=self.max_concurrent,
+            timeout=self.request_timeout_config,
+            name=layer,
+            limiter=get_host_limiter(url, max_concurrency=self.max_concurrent_per_host)
+        )
 
-            async with session.get(f"{url}/{layer.split(':')[1]}/query", params=params) as response:
-                if response.status != 200:
-                    logger.error(f"Error fetching ArcGIS features. Status: {response.status}")
-                    return None
+    async def _parse_arcgis_page(self, response, layer):
+        """Parse one ArcGIS query page of a layer into a FeatureBatch"""
+        batch = await read_query_response(response)
+        has_geometry = ~shapely.is_missing(batch.geometry)
+        attrs = batch.attributes[has_geometry].reset_index(drop=True)
+        geometries = batch.geometry[has_geometry]
+        
+        def timestamps(name):
+            # Date fields arrive typed from the field list, otherwise as epoch milliseconds
+            if name not in attrs:
+                return None
+            values = attrs[name]
+            if not pd.api.types.is_datetime64_any_dtype(values):
+                values = pd.to_datetime(values, unit='ms', utc=True, errors='coerce')
+            return values.dt.tz_localize(None)
+        
+        df = pd.DataFrame({
+            'layer_name': layer,
+            'area_ha': shapely.area(geometries) / 10000,
+            'projektnavn': attrs.get('projektnavn'),
+            'enhedskontakt': attrs.get('enhedskontakt'),
+            'startdato': timestamps('projektstart'),
+            'slutdato': timestamps('projektslut'),
+            'status': attrs.get('status'),
+            'object_id': attrs.get('OBJECTID'),
+            'global_id': attrs.get('GlobalID')
+        }, index=attrs.index)
+        
+        return FeatureBatch(df, geometries, source_count=batch.source_count)
+
+    async def _fetch_layer(self, session, layer):
+        """Fetch one layer, returning (layer, FeatureBatch, checkpoint ranges of the fetched pages)"""
+        features = FeatureBatch()
+        ranges = []
+        try:
+            service_type = self.service_types.get(layer, 'wfs')
+            base_url = self.url_mapping.get(layer, self.config['url'])
+            skip = None
+
+            if service_type == 'arcgis':
+                # Checkpointed OBJECTID ranges are left out of the page plan instead of skipped
+                paginator = self._get_arcgis_paginator(layer, base_url, exclude=self.sink.completed_ranges(layer))
+                paginator.base_params['f'] = await detect_query_format(session, paginator.url)
+            else:
+                paginator = self._get_paginator(layer, base_url)
+                skip = self.sink.skipper(layer)
+            total_features = await paginator.get_total_count(session)
+            logger.info(f"Layer {layer}: found {total_features if total_features is not None else 'unknown number of'} total features")
+
+            async for page in paginator.pages(session, total_features, skip=skip, shutdown=self.shutdown):
+                if page.items is not None:
+                    ranges.append(paginator.page_range(page.offset))
+                if page.items:
+                    features.extend(page.items)
+                    logger.debug(f"Layer {layer}: processed {len(page.items):,} features at offset {page.offset:,}")
+            paginator.log_stats()
 
-                data = await response.json()
-                features = []
-                
-                for feature in data.get('features', []):
-                    try:
-                        attrs = feature.get('attributes', {})
-                        geom = feature.get('geometry', {})
-                        
-                        if 'rings' not in geom:
-                            continue
-                            
-                        # Convert geometry
-                        polygons = []
-                        for ring in geom['rings']:
-                            coords = [(x, y) for x, y in ring]
-                            polygons.append(Polygon(coords))
-                        
-                        multi_poly = MultiPolygon(polygons) if len(polygons) > 1 else polygons[0]
-                        area_ha = multi_poly.area / 10000
-                        
-                        # Convert timestamps
-                        start_date = datetime.fromtimestamp(attrs.get('projektstart')/1000) if attrs.get('projektstart') else None
-                        end_date = datetime.fromtimestamp(attrs.get('projektslut')/1000) if attrs.get('projektslut') else None
-                        
-                        processed_feature = {
-                            'layer_name': layer,
-                            'geometry': multi_poly.wkt,
-                            'area_ha': area_ha,
-                            'projektnavn': attrs.get('projektnavn'),
-                            'enhedskontakt': attrs.get('enhedskontakt'),
-                            'startdato': start_date,
-                            'slutdato': end_date,
-                            'status': attrs.get('status'),
-                            'object_id': attrs.get('OBJECTID'),
-                            'global_id': attrs.get('GlobalID')
-                        }
-                        
-                        features.append(processed_feature)
-                        
-                    except Exception as e:
-                        logger.error(f"Error processing feature: {str(e)}")
-                        continue
-                        
-                return features
-                
         except Exception as e:
-            logger.error(f"Error in _fetch_arcgis_features: {str(e)}")
-            return None
+            logger.error(f"Error processing layer {layer}: {str(e)}", exc_info=True)
+        return layer, features, ranges
 
     async def sync(self):
-        """Sync all water project layers"""
+        """Sync all water project layers.
+
+        Layers are fetched concurrently, their pages concurrently within each
+        layer, and each host's limiter bounds the requests in flight per host.
+        Features are handed to the writer as each layer completes.
+        """
+        if self.shard.index > 0:
+            # Small enough for one task; the first task of a sharded job syncs it unsharded
+            logger.info(f"Water projects are not sharded, nothing to do for {self.shard.label}")
+            return 0
         logger.info("Starting water projects sync...")
         self.is_sync_complete = False
+        self.sink = await PartFileSink.resume(self.storage, 'water_projects')
         total_processed = 0
-        features_batch = []
+        features_batch = FeatureBatch()
+        batch_pages = {}
         
         try:
             async with aiohttp.ClientSession(headers=self.headers) as session:
-                for layer in self.layers:
-                    logger.info(f"\nProcessing layer: {layer}")
-                    try:
-                        service_type = self.service_types.get(layer, 'wfs')
-                        base_url = self.url_mapping.get(layer, self.config['url'])
-
-                        if service_type == 'arcgis':
-                            features = await self._fetch_arcgis_features(session, layer, base_url)
-                            if features:
-                                features_batch.extend(features)
-                                total_processed += len(features)
-                                logger.info(f"Layer {layer}: processed {len(features):,} features")
-                            continue
+                tasks = [asyncio.create_task(self._fetch_layer(session, layer)) for layer in self.layers]
+                try:
+                    for next_layer in asyncio.as_completed(tasks):
+                        layer, features, ranges = await next_layer
+                        if ranges:
+                            batch_pages[layer] = ranges
+                        features_batch.extend(features)
+                        total_processed += len(features)
+                        logger.info(f"Layer {layer}: processed {len(features):,} features")
+                        
+                        # Write batch if it's large enough
+                        if len(features_batch) >= self.storage_batch_size:
+                            logger.info(f"Writing batch of {len(features_batch):,} features")
+                            await self.write_to_storage(features_batch, 'water_projects', batch_pages)
+                            features_batch = FeatureBatch()
+                            batch_pages = {}
+                finally:
+                    for task in tasks:
+                        task.cancel()
 
-                        # Existing WFS handling code
-                        params = self._get_params(layer, 0)
-                        async with session.get(base_url, params=params) as response:
-                            if response.status != 200:
-                                logger.error(f"Failed to fetch {layer}. Status: {response.status}")
-                                error_text = await response.text()
-                                logger.error(f"Error response: {error_text[:500]}")
-                                continue
-                            
-                            text = await response.text()
-                            root = ET.fromstring(text)
-                            total_features = int(root.get('numberMatched', '0'))
-                            logger.info(f"Layer {layer}: found {total_features:,} total features")
-                            
-                            # Process first batch
-                            features = []
-                            namespaces = {}
-                            for elem in root.iter():
-                                if '}' in elem.tag:
-                                    ns_url = elem.tag.split('}')[0].strip('{')
-                                    namespaces['ns'] = ns_url
-                                    break
-                                    
-                            for member in root.findall('.//ns:member', namespaces=namespaces):
-                                for feature in member:
-                                    parsed = self._parse_feature(feature, layer)
-                                    if parsed and parsed.get('geometry'):
-                                        features.append(parsed)
-                            
-                            if features:
-                                features_batch.extend(features)
-                                total_processed += len(features)
-                                logger.info(f"Layer {layer}: processed {len(features):,} features")
-                            
-                            # Process remaining batches
-                            for start_index in range(self.batch_size, total_features, self.batch_size):
-                                logger.info(f"Layer {layer}: fetching features {start_index:,}-{min(start_index + self.batch_size, total_features):,} of {total_features:,}")
-                                chunk = await self._fetch_chunk(session, layer, start_index)
-                                if chunk:
-                                    features_batch.extend(chunk)
-                                    total_processed += len(chunk)
-                                    logger.info(f"Layer {layer}: processed {len(chunk):,} features")
-                            
-                            # Write batch if it's large enough
-                            if len(features_batch) >= self.storage_batch_size:
-                                logger.info(f"Writing batch of {len(features_batch):,} features")
-                                await self.write_to_storage(features_batch, 'water_projects')
-                                features_batch = []
-                            
-                    except Exception as e:
-                        logger.error(f"Error processing layer {layer}: {str(e)}", exc_info=True)
-                        continue
+                if self.stop_requested:
+                    # Checkpoint what was fetched, a restarted job resumes from here
+                    await self.write_to_storage(features_batch, 'water_projects', batch_pages)
+                    raise SyncInterrupted(f"Stopped after {total_processed:,} features, progress checkpointed")
 
                 # Write any remaining features as final batch
-                if features_batch:
-                    logger.info(f"Writing final batch of {len(features_batch):,} features")
-                    self.is_sync_complete = True
-                    await self.write_to_storage(features_batch, 'water_projects')
+                logger.info(f"Writing final batch of {len(features_batch):,} features")
+                self.is_sync_complete = True
+                await self.write_to_storage(features_batch, 'water_projects', batch_pages)
                 
                 logger.info(f"Sync completed. Total processed: {total_processed:,}")
                 return total_processed
                 
+        except SyncInterrupted:
+            raise
         except Exception as e:
             self.is_sync_complete = False
             logger.error(f"Error in sync: {str(e)}", exc_info=True)
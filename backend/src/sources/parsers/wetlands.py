@@ -1,68 +1,111 @@
-from pathlib import Path
-import asyncio
-import xml.etree.ElementTree as ET
 import logging
 import aiohttp
-from shapely.geometry import Polygon, MultiPolygon
-from aiohttp import ClientError
-from ...base import Source
+from ...base import Source, SyncInterrupted
 import pandas as pd
-import geopandas as gpd
-import os
-from ..utils.geometry_validator import validate_and_transform_geometries
+import numpy as np
+import shapely
+from ..utils.geometry_validator import validate_in_chunks
+from ..utils.feature_batch import FeatureBatch
+from ..utils.gml_geometry import PolygonBatch, make_valid_polygons
+from ..utils.gml_stream import GMLFeatureStream
+from ..utils.grid_dissolve import dissolve_grid_cells
+from ..utils.pagination import Paginator, WFSPaging, page_ranges
+from ..utils.memory import MemoryGovernor
+from ..utils.part_sink import PartFileSink
+from ..utils.pipeline import Pipeline
+from ..utils.process_pool import run_in_process, spooled_body
 import time
-import psutil
 from collections import Counter
-from shapely.ops import unary_union
 
 logger = logging.getLogger(__name__)
 
+NAMESPACES = {
+    'wfs': 'http://www.opengis.net/wfs/2.0',
+    'natur': 'http://wfs2-miljoegis.mim.dk/natur',
+    'gml': 'http://www.opengis.net/gml/3.2'
+}
+FEATURE_TAG = f"{{{NAMESPACES['natur']}}}kulstof2022"
+
+def _parse_feature(feature):
+    """Parse the properties of a single feature, the geometry is built per page"""
+    try:
+        return {
+            'id': feature.get('{http://www.opengis.net/gml/3.2}id'),
+            'gridcode': int(feature.find('natur:gridcode', NAMESPACES).text),
+            'toerv_pct': feature.find('natur:toerv_pct', NAMESPACES).text
+        }
+    except Exception as e:
+        logger.error(f"Error parsing feature: {str(e)}")
+        return None
+
+def parse_page(content, start_index):
+    """Parse one WFS page body, as bytes or a spooled file path, into a FeatureBatch, in the process pool"""
+    properties = []
+    element_count = 0
+    geometries = PolygonBatch(dims=2)
+    for feature_elem in GMLFeatureStream(content):
+        if feature_elem.tag != FEATURE_TAG:
+            continue
+        element_count += 1
+        feature = _parse_feature(feature_elem)
+        if feature:
+            geometries.add(feature_elem)
+            properties.append(feature)
+    
+    built = make_valid_polygons(geometries.build())
+    valid = ~shapely.is_missing(built)
+    df = pd.DataFrame.from_records(properties, index=range(len(properties)))
+    return FeatureBatch(df[valid], built[valid], source_count=element_count)
+
 class Wetlands(Source):
-    def __init__(self, config):
-        super().__init__(config)
+    def __init__(self, config, storage=None):
+        super().__init__(config, storage)
         self.batch_size = 100000
-        self.max_concurrent = 5
+        # Pages hold batch_size features each, so keep few in flight
+        self.max_concurrent = 2
         self.request_timeout = 300
+        self.total_processed = 0
         
-        self.namespaces = {
-            'wfs': 'http://www.opengis.net/wfs/2.0',
-            'natur': 'http://wfs2-miljoegis.mim.dk/natur',
-            'gml': 'http://www.opengis.net/gml/3.2'
-        }
+        self.namespaces = NAMESPACES
+        self.feature_tag = FEATURE_TAG
         
-        self.request_semaphore = asyncio.Semaphore(self.max_concurrent)
-
-    def analyze_geometry(self, geom):
-        """Analyze a single geometry for grid characteristics"""
-        bounds = geom.bounds
-        width = bounds[2] - bounds[0]
-        height = bounds[3] - bounds[1]
-        area = width * height
-        
-        # Check grid alignment
-        vertices = list(geom.exterior.coords)
-        is_grid_aligned = all(
-            abs(round(coord / 10) * 10 - coord) < 0.01
-            for vertex in vertices
-            for coord in vertex
+        self.paginator = Paginator(
+            WFSPaging(),
+            self.config['url'],
+            self._parse_page,
+            page_size=self.batch_size,
+            base_params=self._get_base_params(),
+            max_concurrent=self.max_concurrent,
+            timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+            name='wetlands'
         )
-        
-        return {
+
+    def analyze_geometries(self, geometries):
+        """Grid characteristics of each geometry, as a DataFrame.
+
+        Works on every ring of every part, so the MultiPolygons that
+        repairing a bowtie produces are counted like polygons.
+        """
+        geometries = np.asarray(geometries)
+        bounds = shapely.bounds(geometries)
+        width = bounds[:, 2] - bounds[:, 0]
+        height = bounds[:, 3] - bounds[:, 1]
+
+        # Check grid alignment of every vertex, per geometry
+        coords, index = shapely.get_coordinates(geometries, return_index=True)
+        off_grid = (np.abs(np.round(coords / 10) * 10 - coords) >= 0.01).any(axis=1)
+
+        return pd.DataFrame({
             'width': width,
             'height': height,
-            'area': area,
-            'grid_aligned': is_grid_aligned,
-            'vertices': len(vertices)
-        }
+            'area': width * height,
+            'grid_aligned': np.bincount(index[off_grid], minlength=len(geometries)) == 0,
+            'vertices': shapely.get_num_coordinates(geometries)
+        })
 
     def log_geometry_statistics(self, gdf):
         """Analyze and log statistics about the geometries"""
-        stats = []
-        for geom in gdf.geometry:
-            stats.append(self.analyze_geometry(geom))
-        
-        # Convert to DataFrame for easy analysis
-        stats_df = pd.DataFrame(stats)
+        stats_df = self.analyze_geometries(gdf.geometry.values)
         
         # Unique dimensions
         dimensions = Counter(zip(stats_df['width'], stats_df['height']))
@@ -77,195 +120,92 @@ class Wetlands(Source):
         logger.info(f"Average vertices per feature: {stats_df['vertices'].mean():.1f}")
         logger.info(f"Total area covered: {stats_df['area'].sum() / 1_000_000:.2f} km²")
 
-    def _get_params(self, start_index=0):
-        """Get WFS request parameters"""
+    def _get_base_params(self):
+        """Get WFS request parameters without pagination"""
         return {
             'SERVICE': 'WFS',
             'REQUEST': 'GetFeature',
             'VERSION': '2.0.0',
             'TYPENAMES': self.config['layer'],
-            'SRSNAME': 'EPSG:25832',
-            'count': str(self.batch_size),
-            'startIndex': str(start_index)
+            'SRSNAME': 'EPSG:25832'
         }
 
-    def _parse_geometry(self, geom_elem):
-        """Parse GML geometry into Shapely geometry"""
-        try:
-            coords = geom_elem.find('.//gml:posList', self.namespaces).text.split()
-            coords = [(float(coords[i]), float(coords[i + 1])) 
-                     for i in range(0, len(coords), 2)]
-            poly = Polygon(coords)
-            
-            # Ensure the polygon is valid
-            if not poly.is_valid:
-                poly = poly.buffer(0)
-            return poly
-        except Exception as e:
-            logger.error(f"Error parsing geometry: {str(e)}")
-            return None
-
-    def _parse_feature(self, feature):
-        """Parse a single feature into GeoJSON-like dictionary"""
-        try:
-            geom = self._parse_geometry(
-                feature.find('.//gml:Polygon', self.namespaces)
-            )
-            
-            if not geom:
-                return None
-
-            return {
-                'type': 'Feature',
-                'geometry': geom.__geo_interface__,
-                'properties': {
-                    'id': feature.get('{http://www.opengis.net/gml/3.2}id'),
-                    'gridcode': int(feature.find('natur:gridcode', self.namespaces).text),
-                    'toerv_pct': feature.find('natur:toerv_pct', self.namespaces).text
-                }
-            }
-        except Exception as e:
-            logger.error(f"Error parsing feature: {str(e)}")
-            return None
-
     async def sync(self):
         """Sync wetlands data to Cloud Storage"""
         logger.info("Starting wetlands sync...")
         self.is_sync_complete = False
-        
-        # Clean up any existing working files
-        working_blob = self.bucket.blob('raw/wetlands/working.parquet')
-        if working_blob.exists():
-            working_blob.delete()
+        self.sink = await PartFileSink.resume(self.storage, 'wetlands', shard=self.shard)
         
         async with aiohttp.ClientSession() as session:
-            # Get total count
-            params = self._get_params(0)
-            async with session.get(self.config['url'], params=params) as response:
-                text = await response.text()
-                root = ET.fromstring(text)
-                total_features = int(root.get('numberMatched', '0'))
-                logger.info(f"Total available features: {total_features:,}")
-                
-                features = [
-                    self._parse_feature(f) 
-                    for f in root.findall('.//natur:kulstof2022', self.namespaces)
-                ]
-                features = [f for f in features if f]
-                
-                if features:
-                    await self.write_to_storage(features, 'wetlands')
-                logger.info(f"Wrote first batch: {len(features)} features")
-                
-                total_processed = len(features)
-                for start_index in range(self.batch_size, total_features, self.batch_size):
-                    try:
-                        chunk = await self._fetch_chunk(session, start_index)
-                        if chunk:
-                            self.is_sync_complete = (start_index + self.batch_size) >= total_features
-                            await self.write_to_storage(chunk, 'wetlands')
-                            total_processed += len(chunk)
-                            logger.info(f"Progress: {total_processed:,}/{total_features:,}")
-                    except Exception as e:
-                        logger.error(f"Error processing batch at {start_index}: {str(e)}")
-                        continue
+            total_features = await self.paginator.get_total_count(session)
+            logger.info(f"Total available features: {total_features if total_features is not None else 'unknown'}")
+            
+            # Pages are written as they arrive while the next ones are fetched
+            # Pages are checkpointed by their fixed size, so only the pages in flight follow the memory in use
+            governor = MemoryGovernor('wetlands')
+            governor.add('max_concurrent', self.max_concurrent,
+                         on_change=lambda value: setattr(self.paginator, 'max_concurrent', value))
+            self.total_processed = 0
+            pipeline = Pipeline('wetlands', governor=governor)
+            pipeline.add('fetch', self.paginator.pages(session, total_features,
+                                                       skip=self.shard.skipper(self.sink.skipper('wetlands')),
+                                                       shutdown=self.shutdown))
+            pipeline.add('write', lambda pages: self._write_pages(pages, total_features))
+            await pipeline.run()
+            
+            self.paginator.log_stats()
+            if self.paginator.failed_offsets:
+                logger.error(f"Failed to fetch batches starting at indices: {self.paginator.failed_offsets}")
+            
+            if self.stop_requested:
+                raise SyncInterrupted(f"Stopped after {self.total_processed:,} features, progress checkpointed")
+            
+            self.is_sync_complete = True
+            await self.write_to_storage([], 'wetlands')
         
-        logger.info(f"Sync completed. Total processed: {total_processed:,}")
-        return total_processed
+        logger.info(f"Sync completed. Total processed: {self.total_processed:,}")
+        return self.total_processed
+
+    async def _write_pages(self, pages, total_features):
+        """Pipeline stage appending each fetched page to the sink"""
+        async for page in pages:
+            if page.items is not None:
+                await self.write_to_storage(page.items, 'wetlands', [page.offset])
+                self.total_processed += len(page.items)
+                logger.info(f"Progress: {self.sink.total_rows:,}/{total_features if total_features is not None else '?'}")
 
-    async def write_to_storage(self, features, dataset):
-        """Write features to GeoParquet in Cloud Storage"""
-        if not features:
+    async def write_to_storage(self, features, dataset, pages=None):
+        """Write features to GeoParquet in Cloud Storage, checkpointing the pages they came from"""
+        pages = {dataset: page_ranges(pages, self.batch_size)} if pages else None
+        if not features and not pages and not self.is_sync_complete:
             return
         
         try:
-            # Create DataFrame
-            df = pd.DataFrame([f['properties'] for f in features])
-            geometries = [Polygon(f['geometry']['coordinates'][0]) for f in features]
-            
-            # Create GeoDataFrame
-            gdf = gpd.GeoDataFrame(df, geometry=geometries, crs="EPSG:25832")
-            
-            # Handle working/final files
-            temp_working = f"/tmp/{dataset}_working.parquet"
-            working_blob = self.bucket.blob(f'raw/{dataset}/working.parquet')
-            
-            if working_blob.exists():
-                working_blob.download_to_filename(temp_working)
-                existing_gdf = gpd.read_parquet(temp_working)
-                logger.info(f"Appending {len(gdf):,} features to existing {len(existing_gdf):,}")
-                combined_gdf = pd.concat([existing_gdf, gdf], ignore_index=True)
-            else:
-                combined_gdf = gdf
-            
-            # Write working file
-            combined_gdf.to_parquet(temp_working)
-            working_blob.upload_from_filename(temp_working)
-            logger.info(f"Updated working file now has {len(combined_gdf):,} features")
+            if features:
+                gdf = features.to_geodataframe(crs="EPSG:25832")
+                
+                # Append batch as an immutable part file
+                await self.sink.write(gdf, pages)
+            elif pages:
+                await self.sink.save(pages)
             
-            # If sync complete, create final files
-            if hasattr(self, 'is_sync_complete') and self.is_sync_complete:
+            # If sync complete, create final files; the dissolve needs every shard, so shards leave it to compact()
+            if self.is_sync_complete and self.sink.shard is not None:
+                await self.sink.finish()
+            elif self.is_sync_complete and self.sink.total_rows:
+                combined_gdf = await self.sink.read_all()
+                
                 logger.info("Sync complete - analyzing input geometries...")
                 self.log_geometry_statistics(combined_gdf)
                 
                 logger.info(f"Starting merge of {len(combined_gdf):,} features...")
                 start_time = time.time()
                 
-                # Create spatial index for efficient neighbor finding
-                logger.info("Creating spatial index...")
-                combined_gdf['idx'] = range(len(combined_gdf))
-                spatial_index = combined_gdf.sindex
-                
-                # Function to check if two polygons share an edge
-                def shares_edge(geom1, geom2):
-                    intersection = geom1.intersection(geom2)
-                    return (intersection.geom_type == 'LineString' and 
-                           intersection.length >= 10)  # At least one grid cell length
-                
-                # Find and merge adjacent polygons
-                logger.info("Finding and merging adjacent polygons...")
-                merged = set()  # Keep track of merged polygons
-                merged_polygons = []
-                
-                for idx, row in combined_gdf.iterrows():
-                    if idx in merged:
-                        continue
-                    
-                    # Find potential neighbors using spatial index
-                    bounds = row.geometry.bounds
-                    possible_matches_idx = list(spatial_index.intersection(bounds))
-                    possible_matches = combined_gdf.iloc[possible_matches_idx]
-                    
-                    # Start with current polygon
-                    current_group = [row.geometry]
-                    merged.add(idx)
-                    
-                    # Check each potential neighbor
-                    for match_idx, match_row in possible_matches.iterrows():
-                        if match_idx != idx and match_idx not in merged:
-                            if shares_edge(row.geometry, match_row.geometry):
-                                current_group.append(match_row.geometry)
-                                merged.add(match_idx)
-                    
-                    # Merge the group if we found any adjacent polygons
-                    if len(current_group) > 1:
-                        merged_poly = unary_union(current_group)
-                    else:
-                        merged_poly = current_group[0]
-                    
-                    merged_polygons.append(merged_poly)
-                    
-                    if len(merged_polygons) % 1000 == 0:
-                        logger.info(f"Processed {len(merged_polygons)} groups")
-                
-                # Create new GeoDataFrame with merged polygons
-                dissolved_gdf = gpd.GeoDataFrame(
-                    geometry=merged_polygons,
-                    crs=combined_gdf.crs
-                )
+                # Cells sit on a 10 m grid: label the connected regions of each gridcode, off the event loop
+                dissolved_gdf = await run_in_process(dissolve_grid_cells, combined_gdf[['gridcode', 'geometry']], 'gridcode')
                 
                 # Add wetland_id
-                dissolved_gdf['wetland_id'] = range(1, len(dissolved_gdf) + 1)
+                dissolved_gdf.insert(0, 'wetland_id', range(1, len(dissolved_gdf) + 1))
                 
                 logger.info(f"Created {len(dissolved_gdf):,} merged polygons")
                 logger.info(f"Reduced from {len(combined_gdf):,} grid cells")
@@ -277,21 +217,13 @@ class Wetlands(Source):
                 
                 # Transform and validate final geometries
                 logger.info("Transforming geometries to BigQuery-compatible CRS...")
-                dissolved_gdf = validate_and_transform_geometries(dissolved_gdf, 'wetlands')
+                dissolved_gdf = await validate_in_chunks(dissolved_gdf, 'wetlands')
                 
                 # Write dissolved version
-                temp_dissolved = f"/tmp/{dataset}_dissolved.parquet"
-                dissolved_gdf.to_parquet(temp_dissolved)
-                dissolved_blob = self.bucket.blob(f'raw/{dataset}/dissolved_current.parquet')
-                dissolved_blob.upload_from_filename(temp_dissolved)
+                await self.sink.write_file(dissolved_gdf, 'dissolved_current.parquet')
                 
-                # Cleanup
-                working_blob.delete()
-                os.remove(temp_dissolved)
-            
-            # Cleanup working file
-            if os.path.exists(temp_working):
-                os.remove(temp_working)
+                # Publish last, so a restart during the dissolve reuses the fetched parts
+                await self.sink.publish()
             
         except Exception as e:
             logger.error(f"Error writing to storage: {str(e)}")
@@ -301,28 +233,22 @@ class Wetlands(Source):
         """Not implemented - using sync() directly"""
         raise NotImplementedError("This source uses sync() directly")
 
-    async def _fetch_chunk(self, session, start_index):
-        """Fetch a chunk of features starting at the given index"""
-        try:
-            async with self.request_semaphore:
-                params = self._get_params(start_index)
-                async with session.get(
-                    self.config['url'], 
-                    params=params, 
-                    timeout=self.request_timeout
-                ) as response:
-                    text = await response.text()
-                    root = ET.fromstring(text)
-                    
-                    features = [
-                        self._parse_feature(f) 
-                        for f in root.findall('.//natur:kulstof2022', self.namespaces)
-                    ]
-                    return [f for f in features if f]
-                    
-        except asyncio.TimeoutError:
-            logger.error(f"Timeout fetching batch at {start_index}")
+    async def compact(self):
+        """Dissolve and publish the shards of a sharded sync"""
+        self.sink = await PartFileSink.combine_shards(self.storage, 'wetlands')
+        if self.sink is None:
+            logger.info("No wetlands shards to compact")
             return None
-        except Exception as e:
-            logger.error(f"Error fetching batch at {start_index}: {str(e)}")
-            return None
\ No newline at end of file
+        
+        total_rows = self.sink.total_rows
+        if not total_rows:
+            return await self.sink.publish()
+        self.is_sync_complete = True
+        await self.write_to_storage([], 'wetlands')
+        return total_rows
+
+    async def _parse_page(self, response, start_index):
+        """Parse one WFS page into a FeatureBatch"""
+        # The worker streams the body from a spooled file, the page is never held whole
+        async with spooled_body(response) as path:
+            return await run_in_process(parse_page, path, start_index)
@@ -2,7 +2,6 @@ import pandas as pd
 import pdfplumber
 from pathlib import Path
 from ....base import Source
-import os
 
 class CropCodes(Source):
     """Danish Agricultural Crop Codes parser"""
@@ -123,15 +122,7 @@ class CropCodes(Source):
         """Sync the crop codes data"""
         df = await self.fetch()
         
-        # Write to temporary local parquet file
-        temp_file = "/tmp/crop_codes_current.parquet"
-        df.to_parquet(temp_file)
-        
-        # Upload to storage
-        blob = self.bucket.blob(f'raw/crops/current.parquet')
-        blob.upload_from_filename(temp_file)
-        
-        # Cleanup
-        os.remove(temp_file)
+        # Write parquet to storage
+        await self.storage.write_bytes('raw/crops/current.parquet', df.to_parquet())
         
         return len(df) 
\ No newline at end of file
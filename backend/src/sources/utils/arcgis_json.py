@@ -0,0 +1,169 @@
+import logging
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from .feature_batch import FeatureBatch
+
+logger = logging.getLogger(__name__)
+
+_INTEGER_TYPES = {'esriFieldTypeOID', 'esriFieldTypeInteger', 'esriFieldTypeSmallInteger', 'esriFieldTypeBigInteger'}
+_FLOAT_TYPES = {'esriFieldTypeDouble', 'esriFieldTypeSingle'}
+_DATE_TYPES = {'esriFieldTypeDate'}
+
+
+def _typed_column(values, field_type):
+    """Convert one attribute column according to its esri field type"""
+    if field_type in _INTEGER_TYPES:
+        return pd.array(pd.to_numeric(pd.Series(values, dtype=object), errors='coerce'), dtype='Int64')
+    if field_type in _FLOAT_TYPES:
+        return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').astype('float64').to_numpy()
+    if field_type in _DATE_TYPES:
+        # Dates are epoch milliseconds
+        return pd.to_datetime(pd.Series(values, dtype=object), unit='ms', utc=True, errors='coerce').array
+    return np.asarray(values, dtype=object)
+
+
+def decode_attributes(features, fields=None) -> pd.DataFrame:
+    """Build typed attribute columns from ArcGIS features.
+
+    ``fields`` is the ``fields`` list of the query response; without it the
+    column names come from the first feature and pandas infers the types.
+    """
+    attributes = [feature.get('attributes') or {} for feature in features]
+    if fields:
+        names = [(field['name'], field.get('type')) for field in fields]
+    else:
+        names = [(name, None) for name in (attributes[0] if attributes else {})]
+    columns = {
+        name: _typed_column([a.get(name) for a in attributes], field_type)
+        for name, field_type in names
+    }
+    df = pd.DataFrame(columns, index=range(len(attributes)))
+    if not fields:
+        df = df.infer_objects()
+    return df
+
+
+def decode_polygons(geometries) -> np.ndarray:
+    """Build shapely polygons from ArcGIS ``rings`` geometries, None where missing"""
+    coords = []
+    ring_counts = []
+    ring_feature = []
+    for index, geometry in enumerate(geometries):
+        if not geometry:
+            continue
+        for ring in geometry.get('rings') or ():
+            coords.extend(ring)
+            ring_counts.append(len(ring))
+            ring_feature.append(index)
+    if not coords:
+        return np.full(len(geometries), None, dtype=object)
+
+    try:
+        xy = np.array(coords, dtype=np.float64)[:, :2]
+    except ValueError:
+        # Mixed 2D/3D vertices
+        xy = np.array([c[:2] for c in coords], dtype=np.float64)
+    return build_polygons(xy, ring_counts, ring_feature, len(geometries))
+
+
+def build_polygons(xy, ring_counts, ring_feature, count) -> np.ndarray:
+    """Build one polygon geometry per feature from flat ring coordinates.
+
+    ``xy`` holds the vertices of every ring back to back, ``ring_counts``
+    the vertex count of each ring and ``ring_feature`` the feature it
+    belongs to; the result has ``count`` entries, None for features
+    without a usable ring.
+
+    ArcGIS stores exterior rings clockwise and holes counterclockwise in one
+    flat ring list. Orientation comes from the signed ring areas; each
+    hole joins the exterior ring containing it (the preceding exterior ring
+    when a feature has just one). A feature whose rings all wind
+    counterclockwise is read as exterior rings, as the ArcGIS clients do.
+    """
+    result = np.full(count, None, dtype=object)
+    xy = np.asarray(xy, dtype=np.float64)
+    ring_counts = np.asarray(ring_counts, dtype=np.int64)
+    ring_feature = np.asarray(ring_feature, dtype=np.int64)
+
+    # Close open rings, then drop rings too short to be valid
+    ends = np.cumsum(ring_counts)
+    starts = ends - ring_counts
+    nonempty = ring_counts > 0
+    open_rings = np.zeros(len(ring_counts), dtype=bool)
+    open_rings[nonempty] = (xy[starts[nonempty]] != xy[ends[nonempty] - 1]).any(axis=1)
+    if open_rings.any():
+        xy = np.insert(xy, ends[open_rings], xy[starts[open_rings]], axis=0)
+        ring_counts = ring_counts + open_rings
+    keep = ring_counts >= 4
+    if not keep.any():
+        return result
+    if not keep.all():
+        xy = xy[np.repeat(keep, ring_counts)]
+        ring_counts = ring_counts[keep]
+        ring_feature = ring_feature[keep]
+    ring_index = np.repeat(np.arange(len(ring_counts)), ring_counts)
+
+    # Shoelace sum per ring; negative means clockwise, which ArcGIS uses for exterior rings
+    x, y = xy[:, 0], xy[:, 1]
+    same_ring = ring_index[:-1] == ring_index[1:]
+    terms = (x[:-1] * y[1:] - x[1:] * y[:-1])[same_ring]
+    signed_area = np.bincount(ring_index[:-1][same_ring], weights=terms, minlength=len(ring_counts))
+    is_shell = signed_area < 0
+    has_shell = np.zeros(count, dtype=bool)
+    has_shell[ring_feature[is_shell]] = True
+    is_shell |= ~has_shell[ring_feature]
+
+    # Each hole belongs to the last exterior ring before it ...
+    ring_polygon = np.maximum.accumulate(np.where(is_shell, np.arange(len(ring_counts)), -1))
+    orphan = ring_polygon < 0
+    orphan[~orphan] = ring_feature[ring_polygon[~orphan]] != ring_feature[~orphan]
+    is_shell |= orphan
+    ring_polygon = np.maximum.accumulate(np.where(is_shell, np.arange(len(ring_counts)), -1))
+
+    rings = shapely.linearrings(xy, indices=ring_index)
+    shell_rings = np.flatnonzero(is_shell)
+    shells_per_feature = np.bincount(ring_feature[shell_rings], minlength=count)
+
+    # ... unless its feature has several, then it belongs to the one containing it
+    holes = np.flatnonzero(~is_shell & (shells_per_feature[ring_feature] > 1))
+    if len(holes):
+        shell_polygons = shapely.polygons(rings[shell_rings])
+        shell_position = {ring: i for i, ring in enumerate(shell_rings)}
+        first_points = xy[np.cumsum(ring_counts) - ring_counts]
+        candidates_by_feature = {}
+        for ring in shell_rings:
+            candidates_by_feature.setdefault(ring_feature[ring], []).append(ring)
+        for hole in holes:
+            point = shapely.points(first_points[hole])
+            for shell in candidates_by_feature[ring_feature[hole]]:
+                if shapely.contains(shell_polygons[shell_position[shell]], point):
+                    ring_polygon[hole] = shell
+                    break
+
+    # Shells first within each polygon, as shapely.polygons expects
+    order = np.lexsort((~is_shell, ring_polygon))
+    polygon_ids, polygon_index = np.unique(ring_polygon[order], return_inverse=True)
+    polygons = shapely.polygons(rings[order], indices=polygon_index)
+
+    polygon_feature = ring_feature[polygon_ids]
+    features, feature_index, polygon_counts = np.unique(polygon_feature, return_inverse=True, return_counts=True)
+    single = polygon_counts == 1
+    if single.any():
+        first = np.searchsorted(polygon_feature, features[single])
+        result[features[single]] = polygons[first]
+    if (~single).any():
+        multi = ~single[feature_index]
+        _, multi_index = np.unique(feature_index[multi], return_inverse=True)
+        result[features[~single]] = shapely.multipolygons(polygons[multi], indices=multi_index)
+    return result
+
+
+def decode_features(data) -> FeatureBatch:
+    """Decode an ArcGIS JSON query response into a FeatureBatch"""
+    features = data.get('features') or []
+    attributes = decode_attributes(features, data.get('fields'))
+    geometry = decode_polygons([feature.get('geometry') for feature in features])
+    return FeatureBatch(attributes, geometry)
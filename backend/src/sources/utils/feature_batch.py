@@ -0,0 +1,62 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+
+class FeatureBatch:
+    """Columnar batch of parsed features, the format parsers hand to writers.
+
+    A batch is a pandas DataFrame of attributes plus a parallel NumPy array
+    of shapely geometries (None where a feature has none). Geometries stay
+    shapely objects from the page parser to the GeoParquet writer, they are
+    never serialized to WKT in between.
+
+    Batches double as page items for ``Paginator`` and as the write buffer
+    of a sync: ``extend`` appends another batch without copying, and the
+    parts are concatenated once, when the buffer is turned into a
+    GeoDataFrame. ``source_count`` is the number of features the server
+    returned, which can exceed ``len(batch)`` when invalid features were
+    dropped; short-page detection uses it.
+    """
+
+    def __init__(self, attributes=None, geometry=None, source_count=None):
+        self._parts = []
+        if attributes is not None:
+            geometry = np.asarray(geometry, dtype=object)
+            if len(attributes) != len(geometry):
+                raise ValueError(f"{len(attributes)} attribute rows but {len(geometry)} geometries")
+            self._parts.append((attributes.reset_index(drop=True), geometry))
+        self.source_count = len(self) if source_count is None else source_count
+
+    @classmethod
+    def from_records(cls, records, geometry, source_count=None):
+        """Build a batch from attribute dicts and a parallel geometry sequence"""
+        return cls(pd.DataFrame.from_records(records, index=range(len(records))), geometry, source_count)
+
+    def __len__(self):
+        return sum(len(geometry) for _, geometry in self._parts)
+
+    def extend(self, other):
+        """Append the features of another batch"""
+        if other is not None:
+            self._parts.extend(other._parts)
+            self.source_count += other.source_count
+
+    def _consolidate(self):
+        if len(self._parts) > 1:
+            attributes = pd.concat([a for a, _ in self._parts], ignore_index=True)
+            geometry = np.concatenate([g for _, g in self._parts])
+            self._parts = [(attributes, geometry)]
+
+    @property
+    def attributes(self) -> pd.DataFrame:
+        self._consolidate()
+        return self._parts[0][0] if self._parts else pd.DataFrame()
+
+    @property
+    def geometry(self) -> np.ndarray:
+        self._consolidate()
+        return self._parts[0][1] if self._parts else np.empty(0, dtype=object)
+
+    def to_geodataframe(self, crs) -> gpd.GeoDataFrame:
+        return gpd.GeoDataFrame(self.attributes, geometry=self.geometry, crs=crs)
@@ -1,55 +1,165 @@
-from shapely.geometry import Polygon, MultiPolygon
-import geopandas as gpd
+from functools import lru_cache
+import asyncio
 import logging
+import math
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from pyproj import CRS, Transformer
+import shapely
+
+from .process_pool import pool_size, run_in_process
 
 logger = logging.getLogger(__name__)
 
-def validate_and_transform_geometries(gdf: gpd.GeoDataFrame, dataset_name: str) -> gpd.GeoDataFrame:
+TARGET_CRS = "EPSG:4326"
+# Rows per chunk below which splitting a batch across processes is not worth it
+MIN_CHUNK_SIZE = 2000
+
+
+@lru_cache(maxsize=None)
+def get_transformer(source_crs, target_crs):
+    """Transformer between two CRS, built once per process; x/y order regardless of the CRS axis order"""
+    return Transformer.from_crs(CRS.from_user_input(source_crs), CRS.from_user_input(target_crs), always_xy=True)
+
+
+def transform_geometries(geometries, source_crs, target_crs):
+    """Reproject a geometry array through its raw coordinate array in one transformer call"""
+    transformer = get_transformer(source_crs, target_crs)
+
+    def transform(coords):
+        x, y = transformer.transform(coords[:, 0], coords[:, 1])
+        return np.column_stack([x, y])
+    return shapely.transform(geometries, transform)
+
+
+def repair_geometries(geometries):
+    """Vectorized make_valid that keeps each geometry's dimension.
+
+    make_valid can turn a self-touching polygon into a collection of
+    polygons and stray lines or points; only the parts with the input's
+    dimension are kept, as a single or multi geometry of that kind.
+    """
+    dimensions = shapely.get_dimensions(geometries)
+    repaired = shapely.make_valid(geometries)
+    collections = np.flatnonzero(shapely.get_type_id(repaired) == shapely.GeometryType.GEOMETRYCOLLECTION)
+    if len(collections) == 0:
+        return repaired
+
+    parts, index = shapely.get_parts(repaired[collections], return_index=True)
+    # A collection can hold multi geometries, e.g. a MultiPolygon next to a stray line, split those too
+    nested = np.flatnonzero(shapely.get_type_id(parts) >= shapely.GeometryType.MULTIPOINT)
+    while len(nested):
+        split, split_index = shapely.get_parts(parts[nested], return_index=True)
+        single = np.ones(len(parts), dtype=bool)
+        single[nested] = False
+        parts = np.concatenate([parts[single], split])
+        index = np.concatenate([index[single], index[nested][split_index]])
+        order = np.argsort(index, kind='stable')
+        parts, index = parts[order], index[order]
+        nested = np.flatnonzero(shapely.get_type_id(parts) >= shapely.GeometryType.MULTIPOINT)
+    keep = shapely.get_dimensions(parts) == dimensions[collections][index]
+    parts, index = parts[keep], index[keep]
+    builders = {0: shapely.multipoints, 1: shapely.multilinestrings, 2: shapely.multipolygons}
+    rebuilt = np.full(len(collections), None, dtype=object)
+    counts = np.bincount(index, minlength=len(collections))
+    for dimension, build in builders.items():
+        of_kind = dimensions[collections][index] == dimension
+        if of_kind.any():
+            groups, positions = np.unique(index[of_kind], return_inverse=True)
+            rebuilt[groups] = build(parts[of_kind], indices=positions)
+    # A single remaining part needs no multi wrapper
+    single = np.flatnonzero(counts == 1)
+    rebuilt[single] = parts[np.searchsorted(index, single)]
+    repaired[collections] = rebuilt
+    return repaired
+
+
+def validate_and_transform_geometries(gdf: gpd.GeoDataFrame, dataset_name: str,
+                                      keep_source_geometry=None) -> gpd.GeoDataFrame:
     """
     Validates and transforms geometries while preserving original areas.
-    
+
+    Invalid geometries are repaired with a vectorized make_valid (see
+    ``repair_geometries``), missing and empty ones are dropped in a
+    single filter, and the rest are reprojected with a cached pyproj
+    transformer over their raw coordinates.
+
     Args:
-        gdf: GeoDataFrame with geometries in EPSG:25832
+        gdf: GeoDataFrame with geometries in a projected CRS, EPSG:25832 for the Danish sources
         dataset_name: Name of dataset for logging
-    
+        keep_source_geometry: Also keep the source geometries as WKB in a
+            ``geometry_<EPSG code>`` column such as ``geometry_25832``;
+            defaults to the KEEP_SOURCE_GEOMETRY env var
+
     Returns:
         GeoDataFrame with valid geometries in EPSG:4326
     """
+    if keep_source_geometry is None:
+        keep_source_geometry = os.getenv('KEEP_SOURCE_GEOMETRY', 'false').lower() == 'true'
     try:
+        if gdf.crs is None:
+            raise ValueError("GeoDataFrame has no CRS to transform from")
+        source_crs = gdf.crs
         initial_count = len(gdf)
-        
+
         # Basic validation
         logger.info(f"{dataset_name}: Starting validation with {initial_count} features")
-        
+
+        geometries = np.asarray(gdf.geometry.values)
+        missing = shapely.is_missing(geometries)
+
         # Fix invalid geometries
-        invalid_mask = ~gdf.geometry.is_valid
-        if invalid_mask.any():
-            logger.warning(f"{dataset_name}: Found {invalid_mask.sum()} invalid geometries. Attempting to fix...")
-            gdf.loc[invalid_mask, 'geometry'] = gdf.loc[invalid_mask, 'geometry'].apply(
-                lambda geom: geom.buffer(0) if geom else None
-            )
-        
-        # Remove nulls and empty geometries
-        gdf = gdf.dropna(subset=['geometry'])
-        gdf = gdf[~gdf.geometry.is_empty]
-        
-        # Calculate areas in original projection (EPSG:25832)
-        gdf['area_m2'] = gdf.geometry.area
-        
+        invalid = np.flatnonzero(~missing & ~shapely.is_valid(geometries))
+        if len(invalid):
+            logger.warning(f"{dataset_name}: Found {len(invalid)} invalid geometries. Attempting to fix...")
+            geometries = geometries.copy()
+            geometries[invalid] = repair_geometries(geometries[invalid])
+
+        # Remove nulls and empty geometries, including repairs that kept nothing
+        keep = ~(shapely.is_missing(geometries) | shapely.is_empty(geometries))
+        geometries = geometries[keep]
+        gdf = pd.DataFrame(gdf.drop(columns=[gdf.geometry.name])[keep])
+
+        # Calculate areas in original projection
+        gdf['area_m2'] = shapely.area(geometries)
+        if keep_source_geometry:
+            epsg = source_crs.to_epsg()
+            if epsg is None:
+                logger.warning(f"{dataset_name}: Source CRS has no EPSG code, not keeping the source geometries")
+            else:
+                gdf[f'geometry_{epsg}'] = shapely.to_wkb(geometries, flavor='iso')
+
         # Transform to WGS84
-        gdf = gdf.to_crs("EPSG:4326")
-        
+        gdf = gpd.GeoDataFrame(gdf, geometry=transform_geometries(geometries, source_crs, TARGET_CRS), crs=TARGET_CRS)
+
         # Final validation check
         final_count = len(gdf)
         removed_count = initial_count - final_count
-        
+
         logger.info(f"{dataset_name}: Validation complete")
         logger.info(f"{dataset_name}: Initial features: {initial_count}")
         logger.info(f"{dataset_name}: Valid features: {final_count}")
         logger.info(f"{dataset_name}: Removed features: {removed_count}")
-        
+
         return gdf
-        
+
     except Exception as e:
         logger.error(f"{dataset_name}: Error in geometry validation: {str(e)}")
-        raise 
\ No newline at end of file
+        raise
+
+
+async def validate_in_chunks(gdf: gpd.GeoDataFrame, dataset_name: str,
+                             keep_source_geometry=None) -> gpd.GeoDataFrame:
+    """Run ``validate_and_transform_geometries`` in the process pool, split into one chunk per process"""
+    chunks = max(1, min(pool_size(), math.ceil(len(gdf) / MIN_CHUNK_SIZE)))
+    if chunks == 1:
+        return await run_in_process(validate_and_transform_geometries, gdf, dataset_name, keep_source_geometry)
+    bounds = np.linspace(0, len(gdf), chunks + 1).astype(int)
+    results = await asyncio.gather(*[
+        run_in_process(validate_and_transform_geometries, gdf.iloc[start:end], dataset_name, keep_source_geometry)
+        for start, end in zip(bounds[:-1], bounds[1:])
+    ])
+    return pd.concat(results)
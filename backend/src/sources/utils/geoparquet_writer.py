@@ -0,0 +1,189 @@
+import json
+import logging
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+logger = logging.getLogger(__name__)
+
+GEOPARQUET_VERSION = '1.0.0'
+# Bbox covering columns came with GeoParquet 1.1
+GEOPARQUET_COVERING_VERSION = '1.1.0'
+DEFAULT_ROW_GROUP_SIZE = 50_000
+# WKB columns named geometry_<EPSG code> are declared as extra geometry columns in that CRS
+EXTRA_GEOMETRY_COLUMN = re.compile(r'^geometry_(\d+)$')
+BBOX_TYPE = pa.struct([(name, pa.float64()) for name in ('xmin', 'ymin', 'xmax', 'ymax')])
+
+_GEOMETRY_TYPES = {
+    0: 'Point',
+    1: 'LineString',
+    3: 'Polygon',
+    4: 'MultiPoint',
+    5: 'MultiLineString',
+    6: 'MultiPolygon',
+    7: 'GeometryCollection'
+}
+
+# Writing 'geo' after the last row group needs key/value metadata support
+_SUPPORTS_FOOTER_METADATA = hasattr(pq.ParquetWriter, 'add_key_value_metadata')
+
+
+def crs_to_projjson(crs):
+    """Return the PROJJSON dict of a CRS given as PROJJSON, EPSG code or pyproj CRS"""
+    if crs is None or isinstance(crs, dict):
+        return crs
+    from pyproj import CRS
+    return CRS.from_user_input(crs).to_json_dict()
+
+
+def gdf_to_table(gdf) -> pa.Table:
+    """Convert a GeoDataFrame to an Arrow table with a WKB geometry column"""
+    geometry_column = gdf.geometry.name
+    wkb = pa.array(shapely.to_wkb(np.asarray(gdf.geometry.values), flavor='iso'), type=pa.binary())
+    df = pd.DataFrame(gdf.drop(columns=[geometry_column]))
+    for column in df.columns:
+        if df[column].dtype.name == 'geometry':
+            # Extra geometry columns, e.g. read back from a part, are stored as WKB too
+            df[column] = shapely.to_wkb(np.asarray(df[column].values), flavor='iso')
+    if len(df.columns) == 0:
+        return pa.table({geometry_column: wkb})
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    return table.append_column(geometry_column, wkb)
+
+
+def bbox_array(geometries) -> pa.StructArray:
+    """Per-row bounding boxes as a GeoParquet 1.1 bbox covering column"""
+    bounds = shapely.bounds(geometries)
+    return pa.StructArray.from_arrays([pa.array(bounds[:, i]) for i in range(4)],
+                                      fields=list(BBOX_TYPE))
+
+
+class StreamingGeoParquetWriter:
+    """Write a GeoParquet file one row group at a time.
+
+    Only the row group being written is held in memory; bytes are streamed
+    straight into ``sink`` (e.g. a resumable upload from ``StorageBackend.open_write``).
+    The GeoParquet ``geo`` metadata (CRS, bbox, geometry types) is
+    accumulated from the written batches and stored in the file footer.
+
+    Binary columns named ``geometry_<EPSG code>`` (such as the
+    ``geometry_25832`` the geometry validator can keep) are declared as
+    further WKB geometry columns in that CRS.
+
+    With ``covering`` a ``bbox`` struct column is added and declared as
+    the GeoParquet 1.1 covering of the geometry. Its row group statistics
+    let readers skip row groups outside a query window, best when rows
+    are written in spatial order.
+    """
+
+    def __init__(self, sink, schema: pa.Schema, crs=None, geometry_column='geometry',
+                 row_group_size=DEFAULT_ROW_GROUP_SIZE, compression='zstd', covering=False):
+        self.sink = sink
+        self.geometry_column = geometry_column
+        self.row_group_size = row_group_size
+        self.covering = covering
+        if covering:
+            schema = schema.append(pa.field('bbox', BBOX_TYPE))
+        self.extra_geometry_columns = {
+            field.name: f'EPSG:{EXTRA_GEOMETRY_COLUMN.match(field.name).group(1)}'
+            for field in schema
+            if EXTRA_GEOMETRY_COLUMN.match(field.name) and pa.types.is_binary(field.type)
+        }
+        self.crs = crs
+        self.bbox = None
+        self.geometry_types = set()
+        self.rows_written = 0
+
+        metadata = dict(schema.metadata or {})
+        metadata.pop(b'geo', None)
+        if not _SUPPORTS_FOOTER_METADATA:
+            # Older pyarrow: 'geo' must be known up front, so bbox is omitted
+            metadata[b'geo'] = json.dumps(self._geo_metadata()).encode('utf-8')
+        self.schema = schema.with_metadata(metadata)
+        self.writer = pq.ParquetWriter(
+            sink,
+            self.schema,
+            compression=compression,
+            store_schema=not _SUPPORTS_FOOTER_METADATA
+        )
+
+    def _geo_metadata(self):
+        column = {
+            'encoding': 'WKB',
+            'geometry_types': sorted(self.geometry_types)
+        }
+        if self.crs is not None:
+            column['crs'] = crs_to_projjson(self.crs)
+        if self.bbox is not None:
+            column['bbox'] = [float(v) for v in self.bbox]
+        if self.covering:
+            column['covering'] = {'bbox': {name: ['bbox', name] for name in ('xmin', 'ymin', 'xmax', 'ymax')}}
+        columns = {self.geometry_column: column}
+        for name, crs in self.extra_geometry_columns.items():
+            columns[name] = {'encoding': 'WKB', 'geometry_types': [], 'crs': crs_to_projjson(crs)}
+        return {
+            'version': GEOPARQUET_COVERING_VERSION if self.covering else GEOPARQUET_VERSION,
+            'primary_column': self.geometry_column,
+            'columns': columns
+        }
+
+    def _update_geo_stats(self, geometries):
+        geometries = geometries[~shapely.is_missing(geometries)]
+        if len(geometries) == 0:
+            return
+        type_ids = np.unique(shapely.get_type_id(geometries))
+        self.geometry_types.update(_GEOMETRY_TYPES[t] for t in type_ids if t in _GEOMETRY_TYPES)
+
+        bounds = shapely.total_bounds(geometries)
+        if np.isnan(bounds).any():
+            return
+        if self.bbox is None:
+            self.bbox = bounds
+        else:
+            self.bbox = np.concatenate([
+                np.minimum(self.bbox[:2], bounds[:2]),
+                np.maximum(self.bbox[2:], bounds[2:])
+            ])
+
+    def write_table(self, table: pa.Table, geometries=None):
+        """Append an Arrow table (WKB geometry column) as one or more row groups.
+
+        ``geometries`` may pass the already decoded shapely array to avoid
+        parsing the WKB again for the bbox and geometry type statistics.
+        """
+        if table.num_rows == 0:
+            return
+        if geometries is None:
+            geometries = shapely.from_wkb(table.column(self.geometry_column).to_numpy(zero_copy_only=False))
+        geometries = np.asarray(geometries)
+        self._update_geo_stats(geometries)
+        if self.covering:
+            table = table.append_column('bbox', bbox_array(geometries))
+        self.writer.write_table(table.select(self.schema.names).cast(self.schema),
+                                row_group_size=self.row_group_size)
+        self.rows_written += table.num_rows
+
+    def write_gdf(self, gdf):
+        """Append a GeoDataFrame batch"""
+        if len(gdf) == 0:
+            return
+        self.write_table(gdf_to_table(gdf), geometries=np.asarray(gdf.geometry.values))
+
+    def close(self):
+        """Write the footer with the final 'geo' metadata"""
+        if _SUPPORTS_FOOTER_METADATA:
+            self.writer.add_key_value_metadata({'geo': json.dumps(self._geo_metadata())})
+        self.writer.close()
+        logger.info(f"Wrote GeoParquet with {self.rows_written:,} rows, "
+                    f"geometry types {sorted(self.geometry_types)}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
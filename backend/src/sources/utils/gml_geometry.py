@@ -0,0 +1,149 @@
+import logging
+
+import numpy as np
+import shapely
+
+logger = logging.getLogger(__name__)
+
+GML_NS = '{http://www.opengis.net/gml/3.2}'
+_POLYGON_TAGS = {f'{GML_NS}Polygon', f'{GML_NS}PolygonPatch'}
+_EXTERIOR_TAG = f'{GML_NS}exterior'
+_INTERIOR_TAG = f'{GML_NS}interior'
+_POS_LIST_TAG = f'{GML_NS}posList'
+_POLYGONAL_TYPES = (3, 6)  # Polygon, MultiPolygon
+_COLLECTION_TYPE = 7
+
+
+class PolygonBatch:
+    """Collect the GML polygons of a page and build them as one shapely array.
+
+    ``add`` only records the posList text of each ring; ``build`` parses all
+    coordinates with NumPy in one pass and creates the geometries with
+    shapely's vectorized ``linearrings``/``polygons``/``multipolygons``
+    constructors from flat coordinate arrays and indices. Each added element
+    becomes a Polygon, a MultiPolygon when it has several polygons, or None.
+
+    ``dims`` is the coordinate stride when a posList has no
+    ``srsDimension`` (2 for most WFS layers, 3 for Datafordeler's 3D
+    geometries); only x and y are kept.
+    """
+
+    def __init__(self, dims=2):
+        self.dims = dims
+        self.size = 0
+        self._texts = []
+        self._ring_dims = []
+        self._ring_polygon = []
+        self._ring_is_shell = []
+        self._polygon_feature = []
+
+    def __len__(self):
+        return self.size
+
+    def _add_ring(self, boundary, polygon_index, is_shell):
+        for pos_list in boundary.iter(_POS_LIST_TAG):
+            if not pos_list.text:
+                return False
+            self._texts.append(pos_list.text)
+            self._ring_dims.append(int(pos_list.get('srsDimension') or self.dims))
+            self._ring_polygon.append(polygon_index)
+            self._ring_is_shell.append(is_shell)
+            return True
+        return False
+
+    def add(self, elem):
+        """Record every polygon under ``elem`` (a surface, or a feature); returns its index"""
+        index = self.size
+        self.size += 1
+        if elem is None:
+            return index
+        for polygon in elem.iter():
+            if polygon.tag not in _POLYGON_TAGS:
+                continue
+            polygon_index = len(self._polygon_feature)
+            boundaries = list(polygon)
+            shells = [b for b in boundaries if b.tag == _EXTERIOR_TAG]
+            if not shells or not self._add_ring(shells[0], polygon_index, True):
+                continue
+            self._polygon_feature.append(index)
+            for boundary in boundaries:
+                if boundary.tag == _INTERIOR_TAG:
+                    self._add_ring(boundary, polygon_index, False)
+        return index
+
+    def build(self) -> np.ndarray:
+        """Build the geometries of all added elements, in the order they were added"""
+        result = np.full(self.size, None, dtype=object)
+        if not self._texts:
+            return result
+
+        # One bulk parse of every coordinate on the page
+        tokens = []
+        value_counts = np.empty(len(self._texts), dtype=np.int64)
+        for i, text in enumerate(self._texts):
+            values = text.split()
+            value_counts[i] = len(values)
+            tokens.extend(values)
+        values = np.array(tokens, dtype=np.float64)
+
+        ring_dims = np.asarray(self._ring_dims, dtype=np.int64)
+        point_counts = value_counts // ring_dims
+        value_starts = np.concatenate([[0], np.cumsum(value_counts)[:-1]])
+        ring_polygon = np.asarray(self._ring_polygon, dtype=np.int64)
+
+        # A ring needs 4 points and a polygon needs a usable shell
+        ring_ok = point_counts >= 4
+        shell_ok = np.zeros(len(self._polygon_feature), dtype=bool)
+        is_shell = np.asarray(self._ring_is_shell)
+        shell_ok[ring_polygon[is_shell]] = ring_ok[is_shell]
+        keep = ring_ok & shell_ok[ring_polygon]
+        if (~ring_ok).any():
+            logger.warning(f"Skipped {(~ring_ok).sum()} rings with fewer than 4 coordinates")
+        if not keep.any():
+            return result
+
+        # x/y positions of every kept point in the flat value array
+        counts = point_counts[keep]
+        point_in_ring = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        x_index = np.repeat(value_starts[keep], counts) + np.repeat(ring_dims[keep], counts) * point_in_ring
+        coords = np.column_stack([values[x_index], values[x_index + 1]])
+
+        rings = shapely.linearrings(coords, indices=np.repeat(np.arange(len(counts)), counts))
+        kept_polygons, polygon_index = np.unique(ring_polygon[keep], return_inverse=True)
+        polygons = shapely.polygons(rings, indices=polygon_index)
+
+        polygon_feature = np.asarray(self._polygon_feature, dtype=np.int64)[kept_polygons]
+        features, feature_index, polygon_counts = np.unique(polygon_feature, return_inverse=True, return_counts=True)
+        single = polygon_counts == 1
+        if single.any():
+            first = np.searchsorted(polygon_feature, features[single])
+            result[features[single]] = polygons[first]
+        if (~single).any():
+            multi = ~single[feature_index]
+            _, multi_index = np.unique(feature_index[multi], return_inverse=True)
+            result[features[~single]] = shapely.multipolygons(polygons[multi], indices=multi_index)
+        return result
+
+
+def make_valid_polygons(geometries) -> np.ndarray:
+    """Repair invalid geometries in bulk, keeping only their polygonal parts (None if there are none)"""
+    geometries = np.array(geometries, dtype=object)
+    invalid = ~shapely.is_missing(geometries) & ~shapely.is_valid(geometries)
+    if not invalid.any():
+        return geometries
+
+    fixed = shapely.make_valid(geometries[invalid])
+    collections = shapely.get_type_id(fixed) == _COLLECTION_TYPE
+    if collections.any():
+        parts, part_index = shapely.get_parts(fixed[collections], return_index=True)
+        polygonal = np.isin(shapely.get_type_id(parts), _POLYGONAL_TYPES)
+        merged = np.full(collections.sum(), None, dtype=object)
+        for i in np.unique(part_index[polygonal]):
+            merged[i] = shapely.union_all(parts[polygonal & (part_index == i)])
+        fixed[collections] = merged
+    fixed[~np.isin(shapely.get_type_id(fixed), _POLYGONAL_TYPES)] = None
+    geometries[invalid] = fixed
+
+    dropped = invalid.sum() - np.isin(shapely.get_type_id(fixed), _POLYGONAL_TYPES).sum()
+    logger.debug(f"Repaired {invalid.sum()} invalid geometries, {dropped} had no polygonal part")
+    return geometries
@@ -0,0 +1,106 @@
+import logging
+import os
+import xml.etree.ElementTree as ET
+
+from .pagination import PageFetchError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+# wfs:member in WFS 2.0, gml:featureMember in WFS 1.x
+MEMBER_TAGS = ('member', 'featureMember')
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+class GMLFeatureStream:
+    """Incrementally decode a WFS GetFeature response from an aiohttp stream.
+
+    The body is read in chunks and fed to an ``XMLPullParser``; each
+    feature element is yielded as soon as its member element closes and is
+    then cleared and detached, so peak memory scales with one feature and
+    one chunk rather than with the page size::
+
+        stream = GMLFeatureStream(response)
+        async for feature in stream:
+            ...
+        stream.attributes.get('numberReturned')
+
+    A body that was already read, or spooled to a file to parse it in
+    another process (see ``process_pool.spooled_body``), is decoded the
+    same way with a plain ``for`` loop over ``GMLFeatureStream(content)``
+    or ``GMLFeatureStream(path)``; a file is read one chunk at a time.
+
+    The attributes of the root element (``numberMatched``,
+    ``numberReturned``, ...) are available once iteration has started. An
+    OWS exception report raises ``PageFetchError``.
+    """
+
+    def __init__(self, response, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.response = response
+        self.chunk_size = chunk_size
+        self.attributes = {}
+        self.features = 0
+
+    def _start(self):
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._root = None
+        self._depth = 0
+        self._exception_report = None
+        # Memoized per tag, a page has only a handful of distinct tags
+        self._is_member = {}
+
+    def _feed(self, chunk):
+        """Feed one chunk and yield the features it completed"""
+        self._parser.feed(chunk)
+        for event, elem in self._parser.read_events():
+            if event == 'start':
+                if self._root is None:
+                    self._root = elem
+                    self.attributes = dict(elem.attrib)
+                    if local_name(elem.tag) == 'ExceptionReport':
+                        self._exception_report = elem
+                self._depth += 1
+                continue
+
+            self._depth -= 1
+            tag = elem.tag
+            member = self._is_member.get(tag)
+            if member is None:
+                member = self._is_member[tag] = local_name(tag) in MEMBER_TAGS
+            if not member or self._exception_report is not None:
+                continue
+            for feature in elem:
+                self.features += 1
+                yield feature
+            # Drop the finished member so the tree never grows
+            elem.clear()
+            if self._depth == 1:
+                self._root.remove(elem)
+
+    def _close(self):
+        self._parser.close()
+        if self._exception_report is not None:
+            message = ' '.join(t.strip() for t in self._exception_report.itertext() if t.strip())
+            raise PageFetchError(f"WFS exception: {message[:500]}")
+
+    async def __aiter__(self):
+        self._start()
+        async for chunk in self.response.content.iter_chunked(self.chunk_size):
+            for feature in self._feed(chunk):
+                yield feature
+        self._close()
+
+    def __iter__(self):
+        self._start()
+        if isinstance(self.response, (str, os.PathLike)):
+            with open(self.response, 'rb') as f:
+                while chunk := f.read(self.chunk_size):
+                    yield from self._feed(chunk)
+        else:
+            content = memoryview(self.response)
+            for start in range(0, len(content), self.chunk_size):
+                yield from self._feed(content[start:start + self.chunk_size])
+        self._close()
@@ -0,0 +1,94 @@
+import logging
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+import shapely
+
+logger = logging.getLogger(__name__)
+
+
+def _grid_rectangles(geometries, cell_size, tolerance):
+    """Integer grid bounds of the geometries, and which of them are grid-aligned rectangles"""
+    bounds = shapely.bounds(geometries)
+    cells = bounds / cell_size
+    grid = np.rint(cells)
+    aligned = (np.abs(cells - grid) * cell_size < tolerance).all(axis=1)
+    # A rectangle fills its bounding box
+    box_area = (bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1])
+    aligned &= np.abs(shapely.area(geometries) - box_area) < tolerance * cell_size
+    aligned &= (grid[:, 2] > grid[:, 0]) & (grid[:, 3] > grid[:, 1])
+    return np.nan_to_num(grid).astype(np.int64), aligned
+
+
+def _adjacent_pairs(grid, groups):
+    """Pairs of rectangles in the same group sharing at least one cell edge, and whether they overlap"""
+    boxes = shapely.box(grid[:, 0], grid[:, 1], grid[:, 2], grid[:, 3])
+    left, right = shapely.STRtree(boxes).query(boxes, predicate='intersects')
+    keep = (left < right) & (groups[left] == groups[right])
+    left, right = left[keep], right[keep]
+    overlap_x = np.minimum(grid[left, 2], grid[right, 2]) - np.maximum(grid[left, 0], grid[right, 0])
+    overlap_y = np.minimum(grid[left, 3], grid[right, 3]) - np.maximum(grid[left, 1], grid[right, 1])
+    # Touching corners only is not adjacent
+    adjacent = (overlap_x > 0) | (overlap_y > 0)
+    return left[adjacent], right[adjacent], (overlap_x > 0)[adjacent] & (overlap_y > 0)[adjacent]
+
+
+def dissolve_grid_cells(gdf, by=None, cell_size=10.0, tolerance=0.01):
+    """Merge grid cells sharing an edge into connected regions, per value of the ``by`` column.
+
+    Cells are rectangles on a ``cell_size`` grid, such as raster cells
+    turned into polygons. Their bounds are snapped to integer grid
+    coordinates, adjacency is worked out on those integers and the
+    regions are labelled as connected components of the adjacency
+    graph, which stays sparse however large the grid's extent is. Each
+    region is then polygonized once with a coverage union. Regions
+    touching only at a corner stay apart. Geometries that are not
+    grid-aligned rectangles are passed through as regions of their own.
+
+    Returns a GeoDataFrame with the ``by`` column, the number of ``cells``
+    (input features) per region and the region geometry, in the input CRS.
+    """
+    geometries = np.asarray(gdf.geometry.values)
+    groups = pd.factorize(gdf[by])[0] if by is not None else np.zeros(len(gdf), dtype=np.int64)
+    grid, aligned = _grid_rectangles(geometries, cell_size, tolerance)
+    if not aligned.all():
+        logger.warning(f"{(~aligned).sum():,} of {len(gdf):,} geometries are not grid-aligned rectangles, "
+                       f"keeping them as they are")
+
+    cells = np.flatnonzero(aligned)
+    left, right, overlapping = _adjacent_pairs(grid[cells], groups[cells])
+    graph = coo_matrix((np.ones(len(left), dtype=np.int8), (left, right)), shape=(len(cells), len(cells)))
+    count, labels = connected_components(graph, directed=False) if len(cells) else (0, cells)
+
+    # Coverage unions need cells that do not overlap, regions with duplicates fall back to a full union
+    needs_union = np.zeros(count, dtype=bool)
+    needs_union[labels[left[overlapping]]] = True
+
+    # Components are labelled 0..count-1, so sorting by label lists the regions in label order
+    order = cells[np.argsort(labels, kind='stable')]
+    sizes = np.bincount(labels, minlength=count)
+    starts = np.cumsum(sizes) - sizes
+    regions = np.empty(count, dtype=object)
+    members = np.split(order, starts[1:]) if count else []
+    for label, member in enumerate(members):
+        if len(member) == 1:
+            regions[label] = geometries[member[0]]
+        elif needs_union[label]:
+            regions[label] = shapely.union_all(geometries[member])
+        else:
+            regions[label] = shapely.coverage_union_all(geometries[member])
+    # Merged cells leave collinear vertices along straight edges
+    regions = shapely.simplify(regions, 0)
+
+    passed = np.flatnonzero(~aligned)
+    result = gpd.GeoDataFrame({
+        'cells': np.r_[sizes, np.ones(len(passed), dtype=np.int64)],
+        'geometry': np.r_[regions, geometries[passed]],
+    }, geometry='geometry', crs=gdf.crs)
+    if by is not None:
+        values = gdf[by].to_numpy()
+        result.insert(0, by, np.r_[values[order[starts]], values[passed]])
+    return result
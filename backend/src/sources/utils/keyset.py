@@ -0,0 +1,32 @@
+import numpy as np
+
+
+class KeySet:
+    """Memory-light set of integer keys, for deduplicating features by key"""
+
+    def __init__(self, keys=None, merge_every=100000):
+        self._sorted = np.unique(np.asarray(keys if keys is not None else [], dtype=np.int64))
+        self._pending = set()
+        self.merge_every = merge_every
+
+    def __len__(self):
+        return len(self._sorted) + len(self._pending)
+
+    def add_new(self, keys) -> np.ndarray:
+        """Add keys and return the mask of those not seen before (first occurrence wins)"""
+        keys = np.asarray(keys, dtype=np.int64)
+        position = np.searchsorted(self._sorted, keys)
+        seen = position < len(self._sorted)
+        seen[seen] = self._sorted[position[seen]] == keys[seen]
+
+        new = np.zeros(len(keys), dtype=bool)
+        for i in np.flatnonzero(~seen):
+            key = int(keys[i])
+            if key not in self._pending:
+                self._pending.add(key)
+                new[i] = True
+
+        if len(self._pending) >= self.merge_every:
+            self._sorted = np.union1d(self._sorted, np.fromiter(self._pending, dtype=np.int64))
+            self._pending.clear()
+        return new
@@ -0,0 +1,165 @@
+from pathlib import Path
+import asyncio
+import gc
+import logging
+import os
+
+import psutil
+
+from .process_pool import spooled_memory
+
+logger = logging.getLogger(__name__)
+
+CGROUP_LIMIT_FILES = (
+    '/sys/fs/cgroup/memory.max',  # cgroup v2
+    '/sys/fs/cgroup/memory/memory.limit_in_bytes',  # cgroup v1
+)
+
+
+def memory_limit():
+    """Bytes this process tree may use: MEMORY_LIMIT_MB, else the cgroup limit, else the machine's memory"""
+    configured = os.getenv('MEMORY_LIMIT_MB')
+    if configured:
+        return int(configured) * 2**20
+    total = psutil.virtual_memory().total
+    for path in CGROUP_LIMIT_FILES:
+        try:
+            value = Path(path).read_text().strip()
+        except OSError:
+            continue
+        # Unlimited is 'max' on v2 and a page-rounded huge number on v1
+        if value != 'max' and int(value) < total:
+            return int(value)
+    return total
+
+
+def memory_usage():
+    """RSS of this process and its children, the parsing pool included, plus page bodies spooled to tmpfs"""
+    process = psutil.Process()
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss + spooled_memory()
+
+
+class Knob:
+    """A setting the governor may move between ``minimum`` and ``maximum``"""
+
+    def __init__(self, name, value, minimum, maximum, on_change=None):
+        self.name = name
+        self.value = value
+        self.minimum = minimum
+        self.maximum = max(maximum, value)
+        self.on_change = on_change
+
+    def set(self, value):
+        value = int(min(self.maximum, max(self.minimum, value)))
+        if value == self.value:
+            return False
+        self.value = value
+        if self.on_change is not None:
+            self.on_change(value)
+        return True
+
+
+class MemoryGovernor:
+    """Sizes buffered batches and pages in flight to the memory a sync may use.
+
+    Every ``interval`` seconds the RSS of the process tree is compared
+    with the limit (see ``memory_limit``):
+
+    - above ``target`` (MEMORY_TARGET, 0.7 of the limit by default) every
+      knob is halved
+    - above ``critical`` (0.85) every knob drops to its minimum and a
+      garbage collection is forced
+    - below ``target * 0.7`` for three checks in a row every knob grows
+      by a quarter, up to its maximum
+
+    So a sync settles at the largest working set that stays clear of the
+    OOM killer, whatever the container's size. Knobs are registered with
+    ``add``; a sync pipeline runs ``watch`` alongside its stages. Every
+    change is logged.
+    """
+
+    def __init__(self, name, limit=None, target=None, critical=0.85, interval=5.0):
+        self.name = name
+        self.limit = limit or memory_limit()
+        self.target = target or float(os.getenv('MEMORY_TARGET', '0.7'))
+        self.critical = max(critical, self.target)
+        self.interval = interval
+        self.knobs = {}
+        self.calm_checks = 0
+        self.peak = 0
+        self.saturated = False
+
+    def add(self, name, value, minimum=1, maximum=None, on_change=None):
+        self.knobs[name] = Knob(name, value, minimum, maximum or value, on_change)
+        if on_change is not None:
+            # Start from the configured value, not whatever an earlier run left behind
+            on_change(value)
+        return self
+
+    def __getitem__(self, name):
+        return self.knobs[name].value
+
+    def _scale(self, factor=None, minimum=False):
+        changes = []
+        for knob in self.knobs.values():
+            old = knob.value
+            value = knob.minimum if minimum else old * factor
+            if not minimum and factor > 1:
+                # Small knobs such as a concurrency of 1 still grow
+                value = max(value, old + 1)
+            if knob.set(value):
+                changes.append(f"{knob.name} {old:,} -> {knob.value:,}")
+        return changes
+
+    def check(self):
+        """Compare memory use with the limit once and adjust the knobs"""
+        usage = memory_usage()
+        self.peak = max(self.peak, usage)
+        share = usage / self.limit
+        if share >= self.critical:
+            self.calm_checks = 0
+            changes = self._scale(minimum=True)
+            gc.collect()
+            reason = "critical"
+        elif share >= self.target:
+            self.calm_checks = 0
+            changes = self._scale(0.5)
+            reason = "above target"
+        elif share < self.target * 0.7:
+            self.calm_checks += 1
+            if self.calm_checks < 3:
+                return
+            self.calm_checks = 0
+            changes = self._scale(1.25)
+            reason = "headroom"
+        else:
+            self.calm_checks = 0
+            return
+        if changes:
+            self.saturated = False
+            logger.info(f"{self.name}: memory {usage / 2**20:,.0f} of {self.limit / 2**20:,.0f} MiB "
+                        f"({share:.0%}, {reason}), {', '.join(changes)}")
+        elif reason == 'critical' and not self.saturated:
+            # Logged once, until a setting moves again
+            self.saturated = True
+            logger.warning(f"{self.name}: memory {usage / 2**20:,.0f} of {self.limit / 2**20:,.0f} MiB "
+                           f"({share:.0%}) with every setting at its minimum")
+
+    async def watch(self):
+        """Check memory every ``interval`` seconds until cancelled"""
+        logger.info(f"{self.name}: governing {', '.join(self.knobs)} to {self.target:.0%} "
+                    f"of {self.limit / 2**20:,.0f} MiB")
+        while True:
+            self.check()
+            await asyncio.sleep(self.interval)
+
+    def log_stats(self):
+        settings = ', '.join(f"{knob.name} {knob.value:,}" for knob in self.knobs.values())
+        logger.info(f"{self.name}: peak memory {self.peak / 2**20:,.0f} of {self.limit / 2**20:,.0f} MiB, "
+                    f"final {settings}")
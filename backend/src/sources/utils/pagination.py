@@ -0,0 +1,385 @@
+from collections import Counter, deque
+import asyncio
+import logging
+import time
+import xml.etree.ElementTree as ET
+
+import aiohttp
+import numpy as np
+
+from .feature_batch import FeatureBatch
+from .rate_limit import get_host_limiter, is_throttle_status
+
+logger = logging.getLogger(__name__)
+
+
+def page_ranges(offsets, page_size):
+    """[start, end) ranges of the given page offsets, for checkpointing"""
+    return [[offset, offset + page_size] for offset in offsets]
+
+
+class PageFetchError(Exception):
+    """A page request failed; retry_after is set when the server asked for a delay"""
+
+    def __init__(self, message, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        # Keep the retry hints when raised in a parsing process
+        return type(self), (str(self), self.retryable, self.retry_after)
+
+
+class PageResult:
+    """One fetched page: its offset, the parsed items and how long it took"""
+
+    __slots__ = ('offset', 'items', 'elapsed', 'attempts')
+
+    def __init__(self, offset, items, elapsed=0.0, attempts=1):
+        self.offset = offset
+        self.items = items
+        self.elapsed = elapsed
+        self.attempts = attempts
+
+
+class WFSPaging:
+    """WFS 2.0 paging with startIndex/count"""
+
+    name = 'wfs'
+
+    def page_params(self, offset, limit):
+        return {'startIndex': str(offset), 'count': str(limit)}
+
+    def page_range(self, offset, limit):
+        return [offset, offset + limit]
+
+    async def get_total_count(self, session, url, params, request_kwargs):
+        """Read numberMatched from a one-feature request; None when the server reports '*'"""
+        params = dict(params, **self.page_params(0, 1))
+        async with session.get(url, params=params, **request_kwargs) as response:
+            response.raise_for_status()
+            root = ET.fromstring(await response.text())
+        number_matched = root.get('numberMatched', '*')
+        logger.info(f"WFS response metadata - numberMatched: {number_matched}, "
+                    f"numberReturned: {root.get('numberReturned', '0')}")
+        if number_matched == '*':
+            return None
+        if not number_matched.isdigit():
+            raise ValueError(f"Invalid numberMatched value: {number_matched}")
+        return int(number_matched)
+
+
+class ArcGISPaging:
+    """ArcGIS REST query paging with resultOffset/resultRecordCount"""
+
+    name = 'arcgis'
+
+    def page_params(self, offset, limit):
+        return {'resultOffset': str(offset), 'resultRecordCount': str(limit)}
+
+    def page_range(self, offset, limit):
+        return [offset, offset + limit]
+
+    async def get_total_count(self, session, url, params, request_kwargs):
+        params = {'f': 'json', 'where': params.get('where', '1=1'), 'returnCountOnly': 'true'}
+        async with session.get(url, params=params, **request_kwargs) as response:
+            response.raise_for_status()
+            data = await response.json(content_type=None)
+        if 'error' in data:
+            raise ValueError(f"ArcGIS count error: {data['error']}")
+        return int(data.get('count', 0))
+
+
+class ArcGISObjectIdPaging:
+    """ArcGIS REST paging by OBJECTID ranges (keyset pagination).
+
+    ``get_total_count`` fetches every matching id with ``returnIdsOnly``;
+    page ``offset`` then covers the ``limit`` ids starting at that index of
+    the sorted id list and is requested as
+    ``where=(...) AND OBJECTID >= a AND OBJECTID <= b``. Unlike
+    ``resultOffset`` the server cost of a page does not grow with its
+    depth, and pages cannot silently stop at the layer's maxRecordCount.
+
+    ``page_range`` is the page's ``[a, b + 1)`` range in id space, which is
+    what callers checkpoint. Ids inside the ``exclude`` ranges (the
+    checkpoint of an interrupted run) are left out of the page plan, and
+    pages whose id range spans an excluded range leave it out of their
+    where clause, so a resumed run fetches each feature once without
+    needing a ``skip``.
+
+    ``id_range`` restricts the plan to one ``[start, end)`` range of ids.
+    Given a ``Shard`` instead, the range is the shard's contiguous slice
+    of the id list, kept in ``id_range`` so a resumed shard stays on it.
+    """
+
+    name = 'arcgis-objectid'
+
+    def __init__(self, exclude=None, id_range=None, shard=None):
+        self.exclude = sorted(list(r) for r in exclude or [])
+        self.id_range = list(id_range) if id_range else None
+        self.shard = shard
+        self.id_field = None
+        self.ids = None
+        self.where = '1=1'
+
+    async def get_total_count(self, session, url, params, request_kwargs):
+        self.where = params.get('where', '1=1')
+        params = {'f': 'json', 'where': self.where, 'returnIdsOnly': 'true'}
+        async with session.get(url, params=params, **request_kwargs) as response:
+            response.raise_for_status()
+            data = await response.json(content_type=None)
+        if 'error' in data:
+            raise ValueError(f"ArcGIS id query error: {data['error']}")
+
+        self.id_field = data.get('objectIdFieldName') or 'OBJECTID'
+        ids = np.unique(np.asarray(data.get('objectIds') or [], dtype=np.int64))
+        if self.id_range is None and self.shard is not None and self.shard.is_sharded:
+            self.id_range = self.shard.key_range(ids)
+        if self.id_range is not None:
+            start, end = self.id_range
+            ids = ids[(ids >= start) & (ids < end)]
+            logger.info(f"{url}: restricted to object ids in [{start}, {end})")
+        excluded = np.zeros(len(ids), dtype=bool)
+        for start, end in self.exclude:
+            excluded |= (ids >= start) & (ids < end)
+        self.ids = ids[~excluded]
+        logger.info(f"{url}: {len(ids):,} object ids, {excluded.sum():,} already fetched")
+        return len(self.ids)
+
+    def page_range(self, offset, limit):
+        page_ids = self.ids[offset:offset + limit]
+        return [int(page_ids[0]), int(page_ids[-1]) + 1]
+
+    def page_params(self, offset, limit):
+        start, end = self.page_range(offset, limit)
+        clauses = [f"({self.where})", f"{self.id_field} >= {start}", f"{self.id_field} < {end}"]
+        clauses += [
+            f"NOT ({self.id_field} >= {ex_start} AND {self.id_field} < {ex_end})"
+            for ex_start, ex_end in self.exclude
+            if ex_start < end and start < ex_end
+        ]
+        return {'where': ' AND '.join(clauses)}
+
+
+class Paginator:
+    """Concurrent, ordered page fetcher shared by the WFS and ArcGIS sources.
+
+    Keeps up to ``max_concurrent`` pages in flight and yields them in offset
+    order. Failed pages are put back on the front of a work queue and retried
+    with exponential backoff (or the server's Retry-After) up to
+    ``max_retries`` times; pages that never succeed are recorded in
+    ``failed_offsets``. When the total count is unknown, pages are fetched
+    until the first short page.
+
+    Requests go through the shared ``HostLimiter`` of the url's host, which
+    enforces ``requests_per_second`` across every paginator on that host and
+    adapts how many of the ``max_concurrent`` page tasks may hit the server.
+    Backoff delays are slept before a slot is taken, never while holding one.
+
+    ``parse_page(response, offset)`` is a coroutine turning an aiohttp
+    response into a sized collection of parsed items, usually a
+    ``FeatureBatch``.
+    """
+
+    def __init__(self, protocol, url, parse_page, page_size, base_params=None,
+                 max_concurrent=4, max_retries=3, timeout=None,
+                 requests_per_second=None, request_kwargs=None, name=None, limiter=None,
+                 shutdown_grace=8):
+        self.protocol = protocol
+        self.url = url
+        self.parse_page = parse_page
+        self.page_size = page_size
+        self.base_params = base_params or {}
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.request_kwargs = request_kwargs or {}
+        self.name = name or url
+        # Cloud Run sends SIGKILL 10 seconds after SIGTERM
+        self.shutdown_grace = shutdown_grace
+        self.limiter = limiter or get_host_limiter(
+            url,
+            requests_per_second=requests_per_second,
+            max_concurrency=max_concurrent
+        )
+
+        self.failed_offsets = []
+        self.stats = Counter()
+
+    async def get_total_count(self, session):
+        logger.info(f"{self.name}: getting total count...")
+        return await self.protocol.get_total_count(session, self.url, self.base_params, self.request_kwargs)
+
+    def page_range(self, offset):
+        """The [start, end) range a page covers, in the protocol's checkpoint units"""
+        return self.protocol.page_range(offset, self.page_size)
+
+    async def _fetch_page(self, session, offset, delay=0):
+        if delay:
+            await asyncio.sleep(delay)
+
+        params = dict(self.base_params, **self.protocol.page_params(offset, self.page_size))
+        kwargs = dict(self.request_kwargs)
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+
+        try:
+            async with self.limiter.request() as slot:
+                start = time.monotonic()
+                async with session.get(self.url, params=params, **kwargs) as response:
+                    self.limiter.mark_response(slot, response, start)
+                    if is_throttle_status(response.status):
+                        raise PageFetchError(f"HTTP {response.status}", retry_after=slot.retry_after)
+                    if response.status != 200:
+                        text = await response.text()
+                        raise PageFetchError(f"HTTP {response.status}: {text[:500]}", retryable=False)
+                    items = await self.parse_page(response, offset)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise PageFetchError(f"{type(e).__name__}: {str(e)}") from e
+
+        elapsed = time.monotonic() - start
+        self.stats['pages'] += 1
+        self.stats['items'] += len(items)
+        self.stats['fetch_seconds'] += elapsed
+        logger.debug(f"{self.name}: page at {offset} returned {len(items)} items in {elapsed:.2f}s")
+        return items, elapsed
+
+    async def pages(self, session, total=None, start=0, skip=None, shutdown=None):
+        """Yield PageResult objects in offset order.
+
+        ``skip(offset, size)`` returns True for pages already finished by an
+        earlier, checkpointed run; they are neither fetched nor yielded.
+        Once the ``shutdown`` event is set no new pages are started, pages in
+        flight get ``shutdown_grace`` seconds to finish, and every finished
+        page is yielded, even past a gap, so the caller can flush it.
+        """
+        end = total
+        next_offset = start
+        expected = start
+        work = deque()
+        attempts = Counter()
+        in_flight = {}
+        completed = {}
+        consecutive_failures = 0
+        stopping = False
+        deadline = None
+
+        def has_more_offsets():
+            return end is None or next_offset < end
+
+        try:
+            while end is None or expected < end:
+                if not stopping and shutdown is not None and shutdown.is_set():
+                    stopping = True
+                    deadline = time.monotonic() + self.shutdown_grace
+                    logger.warning(f"{self.name}: shutting down, waiting up to {self.shutdown_grace}s "
+                                   f"for {len(in_flight)} pages in flight")
+
+                # Bound in-flight plus buffered out-of-order pages. max_concurrent may shrink while
+                # paging, so one page may always be in flight, or a full buffer would never drain
+                while (not stopping and len(in_flight) < max(self.max_concurrent, 1)
+                       and (len(in_flight) + len(completed) < self.max_concurrent * 2 or not in_flight)):
+                    if work:
+                        offset, delay = work.popleft()
+                    elif has_more_offsets():
+                        offset, delay = next_offset, 0
+                        next_offset += self.page_size
+                        if skip is not None and skip(offset, self.page_size):
+                            continue
+                    else:
+                        break
+                    task = asyncio.create_task(self._fetch_page(session, offset, delay))
+                    in_flight[task] = offset
+
+                if not in_flight:
+                    break
+
+                waiters = set(in_flight)
+                shutdown_waiter = None
+                if shutdown is not None and not stopping:
+                    shutdown_waiter = asyncio.ensure_future(shutdown.wait())
+                    waiters.add(shutdown_waiter)
+                timeout = max(0.0, deadline - time.monotonic()) if stopping else None
+                done, _ = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if shutdown_waiter is not None:
+                    shutdown_waiter.cancel()
+                    done.discard(shutdown_waiter)
+                if stopping and not done:
+                    logger.warning(f"{self.name}: {len(in_flight)} pages still in flight after the grace period, dropping them")
+                    break
+
+                for task in done:
+                    offset = in_flight.pop(task)
+                    if end is not None and offset >= end:
+                        continue
+                    try:
+                        items, elapsed = task.result()
+                    except Exception as e:
+                        attempts[offset] += 1
+                        self.stats['errors'] += 1
+                        if stopping:
+                            # Left unfinished, the next run fetches it again
+                            continue
+                        retryable = getattr(e, 'retryable', True)
+                        if retryable and attempts[offset] < self.max_retries:
+                            delay = getattr(e, 'retry_after', None) or min(2 ** attempts[offset], 60)
+                            logger.warning(f"{self.name}: requeueing page at {offset} in {delay:.0f}s "
+                                           f"(attempt {attempts[offset]}): {str(e)}")
+                            work.appendleft((offset, delay))
+                        else:
+                            logger.error(f"{self.name}: giving up on page at {offset} "
+                                         f"after {attempts[offset]} attempts: {str(e)}")
+                            self.failed_offsets.append(offset)
+                            completed[offset] = PageResult(offset, None, attempts=attempts[offset])
+                            consecutive_failures += 1
+                            if total is None and consecutive_failures >= self.max_concurrent:
+                                # Without a count, a run of dead pages is the only end marker
+                                logger.error(f"{self.name}: {consecutive_failures} pages failed in a row, stopping")
+                                end = offset + self.page_size if end is None else min(end, offset + self.page_size)
+                        continue
+
+                    consecutive_failures = 0
+                    completed[offset] = PageResult(offset, items, elapsed, attempts[offset] + 1)
+                    if total is None and getattr(items, 'source_count', len(items)) < self.page_size:
+                        # A short page marks the end when the count is unknown
+                        end = offset + self.page_size if end is None else min(end, offset + self.page_size)
+
+                while end is None or expected < end:
+                    if expected in completed:
+                        yield completed.pop(expected)
+                    elif expected < next_offset and skip is not None and skip(expected, self.page_size):
+                        pass
+                    else:
+                        break
+                    expected += self.page_size
+
+            if stopping:
+                # Flush pages that finished behind a gap
+                for offset in sorted(completed):
+                    if end is None or offset < end:
+                        yield completed[offset]
+                completed.clear()
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+    async def batches(self, session, batch_size, total=None, skip=None, shutdown=None):
+        """Yield FeatureBatches of at least batch_size items (the last one may be smaller)"""
+        batch = FeatureBatch()
+        async for page in self.pages(session, total, skip=skip, shutdown=shutdown):
+            if page.items:
+                batch.extend(page.items)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = FeatureBatch()
+        if batch:
+            yield batch
+
+    def log_stats(self):
+        pages = self.stats['pages']
+        avg = self.stats['fetch_seconds'] / pages if pages else 0
+        logger.info(f"{self.name}: {pages:,} pages, {self.stats['items']:,} items, "
+                    f"{self.stats['errors']:,} errors, {avg:.2f}s average page time, "
+                    f"{len(self.failed_offsets)} failed pages")
+        self.limiter.log_stats()
@@ -0,0 +1,510 @@
+import json
+import logging
+import os
+import re
+from datetime import datetime, timedelta, timezone
+
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from .geoparquet_writer import (
+    StreamingGeoParquetWriter,
+    crs_to_projjson,
+    gdf_to_table
+)
+from .keyset import KeySet
+from .sharding import Shard
+from .storage import retry_transient
+
+logger = logging.getLogger(__name__)
+
+RUN_ID_FORMAT = '%Y%m%dT%H%M%S'
+RUN_ID_PATTERN = re.compile(r'^\d{8}T\d{6}$')
+
+
+def _unify_schemas(schemas):
+    """Unify part schemas, allowing null and numeric type promotion"""
+    try:
+        return pa.unify_schemas(schemas, promote_options='permissive')
+    except TypeError:
+        # pyarrow < 14 has no promote_options
+        return pa.unify_schemas(schemas)
+
+
+def _merge_ranges(ranges):
+    """Merge [start, end) offset ranges into sorted, non-overlapping ones"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _conform_table(table, schema):
+    """Add missing columns as nulls and cast a part table to the unified schema"""
+    columns = []
+    for field in schema:
+        if field.name in table.column_names:
+            column = table.column(field.name)
+            if not column.type.equals(field.type):
+                column = column.cast(field.type)
+        else:
+            column = pa.nulls(len(table), type=field.type)
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+class PartFileSink:
+    """Append-only dataset writer backed by immutable part files.
+
+    Each batch is written once as its own part file under
+    ``raw/{dataset}/parts/{run_id}/`` and recorded in a manifest, so the
+    cost of a write is proportional to the batch, not to the progress of
+    the sync. Parts are streamed straight to storage, never to /tmp.
+    ``publish`` streams the parts row group by row group into a staging
+    object and copies it to ``raw/{dataset}/current.parquet`` in one step.
+
+    The manifest doubles as the sync checkpoint: it records the page
+    ranges each write covered and free-form ``state``, and is rewritten
+    after every part, so ``resume`` can pick up an interrupted run where
+    it stopped.
+
+    Storage calls that are safe to repeat (writing a part or the manifest
+    to its fixed path, staging, copying) are retried on transient errors
+    one at a time. A part whose manifest entry could not be written is
+    taken out of the manifest again, so the retried batch overwrites it
+    instead of adding a duplicate.
+
+    A sync split across workers gives each its own ``shard``: the runs
+    of a shard live under ``raw/{dataset}/parts/shard-{i}-of-{n}/``, a
+    finished shard calls ``finish`` instead of publishing, and
+    ``combine_shards`` gathers the finished shards into one sink that
+    publishes them all.
+    """
+
+    def __init__(self, storage, dataset, run_id=None, manifest=None, shard=None):
+        self.storage = storage
+        self.dataset = dataset
+        self.shard = shard if shard is not None and shard.is_sharded else None
+        self.run_id = run_id or datetime.now(timezone.utc).strftime(RUN_ID_FORMAT)
+        self.prefix = f'{self._runs_prefix(dataset, self.shard)}{self.run_id}'
+        # Shard runs whose parts this sink publishes, see combine_shards
+        self.shard_sinks = []
+        self.manifest = manifest or {
+            'dataset': dataset,
+            'run_id': self.run_id,
+            'created': datetime.now(timezone.utc).isoformat(),
+            'parts': [],
+            'pages': {},
+            'state': {}
+        }
+        self.manifest.setdefault('pages', {})
+        self.manifest.setdefault('state', {})
+
+    @staticmethod
+    def _runs_prefix(dataset, shard=None):
+        return f'raw/{dataset}/parts/{shard.label}/' if shard is not None else f'raw/{dataset}/parts/'
+
+    @staticmethod
+    async def _list_runs(storage, runs_prefix, orphans=False):
+        """Sorted ids of the runs directly under a prefix (not those of shards below it).
+
+        With ``orphans``, the ids of run directories left without a manifest
+        are returned instead, e.g. of a run whose cleanup was interrupted.
+        """
+        run_ids, orphan_ids = set(), set()
+        for path in await storage.list(runs_prefix):
+            run_id, _, rest = path[len(runs_prefix):].partition('/')
+            if rest == '_manifest.json':
+                run_ids.add(run_id)
+            elif rest and RUN_ID_PATTERN.match(run_id):
+                orphan_ids.add(run_id)
+        return sorted(orphan_ids - run_ids) if orphans else sorted(run_ids)
+
+    @classmethod
+    async def resume(cls, storage, dataset, max_age_hours=None, shard=None):
+        """Continue the latest unpublished run of a dataset (or of one shard of it), or start a new one.
+
+        Runs older than ``max_age_hours`` (SYNC_RESUME_MAX_AGE_HOURS,
+        default 24) are discarded, as are all but the latest run.
+        """
+        if max_age_hours is None:
+            max_age_hours = float(os.getenv('SYNC_RESUME_MAX_AGE_HOURS', '24'))
+        shard = shard if shard is not None and shard.is_sharded else None
+        runs_prefix = cls._runs_prefix(dataset, shard)
+        name = f'{dataset} {shard.label}' if shard is not None else dataset
+        run_ids = await cls._list_runs(storage, runs_prefix)
+
+        sink = None
+        if run_ids:
+            latest = run_ids[-1]
+            manifest = json.loads(await storage.read_bytes(f'{runs_prefix}{latest}/_manifest.json'))
+            created = datetime.fromisoformat(manifest['created'])
+            if datetime.now(timezone.utc) - created <= timedelta(hours=max_age_hours):
+                sink = cls(storage, dataset, run_id=latest, manifest=manifest, shard=shard)
+                logger.info(f"{name}: resuming run {latest} with {len(manifest['parts'])} parts "
+                            f"({sink.total_rows:,} rows) already written")
+            else:
+                logger.info(f"{name}: run {latest} is older than {max_age_hours:g}h, starting over")
+
+        stale = [run_id for run_id in run_ids if sink is None or run_id != sink.run_id]
+        for run_id in stale + await cls._list_runs(storage, runs_prefix, orphans=True):
+            await cls(storage, dataset, run_id=run_id, shard=shard).cleanup()
+        return sink or cls(storage, dataset, shard=shard)
+
+    @classmethod
+    async def combine_shards(cls, storage, dataset, count=None):
+        """Gather the finished shard runs of a dataset into one sink, None when there are none.
+
+        ``count`` defaults to the shard count found in storage. Every shard
+        must have finished its run; publishing the returned sink streams
+        the parts of all shards and then removes the shard runs.
+        """
+        root = f'raw/{dataset}/parts/'
+        if count is None:
+            counts = set()
+            for path in await storage.list(root):
+                shard = Shard.from_label(path[len(root):].split('/', 1)[0])
+                if shard is not None:
+                    counts.add(shard.count)
+            if not counts:
+                return None
+            if len(counts) > 1:
+                raise ValueError(f"{dataset}: found shard runs for {sorted(counts)} tasks, set the shard count to compact")
+            count = counts.pop()
+
+        sinks = []
+        unfinished = []
+        for index in range(count):
+            shard = Shard(index, count)
+            runs_prefix = cls._runs_prefix(dataset, shard)
+            run_ids = await cls._list_runs(storage, runs_prefix)
+            if not run_ids:
+                unfinished.append(f'{shard.label} (no run)')
+                continue
+            manifest = json.loads(await storage.read_bytes(f'{runs_prefix}{run_ids[-1]}/_manifest.json'))
+            sink = cls(storage, dataset, run_id=run_ids[-1], manifest=manifest, shard=shard)
+            if not sink.state.get('complete'):
+                unfinished.append(f'{shard.label} (run {sink.run_id} not finished)')
+            sinks.append(sink)
+        if unfinished:
+            raise ValueError(f"{dataset}: cannot compact, unfinished shards: {', '.join(unfinished)}")
+
+        combined = cls(storage, dataset)
+        for sink in sinks:
+            logger.info(f"{dataset}: {sink.shard.label} run {sink.run_id} has "
+                        f"{len(sink.manifest['parts'])} parts ({sink.total_rows:,} rows)")
+            combined.manifest['parts'].extend(
+                dict(part, path=sink._part_path(part)) for part in sink.manifest['parts']
+            )
+        combined.manifest['state'] = {'shards': [sink.state for sink in sinks]}
+        combined.shard_sinks = sinks
+        return combined
+
+    @property
+    def resumed(self):
+        return bool(self.manifest['parts'] or self.manifest['pages'])
+
+    @property
+    def state(self):
+        """Free-form checkpoint state saved with the manifest (e.g. a high-water mark)"""
+        return self.manifest['state']
+
+    @property
+    def total_rows(self):
+        return sum(part['rows'] for part in self.manifest['parts'])
+
+    def completed_ranges(self, stream):
+        return self.manifest['pages'].get(stream, [])
+
+    def skipper(self, stream):
+        """Return skip(offset, size) for Paginator.pages, true for checkpointed pages"""
+        ranges = self.completed_ranges(stream)
+
+        def skip(offset, size):
+            return any(start <= offset and offset + size <= end for start, end in ranges)
+        return skip
+
+    def _record_pages(self, pages):
+        for stream, ranges in (pages or {}).items():
+            self.manifest['pages'][stream] = _merge_ranges(self.completed_ranges(stream) + [list(r) for r in ranges])
+
+    async def finish(self):
+        """Mark the run of a shard complete, leaving its parts for ``combine_shards``"""
+        self.state['complete'] = True
+        await self._write_manifest()
+        logger.info(f"{self.dataset}: {self.shard.label if self.shard else 'run'} finished with "
+                    f"{self.total_rows:,} rows in {len(self.manifest['parts'])} parts")
+
+    async def save(self, pages=None):
+        """Checkpoint completed page ranges and state without writing a part"""
+        self._record_pages(pages)
+        await self._write_manifest()
+
+    @retry_transient
+    async def _retry(self, call, *args, **kwargs):
+        """Await a storage call, retrying transient errors; only for calls that are safe to repeat"""
+        return await call(*args, **kwargs)
+
+    async def _write_manifest(self):
+        await self._retry(
+            self.storage.write_bytes,
+            f'{self.prefix}/_manifest.json',
+            json.dumps(self.manifest),
+            content_type='application/json'
+        )
+
+    def _write_gdf(self, path, gdf, **kwargs):
+        table = gdf_to_table(gdf)
+        with self.storage.open_write(path) as sink:
+            with StreamingGeoParquetWriter(sink, table.schema, crs=gdf.crs,
+                                           geometry_column=gdf.geometry.name, **kwargs) as writer:
+                writer.write_table(table, geometries=gdf.geometry.values)
+
+    async def write(self, gdf: gpd.GeoDataFrame, pages=None) -> str:
+        """Write one batch as a new part file and record it in the manifest.
+
+        ``pages`` maps a stream name (e.g. a layer) to the [start, end) page
+        ranges the batch came from; they are checkpointed with the part.
+        """
+        if gdf is None or len(gdf) == 0:
+            if pages:
+                await self.save(pages)
+            return None
+
+        name = f'part-{len(self.manifest["parts"]):06d}.parquet'
+        self.manifest['parts'].append({
+            'name': name,
+            'rows': len(gdf),
+            'crs': crs_to_projjson(gdf.crs),
+            'geometry_column': gdf.geometry.name
+        })
+        previous_pages = dict(self.manifest['pages'])
+        try:
+            await self._retry(self.storage.run, self._write_gdf, f'{self.prefix}/{name}', gdf)
+            self._record_pages(pages)
+            await self._write_manifest()
+        except Exception:
+            # The part is not checkpointed: a retry of the batch writes it again under the same name
+            self.manifest['parts'].pop()
+            self.manifest['pages'] = previous_pages
+            raise
+        logger.info(f"{self.dataset}: wrote {name} with {len(gdf):,} rows "
+                    f"({self.total_rows:,} rows in {len(self.manifest['parts'])} parts)")
+        return name
+
+    def _part_path(self, part):
+        # Parts gathered from shard runs carry their own path
+        return part.get('path') or f'{self.prefix}/{part["name"]}'
+
+    def _read_part(self, part):
+        with self.storage.open_read(self._part_path(part)) as f:
+            return gpd.read_parquet(f)
+
+    async def read_all(self) -> gpd.GeoDataFrame:
+        """Read all parts of this run into a single GeoDataFrame"""
+        frames = []
+        for part in self.manifest['parts']:
+            frames.append(await self.storage.run(self._read_part, part))
+        if not frames:
+            return None
+        return pd.concat(frames, ignore_index=True)
+
+    def _read_part_schema(self, part):
+        with self.storage.open_read(self._part_path(part)) as f:
+            return pq.read_schema(f)
+
+    def _write_parts(self, writer, schema, key=None):
+        """Stream every part into ``writer``, dropping repeated ``key`` values when given.
+
+        Returns the rows written and the duplicates dropped.
+        """
+        keys = KeySet() if key is not None else None
+        written = duplicates = 0
+        for part in self.manifest['parts']:
+            with self.storage.open_read(self._part_path(part)) as f:
+                part_file = pq.ParquetFile(f)
+                for i in range(part_file.num_row_groups):
+                    table = part_file.read_row_group(i)
+                    if keys is not None:
+                        new = keys.add_new(table.column(key).to_numpy())
+                        duplicates += len(new) - int(new.sum())
+                        table = table.filter(pa.array(new))
+                    writer.write_table(_conform_table(table, schema))
+                    written += table.num_rows
+        return written, duplicates
+
+    def _compact(self, path, schema, key=None):
+        parts = self.manifest['parts']
+        with self.storage.open_write(path) as sink:
+            with StreamingGeoParquetWriter(sink, schema, crs=parts[0].get('crs'),
+                                           geometry_column=parts[0].get('geometry_column', 'geometry')) as writer:
+                return self._write_parts(writer, schema, key)
+
+    def _read_row_count(self, path):
+        with self.storage.open_read(path) as f:
+            return pq.ParquetFile(f).metadata.num_rows
+
+    async def _check_row_count(self, path, expected):
+        """Fail before publishing if a staged file does not hold the rows written to it"""
+        rows = await self._retry(self.storage.run, self._read_row_count, path)
+        if rows != expected:
+            raise ValueError(f"{self.dataset}: staged file has {rows:,} rows, expected {expected:,}")
+
+    async def publish(self, name='current.parquet', key=None):
+        """Stream all parts into raw/{dataset}/{name} and remove the parts.
+
+        With ``key``, only the first row of each key value is kept, e.g. for
+        features that several shards fetched. Returns the rows published.
+        """
+        parts = self.manifest['parts']
+        if not parts:
+            logger.warning(f"{self.dataset}: no parts written, nothing to publish")
+            await self.cleanup()
+            return 0
+
+        logger.info(f"{self.dataset}: compacting {len(parts)} parts "
+                    f"({self.total_rows:,} rows) into {name}")
+        schemas = [await self.storage.run(self._read_part_schema, part) for part in parts]
+        schema = _unify_schemas([s.remove_metadata() for s in schemas])
+
+        # Stream into a staging object, one row group in memory at a time
+        staging_path = f'{self.prefix}/_staging_{name}'
+        written, duplicates = await self._retry(self.storage.run, self._compact, staging_path, schema, key)
+        if written + duplicates != self.total_rows:
+            raise ValueError(f"{self.dataset}: read {written + duplicates:,} rows from parts "
+                             f"recording {self.total_rows:,}")
+        await self._check_row_count(staging_path, written)
+
+        # A single copy of the finished object is the atomic publish step
+        await self._retry(self.storage.copy, staging_path, f'raw/{self.dataset}/{name}')
+        logger.info(f"{self.dataset}: published {name} with {written:,} rows"
+                    + (f" ({duplicates:,} duplicate {key} values dropped)" if duplicates else ""))
+
+        await self._cleanup_published()
+        return written
+
+    def _read_part_keys(self, part, key):
+        with self.storage.open_read(self._part_path(part)) as f:
+            return pq.read_table(f, columns=[key]).column(key)
+
+    async def read_keys(self, key):
+        """Values of the ``key`` column across all parts written so far"""
+        arrays = [await self.storage.run(self._read_part_keys, part, key) for part in self.manifest['parts']]
+        chunks = [chunk for column in arrays for chunk in column.chunks]
+        return pa.chunked_array(chunks).to_numpy() if chunks else None
+
+    def _merge(self, path, previous_path, schema, key, upserted, keep_keys, geo):
+        stats = {'kept': 0, 'replaced': 0, 'deleted': 0}
+        with self.storage.open_write(path) as sink:
+            with StreamingGeoParquetWriter(sink, schema, crs=geo.get('crs'),
+                                           geometry_column=geo['geometry_column']) as writer:
+                with self.storage.open_read(previous_path) as f:
+                    previous_file = pq.ParquetFile(f)
+                    for i in range(previous_file.num_row_groups):
+                        table = previous_file.read_row_group(i)
+                        keys = table.column(key)
+                        replaced = pc.is_in(keys, value_set=upserted)
+                        keep = pc.invert(replaced)
+                        if keep_keys is not None:
+                            keep = pc.and_(keep, pc.is_in(keys, value_set=keep_keys))
+                        kept = table.filter(keep)
+                        stats['kept'] += kept.num_rows
+                        stats['replaced'] += pc.sum(replaced).as_py() or 0
+                        writer.write_table(_conform_table(kept, schema))
+                stats['deleted'] = previous_file.metadata.num_rows - stats['kept'] - stats['replaced']
+                stats['upserted'], stats['duplicates'] = self._write_parts(writer, schema, key)
+        return stats
+
+    async def publish_merged(self, key, keep_keys=None, name='current.parquet'):
+        """Upsert the parts of this run into the published raw/{dataset}/{name}.
+
+        Rows of the previous file whose ``key`` appears in a part are
+        replaced, and when ``keep_keys`` is given, rows whose key is not in
+        it are deleted. Parts are deduplicated on ``key`` as well. The merge
+        is streamed row group by row group and published with the same
+        stage-and-copy step as ``publish``.
+        """
+        previous_path = f'raw/{self.dataset}/{name}'
+        if not await self.storage.exists(previous_path):
+            logger.warning(f"{self.dataset}: no previous {name} to merge into, publishing parts as is")
+            return await self.publish(name, key=key)
+
+        parts = self.manifest['parts']
+        if not parts and keep_keys is None:
+            logger.info(f"{self.dataset}: no changes to merge into {name}")
+            await self.cleanup()
+            return None
+        previous_schema = await self.storage.run(self._read_schema, previous_path)
+        geo = json.loads(previous_schema.metadata[b'geo']) if previous_schema.metadata and b'geo' in previous_schema.metadata else {}
+        geometry_column = geo.get('primary_column', 'geometry')
+        geo = {
+            'geometry_column': geometry_column,
+            'crs': parts[0].get('crs') if parts else geo.get('columns', {}).get(geometry_column, {}).get('crs')
+        }
+
+        schemas = [previous_schema.remove_metadata()]
+        key_arrays = []
+        for part in parts:
+            schemas.append((await self.storage.run(self._read_part_schema, part)).remove_metadata())
+            key_arrays.append(await self.storage.run(self._read_part_keys, part, key))
+        schema = _unify_schemas(schemas)
+        key_type = schema.field(key).type
+        upserted = pa.chunked_array(key_arrays, type=key_type).combine_chunks() if key_arrays else pa.array([], type=key_type)
+        if keep_keys is not None:
+            keep_keys = pa.array(keep_keys, type=key_type)
+
+        logger.info(f"{self.dataset}: merging {len(parts)} parts ({self.total_rows:,} rows) into {name}")
+        staging_path = f'{self.prefix}/_staging_{name}'
+        stats = await self._retry(self.storage.run, self._merge, staging_path, previous_path, schema, key,
+                                  upserted, keep_keys, geo)
+        await self._check_row_count(staging_path, stats['kept'] + stats['upserted'])
+        await self._retry(self.storage.copy, staging_path, previous_path)
+        logger.info(f"{self.dataset}: published {name} - {stats['kept']:,} rows kept, "
+                    f"{stats['replaced']:,} replaced, {stats['deleted']:,} deleted, "
+                    f"{stats['upserted']:,} upserted")
+
+        await self._cleanup_published()
+        return stats['kept'] + stats['upserted']
+
+    def _read_schema(self, path):
+        with self.storage.open_read(path) as f:
+            return pq.read_schema(f)
+
+    async def write_file(self, gdf: gpd.GeoDataFrame, name, **kwargs):
+        """Stream a derived GeoDataFrame (e.g. a dissolved version) to raw/{dataset}/{name}.
+
+        Keyword arguments such as ``covering`` or ``row_group_size`` go to the ``StreamingGeoParquetWriter``.
+        """
+        staging_path = f'{self.prefix}/_staging_{name}'
+        await self._retry(self.storage.run, self._write_gdf, staging_path, gdf, **kwargs)
+        await self._retry(self.storage.copy, staging_path, f'raw/{self.dataset}/{name}')
+        await self._retry(self.storage.delete, staging_path, missing_ok=True)
+        logger.info(f"{self.dataset}: wrote {name} with {len(gdf):,} rows")
+
+    async def cleanup(self):
+        """Delete the part files and manifest of this run, and of the shard runs it gathered.
+
+        The manifest goes first, so an interrupted cleanup never leaves a
+        run that ``resume`` would continue, and objects already gone are
+        skipped, so cleanup can simply be run again.
+        """
+        manifest_path = f'{self.prefix}/_manifest.json'
+        await self._retry(self.storage.delete, manifest_path, missing_ok=True)
+        for path in await self._retry(self.storage.list, f'{self.prefix}/'):
+            if path != manifest_path:
+                await self._retry(self.storage.delete, path, missing_ok=True)
+        for sink in self.shard_sinks:
+            await sink.cleanup()
+
+    async def _cleanup_published(self):
+        # The file is published at this point; leftovers are removed by the next resume
+        try:
+            await self.cleanup()
+        except Exception as e:
+            logger.warning(f"{self.dataset}: published, but could not remove the parts of run {self.run_id}: {str(e)}")
@@ -0,0 +1,171 @@
+import asyncio
+import inspect
+import logging
+import time
+
+from .feature_batch import FeatureBatch
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class StageStats:
+    """Where a stage spent its time: waiting for input (starved), for room downstream (blocked) or working (busy)"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = None
+        self.finished = None
+        self.starved = 0.0
+        self.blocked = 0.0
+        self.items_in = 0
+        self.items_out = 0
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def busy(self):
+        return max(0.0, self.elapsed - self.starved - self.blocked)
+
+    def summary(self):
+        elapsed = self.elapsed or 1.0
+        return (f"{self.name}: {self.busy / elapsed:.0%} busy, {self.starved / elapsed:.0%} starved, "
+                f"{self.blocked / elapsed:.0%} blocked, {self.items_in:,} in, {self.items_out:,} out")
+
+
+class Pipeline:
+    """Async stages connected by bounded queues, so fetching, CPU work and uploads overlap.
+
+    The first stage is an async iterable producing items; every later stage
+    is a function taking the async iterator of its inputs and returning an
+    async iterator of outputs (an async generator), which lets a stage
+    batch, split or drop items and flush state at the end. The last stage
+    may instead be a coroutine function that only consumes. Bounded queues
+    between the stages apply back-pressure, so a slow writer stops the
+    fetcher instead of letting pages pile up in memory::
+
+        pipeline = Pipeline('cadastral')
+        pipeline.add('fetch', fetch_pages(session))
+        pipeline.add('batch', lambda pages: batch_pages(pages, 5000), queue_size=8)
+        pipeline.add('write', write_batches)
+        await pipeline.run()
+
+    ``queue_size`` bounds the queue feeding a stage. Each stage records how
+    long it was busy, starved of input and blocked on a full queue
+    downstream; ``log_stats`` reports them, every ``report_every`` seconds
+    while running and once at the end. The stage with the highest busy
+    share is the bottleneck. If a stage fails, the others are cancelled and
+    the error is raised from ``run``. A ``MemoryGovernor`` passed as
+    ``governor`` watches memory while the stages run.
+    """
+
+    def __init__(self, name, report_every=300, governor=None):
+        self.name = name
+        self.report_every = report_every
+        self.governor = governor
+        self.stages = []
+        self.stats = []
+
+    def add(self, name, stage, queue_size=1):
+        self.stages.append((name, stage, queue_size))
+        return self
+
+    async def _inputs(self, queue, stats):
+        while True:
+            start = time.monotonic()
+            item = await queue.get()
+            stats.starved += time.monotonic() - start
+            if item is _END:
+                return
+            stats.items_in += 1
+            yield item
+
+    async def _run_stage(self, outputs, queue, stats):
+        stats.started = time.monotonic()
+        try:
+            if inspect.isawaitable(outputs):
+                await outputs
+                return
+            async for item in outputs:
+                stats.items_out += 1
+                if queue is not None:
+                    start = time.monotonic()
+                    await queue.put(item)
+                    stats.blocked += time.monotonic() - start
+            if queue is not None:
+                await queue.put(_END)
+        finally:
+            stats.finished = time.monotonic()
+            if hasattr(outputs, 'aclose'):
+                # Lets a cancelled fetcher cancel its requests in flight right away
+                await outputs.aclose()
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.report_every)
+            self.log_stats()
+
+    async def run(self):
+        if not self.stages:
+            return
+        self.stats = []
+        queues = [asyncio.Queue(maxsize=queue_size) for _, _, queue_size in self.stages[1:]] + [None]
+        tasks = []
+        for i, (name, stage, _) in enumerate(self.stages):
+            stats = StageStats(name)
+            outputs = stage if i == 0 else stage(self._inputs(queues[i - 1], stats))
+            self.stats.append(stats)
+            tasks.append(asyncio.create_task(self._run_stage(outputs, queues[i], stats), name=f'{self.name}:{name}'))
+
+        reporter = asyncio.create_task(self._report()) if self.report_every else None
+        watcher = asyncio.create_task(self.governor.watch()) if self.governor is not None else None
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_EXCEPTION)
+                for task in done:
+                    if task.exception() is not None:
+                        raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for helper in (reporter, watcher):
+                if helper is not None:
+                    helper.cancel()
+            self.log_stats()
+            if self.governor is not None:
+                self.governor.log_stats()
+
+    def log_stats(self):
+        for stats in self.stats:
+            logger.info(f"{self.name} pipeline - {stats.summary()}")
+
+
+async def batch_pages(pages, batch_size):
+    """Pipeline stage collecting ``(checkpoint range, FeatureBatch)`` pages into batches.
+
+    Yields ``(FeatureBatch, ranges)`` once a batch holds ``batch_size``
+    features; ``batch_size`` may be a function, read for every page, so a
+    ``MemoryGovernor`` can resize batches during a sync. Pages that failed have no range and pages without features
+    only contribute their range. The last batch is yielded even when
+    empty, so the ranges of trailing empty pages are checkpointed too.
+    """
+    features_batch = FeatureBatch()
+    ranges = []
+    async for key_range, items in pages:
+        if key_range is not None:
+            ranges.append(key_range)
+        if not items:
+            continue
+        features_batch.extend(items)
+        if len(features_batch) >= (batch_size() if callable(batch_size) else batch_size):
+            yield features_batch, ranges
+            features_batch = FeatureBatch()
+            ranges = []
+    yield features_batch, ranges
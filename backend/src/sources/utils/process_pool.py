@@ -0,0 +1,206 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from functools import lru_cache
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import shapely
+
+from .feature_batch import FeatureBatch
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+SPOOL_CHUNK_SIZE = 256 * 1024
+
+
+def _worker_count():
+    configured = os.getenv('PARSE_WORKERS')
+    if configured is not None:
+        return int(configured)
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def pool_size():
+    """Processes in the shared pool, 0 when PARSE_WORKERS=0 keeps the work on the calling thread"""
+    return _worker_count() if get_process_pool() is not None else 0
+
+
+def _init_worker(log_level):
+    # Shutdown is the parent's job, a Ctrl-C must not kill pages mid-parse
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=log_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+def get_process_pool():
+    """The shared pool for CPU-bound parsing and validation, None when PARSE_WORKERS=0"""
+    global _pool
+    if _pool is None:
+        workers = _worker_count()
+        if workers <= 0:
+            return None
+        # Forking a process that runs an event loop and storage threads is unsafe
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                    initargs=(logging.getLogger().getEffectiveLevel(),))
+        logger.info(f"Started a pool of {workers} processes for parsing and validation")
+    return _pool
+
+
+def _table_bytes(df):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def _pack_attributes(df):
+    try:
+        return 'arrow', _table_bytes(df)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        # Mixed-type object columns have no Arrow type, pickle those frames as they are
+        return 'pickle', df
+
+
+def _unpack_attributes(packed, rows):
+    kind, data = packed
+    if kind == 'pickle':
+        return data
+    df = pa.ipc.open_stream(data).read_all().to_pandas()
+    if len(df.columns) == 0:
+        # A table without columns does not keep its row count
+        return pd.DataFrame(index=pd.RangeIndex(rows))
+    return df
+
+
+def pack(value):
+    """Turn FeatureBatches and GeoDataFrames into Arrow attribute buffers plus WKB geometries.
+
+    Shapely geometries and object columns are slow to pickle one by one;
+    the packed form crosses the process boundary as a few large buffers.
+    Anything else is passed through as is.
+    """
+    if isinstance(value, FeatureBatch):
+        return ('batch', _pack_attributes(value.attributes), shapely.to_wkb(value.geometry), value.source_count)
+    if isinstance(value, gpd.GeoDataFrame):
+        name = value.geometry.name
+        crs = value.crs.to_wkt() if value.crs is not None else None
+        return ('frame', _pack_attributes(value.drop(columns=[name])), shapely.to_wkb(value.geometry.values), name, crs)
+    return ('value', value)
+
+
+def unpack(packed):
+    kind = packed[0]
+    if kind == 'batch':
+        _, attributes, wkb, source_count = packed
+        return FeatureBatch(_unpack_attributes(attributes, len(wkb)), shapely.from_wkb(wkb), source_count=source_count)
+    if kind == 'frame':
+        _, attributes, wkb, name, crs = packed
+        df = _unpack_attributes(attributes, len(wkb))
+        df[name] = gpd.GeoSeries(shapely.from_wkb(wkb), index=df.index)
+        return gpd.GeoDataFrame(df, geometry=name, crs=crs)
+    return packed[1]
+
+
+def _call_packed(func, args):
+    return pack(func(*[unpack(arg) for arg in args]))
+
+
+async def run_in_process(func, *args):
+    """Run a module-level function in the process pool and return its result.
+
+    FeatureBatch and GeoDataFrame arguments and results travel packed (see
+    ``pack``). With PARSE_WORKERS=0 the function runs on the calling
+    thread, as before the pool existed.
+    """
+    global _pool
+    pool = get_process_pool()
+    if pool is None:
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    try:
+        packed = await loop.run_in_executor(pool, _call_packed, func, [pack(arg) for arg in args])
+    except BrokenProcessPool:
+        # A worker died (e.g. out of memory); start a fresh pool for the retry
+        if _pool is pool:
+            _pool = None
+            pool.shutdown(wait=False)
+        logger.error("A parsing process died, restarting the pool")
+        raise
+    return unpack(packed)
+
+
+def spool_dir():
+    return os.getenv('SPOOL_DIR') or tempfile.gettempdir()
+
+
+@lru_cache(maxsize=None)
+def _is_memory_backed(path):
+    """Whether ``path`` lies on a tmpfs or ramfs mount, as /tmp does on Cloud Run"""
+    path = os.path.realpath(path)
+    mount, fs_type = '/', None
+    try:
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                point = fields[1]
+                # The longest mount point containing the path is its filesystem
+                if (path == point or path.startswith(point.rstrip('/') + '/')) and len(point) >= len(mount):
+                    mount, fs_type = point, fields[2]
+    except OSError:
+        return False
+    return fs_type in ('tmpfs', 'ramfs')
+
+
+_spooled = 0
+
+
+def spooled_memory():
+    """Bytes of page bodies spooled to a memory-backed directory right now.
+
+    They count against the container's memory but not against any
+    process's RSS, so the ``MemoryGovernor`` adds them to its usage.
+    """
+    return _spooled if _is_memory_backed(spool_dir()) else 0
+
+
+@asynccontextmanager
+async def spooled_body(response, chunk_size=SPOOL_CHUNK_SIZE):
+    """Stream a response body into a temporary file and yield its path, deleting it afterwards.
+
+    Handing the path to ``run_in_process`` instead of the body keeps the
+    whole page out of this process and out of the pickled call; the
+    worker reads the file, a streaming parser one chunk at a time. Files
+    go to SPOOL_DIR, else the system temp directory; file operations run
+    in a thread, off the event loop.
+    """
+    global _spooled
+    spool = await asyncio.to_thread(tempfile.NamedTemporaryFile, prefix='page-', suffix='.body',
+                                    dir=spool_dir(), delete=False)
+    size = 0
+    try:
+        async for chunk in response.content.iter_chunked(chunk_size):
+            await asyncio.to_thread(spool.write, chunk)
+            size += len(chunk)
+            _spooled += len(chunk)
+        await asyncio.to_thread(spool.close)
+        yield spool.name
+    finally:
+        _spooled -= size
+        await asyncio.to_thread(spool.close)
+        await asyncio.to_thread(os.unlink, spool.name)
@@ -0,0 +1,214 @@
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+def is_throttle_status(status) -> bool:
+    """429 and 5xx responses mean the server wants less load"""
+    return status == 429 or status >= 500
+
+
+def parse_retry_after(value):
+    """Parse a Retry-After header given as seconds or an HTTP date, in seconds"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class RequestSlot:
+    """Filled in by the caller so the limiter can learn from the response"""
+
+    __slots__ = ('status', 'retry_after', 'latency')
+
+    def __init__(self):
+        self.status = None
+        self.retry_after = None
+        self.latency = None
+
+
+class HostLimiter:
+    """Shared rate and concurrency limit for all requests to one host.
+
+    Combines a token bucket (``requests_per_second`` with ``burst`` tokens)
+    with an additive-increase/multiplicative-decrease concurrency limit:
+
+    - every healthy response raises the limit by ``1/limit``, so it grows
+      by about one request per round trip, up to ``max_concurrency``
+    - a 429/5xx response, a connection error or a timeout, or a response
+      slower than ``latency_factor`` times the latency baseline, halves
+      the limit (at most once per round trip), down to ``min_concurrency``
+    - a Retry-After header pauses the whole host until it has passed
+
+    Latency is measured until the response headers arrive, so it tracks
+    server load rather than body size or parse time.
+    """
+
+    def __init__(self, host, requests_per_second=None, burst=None, max_concurrency=8,
+                 min_concurrency=1, initial_concurrency=None, latency_factor=3.0,
+                 decrease_factor=0.5):
+        self.host = host
+        self.requests_per_second = requests_per_second
+        self.burst = burst or (max(1.0, float(requests_per_second)) if requests_per_second else None)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(initial_concurrency or max(min_concurrency, max_concurrency // 2))
+        self.latency_factor = latency_factor
+        self.decrease_factor = decrease_factor
+
+        self.in_flight = 0
+        self.latency_baseline = None
+        self.stats = Counter()
+        self._tokens = self.burst
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._wakeup = None
+        self._loop = None
+
+    def _event(self):
+        # Events belong to one event loop; scripts may call asyncio.run more than once
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    def _try_acquire(self, now):
+        """Take a slot and a token; otherwise return how long to wait (None: until a release)"""
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        if self.in_flight >= int(self.limit):
+            return None
+        if self.requests_per_second:
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.requests_per_second)
+            self._last_refill = now
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.requests_per_second
+            self._tokens -= 1
+        self.in_flight += 1
+        return 0
+
+    async def acquire(self):
+        wakeup = self._event()
+        waited = False
+        while True:
+            wait = self._try_acquire(time.monotonic())
+            if wait == 0:
+                if waited:
+                    self.stats['waits'] += 1
+                return
+            waited = True
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _decrease(self, now, reason):
+        # One decrease per round trip, so a burst of failures from the same window counts once
+        if now - self._last_decrease < max(self.latency_baseline or 0, 1.0):
+            return
+        self._last_decrease = now
+        old = self.limit
+        self.limit = max(float(self.min_concurrency), self.limit * self.decrease_factor)
+        self.stats['decreases'] += 1
+        logger.info(f"{self.host}: {reason}, concurrency {old:.1f} -> {self.limit:.1f}")
+
+    def release(self, latency=None, throttled=False, retry_after=None):
+        """Return a slot and adjust the limit from the outcome of the request"""
+        now = time.monotonic()
+        self.in_flight -= 1
+        self.stats['requests'] += 1
+
+        if retry_after:
+            self._blocked_until = max(self._blocked_until, now + retry_after)
+            self.stats['retry_after'] += 1
+            logger.warning(f"{self.host}: server asked to retry after {retry_after:.0f}s, pausing requests")
+
+        if throttled:
+            self.stats['throttled'] += 1
+            self._decrease(now, 'throttled')
+        elif latency is not None:
+            if self.latency_baseline is None:
+                self.latency_baseline = latency
+            elif latency > self.latency_baseline * self.latency_factor:
+                self.stats['slow'] += 1
+                self._decrease(now, f"latency {latency:.1f}s over baseline {self.latency_baseline:.1f}s")
+            else:
+                self.latency_baseline = 0.9 * self.latency_baseline + 0.1 * latency
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    @asynccontextmanager
+    async def request(self):
+        """Hold a slot for one request.
+
+        Set ``slot.status`` (and ``slot.retry_after``) once the response
+        headers are in; connection errors and timeouts count as throttling.
+        """
+        await self.acquire()
+        slot = RequestSlot()
+        start = time.monotonic()
+        try:
+            yield slot
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.release(time.monotonic() - start, throttled=True)
+            raise
+        except BaseException:
+            throttled = slot.status is not None and is_throttle_status(slot.status)
+            self.release(slot.latency, throttled=throttled, retry_after=slot.retry_after)
+            raise
+        else:
+            latency = slot.latency if slot.latency is not None else time.monotonic() - start
+            throttled = slot.status is not None and is_throttle_status(slot.status)
+            self.release(latency, throttled=throttled, retry_after=slot.retry_after)
+
+    def mark_response(self, slot, response, started):
+        """Record status, Retry-After and header latency of an aiohttp response"""
+        slot.status = response.status
+        slot.latency = time.monotonic() - started
+        slot.retry_after = parse_retry_after(response.headers.get('Retry-After'))
+
+    def log_stats(self):
+        logger.info(f"{self.host}: {self.stats['requests']:,} requests, concurrency limit {self.limit:.1f}, "
+                    f"{self.stats['throttled']:,} throttled, {self.stats['slow']:,} slow, "
+                    f"{self.stats['decreases']:,} decreases, latency baseline "
+                    f"{(self.latency_baseline or 0):.2f}s")
+
+
+_limiters = {}
+
+
+def get_host_limiter(url, **kwargs) -> HostLimiter:
+    """Return the limiter shared by every request to the host of ``url``.
+
+    The first caller's settings create the limiter; later callers can only
+    raise ``max_concurrency``, so sources sharing a host share one budget.
+    """
+    host = urlparse(url).netloc or url
+    limiter = _limiters.get(host)
+    if limiter is None:
+        limiter = _limiters[host] = HostLimiter(host, **kwargs)
+    elif kwargs.get('max_concurrency'):
+        limiter.max_concurrency = max(limiter.max_concurrency, kwargs['max_concurrency'])
+    return limiter
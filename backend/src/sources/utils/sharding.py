@@ -0,0 +1,74 @@
+import os
+import re
+
+SHARD_LABEL = re.compile(r'^shard-(\d+)-of-(\d+)$')
+
+
+class Shard:
+    """One of ``count`` workers splitting a sync between them, ``index`` counting from 0.
+
+    Cloud Run jobs started with several tasks set CLOUD_RUN_TASK_INDEX and
+    CLOUD_RUN_TASK_COUNT on each task; the same variables split a sync
+    across local processes. Each shard fetches its own share (offset
+    pages, an OBJECTID range or a set of tiles) into its own
+    ``PartFileSink`` run, and a separate compaction step publishes them.
+    """
+
+    def __init__(self, index=0, count=1):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"Invalid shard {index} of {count}")
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def from_env(cls):
+        return cls(int(os.getenv('CLOUD_RUN_TASK_INDEX', '0')), int(os.getenv('CLOUD_RUN_TASK_COUNT', '1')))
+
+    @classmethod
+    def from_label(cls, label):
+        match = SHARD_LABEL.match(label)
+        return cls(int(match.group(1)), int(match.group(2))) if match else None
+
+    @property
+    def is_sharded(self):
+        return self.count > 1
+
+    @property
+    def label(self):
+        return f'shard-{self.index}-of-{self.count}'
+
+    def __repr__(self):
+        return f'Shard({self.index}, {self.count})'
+
+    def select(self, items):
+        """Every ``count``-th item, starting at ``index``"""
+        return list(items)[self.index::self.count]
+
+    def owns_page(self, offset, size):
+        return (offset // size) % self.count == self.index
+
+    def skipper(self, skip=None):
+        """Wrap a Paginator skip(offset, size) so pages of other shards are skipped too.
+
+        Pages are dealt out round-robin, which keeps the shards even when
+        the cost of a page grows with its offset.
+        """
+        if not self.is_sharded:
+            return skip
+
+        def shard_skip(offset, size):
+            return not self.owns_page(offset, size) or (skip is not None and skip(offset, size))
+        return shard_skip
+
+    def key_range(self, keys):
+        """[start, end) range of this shard's contiguous slice of the sorted ``keys``"""
+        n = len(keys)
+
+        def edge(i):
+            position = i * n // self.count
+            if position < n:
+                return int(keys[position])
+            return int(keys[-1]) + 1 if n else 0
+
+        # The first shard also takes any key below the current minimum
+        return [0 if self.index == 0 else edge(self.index), edge(self.index + 1)]
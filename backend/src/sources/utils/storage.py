@@ -0,0 +1,326 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+import asyncio
+import io
+import logging
+import os
+import shutil
+
+import backoff
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKET = 'landbrugsdata-raw-data'
+# Resumable upload chunk size, must be a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+
+def _transient_errors():
+    """Errors of a storage call that a retry may get past: dropped connections, timeouts, throttling, 5xx"""
+    errors = [ConnectionError, TimeoutError]
+    try:
+        from google.api_core import exceptions as api_exceptions
+        errors += [api_exceptions.TooManyRequests, api_exceptions.InternalServerError,
+                   api_exceptions.BadGateway, api_exceptions.ServiceUnavailable, api_exceptions.GatewayTimeout]
+    except ImportError:
+        pass
+    try:
+        import requests
+        errors += [requests.ConnectionError, requests.Timeout]
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+TRANSIENT_ERRORS = _transient_errors()
+
+# Only for calls that are safe to repeat, such as writing an object to a fixed path
+retry_transient = backoff.on_exception(backoff.expo, TRANSIENT_ERRORS, max_tries=3, max_time=300)
+
+
+class StorageBackend(ABC):
+    """Object storage used by sources for raw data.
+
+    Paths are bucket-relative keys such as ``raw/cadastral/current.parquet``.
+    The ``open_read``/``open_write`` methods return blocking file objects and
+    are meant to be used inside ``run``; every other public method is a
+    coroutine that offloads the blocking call to the backend's thread pool,
+    so large transfers never stall the event loop.
+    """
+
+    def __init__(self, max_workers=8):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='storage')
+
+    async def run(self, func, *args, **kwargs):
+        """Run a blocking function in the storage thread pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    @abstractmethod
+    def open_read(self, path):
+        """Open an object for binary reading (seekable)"""
+        pass
+
+    @abstractmethod
+    def open_write(self, path):
+        """Open an object for streaming binary writes, committed on close"""
+        pass
+
+    @abstractmethod
+    def _exists(self, path) -> bool:
+        pass
+
+    @abstractmethod
+    def _delete(self, path):
+        pass
+
+    @abstractmethod
+    def _list(self, prefix) -> list:
+        pass
+
+    def _read_bytes(self, path) -> bytes:
+        with self.open_read(path) as f:
+            return f.read()
+
+    def _write_bytes(self, path, data, content_type=None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        with self.open_write(path) as f:
+            f.write(data)
+
+    def _copy(self, source_path, dest_path):
+        with self.open_read(source_path) as src, self.open_write(dest_path) as dst:
+            shutil.copyfileobj(src, dst, UPLOAD_CHUNK_SIZE)
+
+    def _upload_file(self, local_path, path):
+        with open(local_path, 'rb') as src, self.open_write(path) as dst:
+            shutil.copyfileobj(src, dst, UPLOAD_CHUNK_SIZE)
+
+    def _download_file(self, path, local_path):
+        with self.open_read(path) as src, open(local_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, UPLOAD_CHUNK_SIZE)
+
+    async def exists(self, path) -> bool:
+        return await self.run(self._exists, path)
+
+    async def delete(self, path, missing_ok=False):
+        """Delete an object; with ``missing_ok`` an object that is already gone is not an error"""
+        try:
+            return await self.run(self._delete, path)
+        except FileNotFoundError:
+            if not missing_ok:
+                raise
+
+    async def list(self, prefix) -> list:
+        """List object paths under a prefix"""
+        return await self.run(self._list, prefix)
+
+    async def read_bytes(self, path) -> bytes:
+        return await self.run(self._read_bytes, path)
+
+    async def write_bytes(self, path, data, content_type=None):
+        return await self.run(self._write_bytes, path, data, content_type)
+
+    async def copy(self, source_path, dest_path):
+        """Copy an object; a completed copy replaces dest_path in one step"""
+        return await self.run(self._copy, source_path, dest_path)
+
+    async def upload_file(self, local_path, path):
+        return await self.run(self._upload_file, local_path, path)
+
+    async def download_file(self, path, local_path):
+        return await self.run(self._download_file, path, local_path)
+
+
+class GCSStorage(StorageBackend):
+    """Google Cloud Storage backend; the client is created on first use"""
+
+    def __init__(self, bucket_name=DEFAULT_BUCKET, client=None, max_workers=8):
+        super().__init__(max_workers=max_workers)
+        self.bucket_name = bucket_name
+        self._client = client
+        self._bucket = None
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            if self._client is None:
+                from google.cloud import storage
+                self._client = storage.Client()
+            self._bucket = self._client.bucket(self.bucket_name)
+        return self._bucket
+
+    def open_read(self, path):
+        return self.bucket.blob(path).open('rb')
+
+    def open_write(self, path):
+        return self.bucket.blob(path).open('wb', chunk_size=UPLOAD_CHUNK_SIZE, ignore_flush=True)
+
+    def _exists(self, path):
+        return self.bucket.blob(path).exists()
+
+    def _delete(self, path):
+        from google.api_core.exceptions import NotFound
+        try:
+            self.bucket.blob(path).delete()
+        except NotFound:
+            raise FileNotFoundError(path)
+
+    def _list(self, prefix):
+        return [blob.name for blob in self.bucket.list_blobs(prefix=prefix)]
+
+    def _read_bytes(self, path):
+        return self.bucket.blob(path).download_as_bytes()
+
+    def _write_bytes(self, path, data, content_type=None):
+        self.bucket.blob(path).upload_from_string(data, content_type=content_type)
+
+    def _copy(self, source_path, dest_path):
+        # Server-side copy, the destination object is replaced atomically
+        self.bucket.copy_blob(self.bucket.blob(source_path), self.bucket, dest_path)
+
+    def _upload_file(self, local_path, path):
+        self.bucket.blob(path).upload_from_filename(local_path)
+
+    def _download_file(self, path, local_path):
+        self.bucket.blob(path).download_to_filename(local_path)
+
+
+class _AtomicLocalFile(io.BufferedWriter):
+    """File written next to its target and renamed into place on a clean close.
+
+    Leaving a ``with`` block on an exception deletes the partial file
+    instead, so the target keeps its previous content.
+    """
+
+    def __init__(self, path, buffer_size=io.DEFAULT_BUFFER_SIZE):
+        self.target = path
+        self.partial = f'{path}.partial'
+        super().__init__(io.FileIO(self.partial, 'wb'), buffer_size)
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+        return False
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            os.replace(self.partial, self.target)
+
+    def discard(self):
+        """Close without committing, deleting the partial file"""
+        if not self.closed:
+            try:
+                super().close()
+            finally:
+                os.remove(self.partial)
+
+
+class LocalStorage(StorageBackend):
+    """Local filesystem backend rooted at a directory"""
+
+    def __init__(self, root, max_workers=8):
+        super().__init__(max_workers=max_workers)
+        self.root = Path(root)
+
+    def _path(self, path):
+        return self.root / path
+
+    def open_read(self, path):
+        return open(self._path(path), 'rb')
+
+    def open_write(self, path):
+        local_path = self._path(path)
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        return _AtomicLocalFile(str(local_path), UPLOAD_CHUNK_SIZE)
+
+    def _exists(self, path):
+        return self._path(path).is_file()
+
+    def _delete(self, path):
+        self._path(path).unlink()
+
+    def _list(self, prefix):
+        base = self._path(prefix)
+        search_root = base if base.is_dir() else base.parent
+        if not search_root.exists():
+            return []
+        paths = (
+            p.relative_to(self.root).as_posix()
+            for p in search_root.rglob('*')
+            if p.is_file() and not p.name.endswith('.partial')
+        )
+        return sorted(p for p in paths if p.startswith(prefix))
+
+
+class _MemoryFile(io.BytesIO):
+    """In-memory object committed to its store on close"""
+
+    def __init__(self, store, path):
+        super().__init__()
+        self.store = store
+        self.path = path
+
+    def close(self):
+        if not self.closed:
+            self.store[self.path] = self.getvalue()
+        super().close()
+
+
+class MemoryStorage(StorageBackend):
+    """In-memory backend for local runs and benchmarks"""
+
+    def __init__(self, max_workers=8):
+        super().__init__(max_workers=max_workers)
+        self.objects = {}
+
+    def open_read(self, path):
+        if path not in self.objects:
+            raise FileNotFoundError(path)
+        return io.BytesIO(self.objects[path])
+
+    def open_write(self, path):
+        return _MemoryFile(self.objects, path)
+
+    def _exists(self, path):
+        return path in self.objects
+
+    def _delete(self, path):
+        if path not in self.objects:
+            raise FileNotFoundError(path)
+        del self.objects[path]
+
+    def _list(self, prefix):
+        return sorted(p for p in self.objects if p.startswith(prefix))
+
+    def _read_bytes(self, path):
+        if path not in self.objects:
+            raise FileNotFoundError(path)
+        return self.objects[path]
+
+    def _write_bytes(self, path, data, content_type=None):
+        self.objects[path] = data.encode('utf-8') if isinstance(data, str) else bytes(data)
+
+    def _copy(self, source_path, dest_path):
+        self.objects[dest_path] = self._read_bytes(source_path)
+
+
+def get_storage_backend(config) -> StorageBackend:
+    """Create the storage backend selected by STORAGE_BACKEND (gcs, local or memory)"""
+    backend = os.getenv('STORAGE_BACKEND', 'gcs').lower()
+    if backend == 'gcs':
+        return GCSStorage(config.get('bucket', DEFAULT_BUCKET))
+    if backend == 'local':
+        root = os.getenv('LOCAL_STORAGE_PATH', 'data')
+        logger.info(f"Using local storage at {root}")
+        return LocalStorage(root)
+    if backend == 'memory':
+        logger.info("Using in-memory storage")
+        return MemoryStorage()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
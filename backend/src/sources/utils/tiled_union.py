@@ -0,0 +1,119 @@
+import asyncio
+import logging
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+import shapely
+
+from .process_pool import run_in_process
+
+logger = logging.getLogger(__name__)
+
+# Shapely type ids of Polygon and MultiPolygon
+_POLYGONAL = (3, 6)
+
+
+def plan_tiles(geometries, max_per_tile=2000, max_depth=8):
+    """Quadtree tiles over the geometries' extent, split until a tile holds at most ``max_per_tile`` of them.
+
+    Geometries are counted by the centre of their bounding box. Every
+    leaf is kept, also those without centres, since larger geometries
+    may still reach into them.
+    """
+    bounds = shapely.bounds(geometries)
+    centers = np.column_stack([(bounds[:, 0] + bounds[:, 2]) / 2, (bounds[:, 1] + bounds[:, 3]) / 2])
+    tiles = []
+    stack = [(tuple(shapely.total_bounds(geometries)), np.arange(len(geometries)), 0)]
+    while stack:
+        tile, members, depth = stack.pop()
+        if len(members) <= max_per_tile or depth >= max_depth:
+            tiles.append(tile)
+            continue
+        minx, miny, maxx, maxy = tile
+        midx, midy = (minx + maxx) / 2, (miny + maxy) / 2
+        east = centers[members, 0] >= midx
+        north = centers[members, 1] >= midy
+        for is_east, is_north, quadrant in (
+            (False, False, (minx, miny, midx, midy)),
+            (True, False, (midx, miny, maxx, midy)),
+            (False, True, (minx, midy, midx, maxy)),
+            (True, True, (midx, midy, maxx, maxy)),
+        ):
+            stack.append((quadrant, members[(east == is_east) & (north == is_north)], depth + 1))
+    return tiles
+
+
+def _polygons(geometries):
+    """The non-empty polygons in a geometry array, multi-part geometries split up"""
+    parts = shapely.get_parts(geometries)
+    return parts[np.isin(shapely.get_type_id(parts), _POLYGONAL) & (shapely.area(parts) > 0)]
+
+
+def union_tile(gdf, tile):
+    """Union of the geometries clipped to one tile, as single polygons"""
+    clipped = shapely.clip_by_rect(np.asarray(gdf.geometry.values), *tile)
+    union = shapely.union_all(_polygons(clipped))
+    return gpd.GeoDataFrame(geometry=_polygons(np.array([union])), crs=gdf.crs)
+
+
+def stitch_tiles(gdf):
+    """Merge tile pieces that meet across tile borders, as single polygons"""
+    pieces = np.asarray(gdf.geometry.values)
+    left, right = shapely.STRtree(pieces).query(pieces, predicate='intersects')
+    keep = left < right
+    graph = coo_matrix((np.ones(keep.sum(), dtype=np.int8), (left[keep], right[keep])),
+                       shape=(len(pieces), len(pieces)))
+    count, labels = connected_components(graph, directed=False)
+    order = np.argsort(labels, kind='stable')
+    sizes = np.bincount(labels, minlength=count)
+    merged = [
+        pieces[member[0]] if len(member) == 1 else shapely.union_all(pieces[member])
+        for member in np.split(order, np.cumsum(sizes)[:-1])
+    ]
+    return gpd.GeoDataFrame(geometry=_polygons(np.array(merged, dtype=object)), crs=gdf.crs)
+
+
+async def _union_group(gdf, max_per_tile):
+    geometries = np.asarray(gdf.geometry.values)
+    tiles = plan_tiles(geometries, max_per_tile)
+    tree = shapely.STRtree(geometries)
+    tasks = []
+    for tile in tiles:
+        members = tree.query(shapely.box(*tile), predicate='intersects')
+        if len(members):
+            tasks.append(run_in_process(union_tile, gdf.iloc[members], tile))
+    pieces = pd.concat(await asyncio.gather(*tasks), ignore_index=True)
+    logger.info(f"Unioned {len(gdf):,} geometries in {len(tasks)} tiles into {len(pieces):,} pieces")
+    return await run_in_process(stitch_tiles, pieces)
+
+
+async def tiled_union(gdf, by=None, max_per_tile=2000):
+    """Dissolve a GeoDataFrame into single polygons, optionally per value of the ``by`` column.
+
+    The extent is split into quadtree tiles, the geometries of each tile
+    are clipped to it and unioned in the process pool, and the pieces
+    are stitched back together across tile borders in one last, cheap
+    pass over pieces that are already dissolved. Rows come out in
+    Hilbert curve order, so neighbouring polygons share row groups.
+    """
+    gdf = gdf[~(gdf.geometry.isna() | gdf.geometry.is_empty)]
+    if by is None:
+        groups = [(None, gdf)] if len(gdf) else []
+    else:
+        groups = list(gdf.groupby(by, sort=True))
+    results = await asyncio.gather(*[_union_group(group[[group.geometry.name]], max_per_tile)
+                                     for _, group in groups])
+    frames = []
+    for (value, _), result in zip(groups, results):
+        if by is not None:
+            result.insert(0, by, value)
+        frames.append(result)
+    if not frames:
+        columns = ([by] if by is not None else []) + ['geometry']
+        return gpd.GeoDataFrame(columns=columns, geometry='geometry', crs=gdf.crs)
+    dissolved = pd.concat(frames, ignore_index=True)
+    dissolved = dissolved.iloc[np.argsort(dissolved.geometry.hilbert_distance(), kind='stable')]
+    return dissolved.reset_index(drop=True)
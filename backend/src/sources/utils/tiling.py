@@ -0,0 +1,269 @@
+from collections import Counter, deque
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+from .pagination import PageFetchError
+from .rate_limit import get_host_limiter, is_throttle_status
+
+logger = logging.getLogger(__name__)
+
+# Denmark including Bornholm and Christiansø in EPSG:25832, squared so tiles stay square
+DENMARK_EXTENT_25832 = (400000.0, 6000000.0, 960000.0, 6560000.0)
+
+
+def _interleave(ix, iy):
+    """Morton code of a tile: x bits at even positions, y bits at odd ones"""
+    code = 0
+    bit = 0
+    while ix or iy:
+        code |= (ix & 1) << (2 * bit) | (iy & 1) << (2 * bit + 1)
+        ix >>= 1
+        iy >>= 1
+        bit += 1
+    return code
+
+
+class TileGrid:
+    """Quadtree of square BBOX tiles over an extent.
+
+    A tile is ``(depth, ix, iy)``; depth 0 is the whole extent and every
+    level splits a tile into its four quadrants. Each tile maps to the
+    ``[start, end)`` range of Morton codes its leaves at ``max_depth``
+    would have, so sibling ranges are adjacent and a finished parent is
+    exactly the union of its children. That lets tiles be checkpointed as
+    ordinary ranges in a ``PartFileSink`` manifest.
+    """
+
+    def __init__(self, extent, max_depth=16):
+        self.minx, self.miny, self.maxx, self.maxy = extent
+        self.max_depth = max_depth
+
+    def tiles(self, depth):
+        """All tiles of one level, in Morton order"""
+        n = 1 << depth
+        return sorted(((depth, ix, iy) for ix in range(n) for iy in range(n)), key=self.key_range)
+
+    def bounds(self, tile):
+        depth, ix, iy = tile
+        width = (self.maxx - self.minx) / (1 << depth)
+        height = (self.maxy - self.miny) / (1 << depth)
+        return (self.minx + ix * width, self.miny + iy * height,
+                self.minx + (ix + 1) * width, self.miny + (iy + 1) * height)
+
+    def children(self, tile):
+        depth, ix, iy = tile
+        return [(depth + 1, 2 * ix + dx, 2 * iy + dy) for dy in (0, 1) for dx in (0, 1)]
+
+    def key_range(self, tile):
+        depth, ix, iy = tile
+        shift = 2 * (self.max_depth - depth)
+        code = _interleave(ix, iy)
+        return [code << shift, (code + 1) << shift]
+
+    def label(self, tile):
+        depth, ix, iy = tile
+        return f"{depth}/{ix}/{iy}"
+
+
+def _coverage(key_range, completed):
+    """'full', 'partial' or None: how much of a tile's range the completed ranges cover"""
+    start, end = key_range
+    covered = 0
+    for done_start, done_end in completed:
+        if done_start <= start and end <= done_end:
+            return 'full'
+        overlap = min(end, done_end) - max(start, done_start)
+        if overlap > 0:
+            covered += overlap
+    return 'partial' if covered else None
+
+
+class TileResult:
+    """One finished tile: the tile, its checkpoint range and the parsed items.
+
+    The range is None for a tile still full at the maximum depth, whose
+    items are only the first page of its features.
+    """
+
+    __slots__ = ('tile', 'key_range', 'items', 'elapsed')
+
+    def __init__(self, tile, key_range, items, elapsed=0.0):
+        self.tile = tile
+        self.key_range = key_range
+        self.items = items
+        self.elapsed = elapsed
+
+
+class TileFetcher:
+    """Concurrent WFS fetcher over the BBOX tiles of a ``TileGrid``.
+
+    Each tile is one request for at most ``capacity`` features. A tile
+    that comes back full is too dense: its features are dropped and its
+    four quadrants are queued instead, so request cost stays flat no
+    matter how the features are distributed and no deep ``startIndex``
+    is ever sent. Tiles finish in no particular order.
+
+    ``tile_params(bounds)`` returns the request parameters restricting a
+    request to a tile (a ``BBOX`` or a FES filter). Features crossing
+    tile borders are returned by every tile they touch; the caller
+    dedupes them. Retries, backoff, the shared ``HostLimiter`` and
+    shutdown handling work as in ``Paginator``.
+    """
+
+    def __init__(self, url, parse_tile, grid, tile_params, capacity, base_params=None,
+                 max_concurrent=4, max_retries=3, timeout=None, requests_per_second=None,
+                 request_kwargs=None, name=None, limiter=None, shutdown_grace=8):
+        self.url = url
+        self.parse_tile = parse_tile
+        self.grid = grid
+        self.tile_params = tile_params
+        self.capacity = capacity
+        self.base_params = base_params or {}
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.request_kwargs = request_kwargs or {}
+        self.name = name or url
+        # Cloud Run sends SIGKILL 10 seconds after SIGTERM
+        self.shutdown_grace = shutdown_grace
+        self.limiter = limiter or get_host_limiter(
+            url,
+            requests_per_second=requests_per_second,
+            max_concurrency=max_concurrent
+        )
+
+        self.failed_tiles = []
+        self.stats = Counter()
+
+    async def _fetch_tile(self, session, tile, delay=0):
+        if delay:
+            await asyncio.sleep(delay)
+
+        params = dict(self.base_params, count=str(self.capacity), **self.tile_params(self.grid.bounds(tile)))
+        kwargs = dict(self.request_kwargs)
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+
+        try:
+            async with self.limiter.request() as slot:
+                start = time.monotonic()
+                async with session.get(self.url, params=params, **kwargs) as response:
+                    self.limiter.mark_response(slot, response, start)
+                    if is_throttle_status(response.status):
+                        raise PageFetchError(f"HTTP {response.status}", retry_after=slot.retry_after)
+                    if response.status != 200:
+                        text = await response.text()
+                        raise PageFetchError(f"HTTP {response.status}: {text[:500]}", retryable=False)
+                    items = await self.parse_tile(response, self.grid.label(tile))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise PageFetchError(f"{type(e).__name__}: {str(e)}") from e
+
+        elapsed = time.monotonic() - start
+        self.stats['requests'] += 1
+        self.stats['fetch_seconds'] += elapsed
+        return items, elapsed
+
+    async def tiles(self, session, start_tiles, completed=None, shutdown=None):
+        """Yield a TileResult for every finished leaf tile.
+
+        ``completed`` are the checkpointed key ranges of an earlier run:
+        fully covered tiles are skipped and partly covered ones are split
+        straight away, since they were found too dense before.
+        """
+        completed = completed or []
+        work = deque((tile, 0) for tile in start_tiles)
+        attempts = Counter()
+        in_flight = {}
+        stopping = False
+        deadline = None
+
+        try:
+            while work or in_flight:
+                if not stopping and shutdown is not None and shutdown.is_set():
+                    stopping = True
+                    deadline = time.monotonic() + self.shutdown_grace
+                    logger.warning(f"{self.name}: shutting down, waiting up to {self.shutdown_grace}s "
+                                   f"for {len(in_flight)} tiles in flight")
+
+                while not stopping and work and len(in_flight) < self.max_concurrent:
+                    tile, delay = work.popleft()
+                    coverage = _coverage(self.grid.key_range(tile), completed)
+                    if coverage == 'full':
+                        self.stats['skipped'] += 1
+                        continue
+                    if coverage == 'partial' and tile[0] < self.grid.max_depth:
+                        work.extendleft((child, 0) for child in reversed(self.grid.children(tile)))
+                        continue
+                    task = asyncio.create_task(self._fetch_tile(session, tile, delay))
+                    in_flight[task] = tile
+
+                if not in_flight:
+                    break
+
+                waiters = set(in_flight)
+                shutdown_waiter = None
+                if shutdown is not None and not stopping:
+                    shutdown_waiter = asyncio.ensure_future(shutdown.wait())
+                    waiters.add(shutdown_waiter)
+                timeout = max(0.0, deadline - time.monotonic()) if stopping else None
+                done, _ = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if shutdown_waiter is not None:
+                    shutdown_waiter.cancel()
+                    done.discard(shutdown_waiter)
+                if stopping and not done:
+                    logger.warning(f"{self.name}: {len(in_flight)} tiles still in flight after the grace period, dropping them")
+                    break
+
+                for task in done:
+                    tile = in_flight.pop(task)
+                    try:
+                        items, elapsed = task.result()
+                    except Exception as e:
+                        attempts[tile] += 1
+                        self.stats['errors'] += 1
+                        if stopping:
+                            # Left unfinished, the next run fetches it again
+                            continue
+                        if getattr(e, 'retryable', True) and attempts[tile] < self.max_retries:
+                            delay = getattr(e, 'retry_after', None) or min(2 ** attempts[tile], 60)
+                            logger.warning(f"{self.name}: requeueing tile {self.grid.label(tile)} in {delay:.0f}s "
+                                           f"(attempt {attempts[tile]}): {str(e)}")
+                            work.appendleft((tile, delay))
+                        else:
+                            logger.error(f"{self.name}: giving up on tile {self.grid.label(tile)} "
+                                         f"after {attempts[tile]} attempts: {str(e)}")
+                            self.failed_tiles.append(tile)
+                        continue
+
+                    returned = getattr(items, 'source_count', len(items))
+                    if returned >= self.capacity and tile[0] < self.grid.max_depth:
+                        # Too dense for one request, fetch the quadrants instead
+                        self.stats['splits'] += 1
+                        if not stopping:
+                            work.extendleft((child, 0) for child in reversed(self.grid.children(tile)))
+                        continue
+                    key_range = self.grid.key_range(tile)
+                    if returned >= self.capacity:
+                        logger.error(f"{self.name}: tile {self.grid.label(tile)} is full at the maximum depth, "
+                                     f"features beyond the first {self.capacity:,} are missing")
+                        # Counted as failed and left out of the checkpoint, so the run does not pass as complete
+                        self.failed_tiles.append(tile)
+                        key_range = None
+                    self.stats['tiles'] += 1
+                    self.stats['items'] += len(items)
+                    yield TileResult(tile, key_range, items, elapsed)
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+    def log_stats(self):
+        requests = self.stats['requests']
+        avg = self.stats['fetch_seconds'] / requests if requests else 0
+        logger.info(f"{self.name}: {self.stats['tiles']:,} tiles, {self.stats['items']:,} items, "
+                    f"{self.stats['splits']:,} dense tiles split, {self.stats['skipped']:,} skipped, "
+                    f"{self.stats['errors']:,} errors, {avg:.2f}s average request time, "
+                    f"{len(self.failed_tiles)} failed tiles")
+        self.limiter.log_stats()
@@ -1,4 +1,6 @@
 import os
+import sys
+import signal
 import asyncio
 import logging
 from src.sources.parsers import get_source_handler
@@ -7,19 +9,50 @@ from src.config import SOURCES
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+shutdown = asyncio.Event()
+
+def handle_shutdown(signum):
+    logger.info(f"Received signal {signum}. Checkpointing and shutting down...")
+    shutdown.set()
+
+async def run_step(source_id, source, step):
+    """Run one source's sync, or the compaction of its sharded sync"""
+    source.shutdown = shutdown
+    if step == 'compact':
+        total = await source.compact()
+        if total is not None:
+            logger.info(f"{source_id} compaction completed. Total records: {total:,}")
+        return
+    if source.shard.is_sharded:
+        logger.info(f"{source_id}: running as {source.shard.label}")
+    total_synced = await source.sync()
+    logger.info(f"{source_id} sync completed. Total records: {total_synced:,}")
+
 async def run_sync() -> bool:
-    """Run the sync process based on environment variable"""
+    """Run the sync process based on environment variable.
+
+    SYNC_STEP=compact publishes the shards written by a sync that ran as
+    several Cloud Run tasks (CLOUD_RUN_TASK_INDEX/CLOUD_RUN_TASK_COUNT).
+    """
     sync_type = os.getenv('SYNC_TYPE', 'all')
-    logger.info(f"Starting sync process for: {sync_type}")
+    step = os.getenv('SYNC_STEP', 'sync').lower()
+    if step not in ('sync', 'compact'):
+        logger.error(f"Unknown sync step: {step}")
+        return False
+    logger.info(f"Starting {step} process for: {sync_type}")
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, handle_shutdown, sig)
     
     try:
         if sync_type == 'all':
             for source_id, config in SOURCES.items():
                 if config['enabled']:
+                    if shutdown.is_set():
+                        return False
                     source = get_source_handler(source_id, config)
                     if source:
-                        total_synced = await source.sync()
-                        logger.info(f"{source_id} sync completed. Total records: {total_synced:,}")
+                        await run_step(source_id, source, step)
         else:
             if sync_type not in SOURCES:
                 logger.error(f"Unknown sync type: {sync_type}")
@@ -35,8 +68,7 @@ async def run_sync() -> bool:
                 logger.error(f"No handler for sync type: {sync_type}")
                 return False
                 
-            total_synced = await source.sync()
-            logger.info(f"{sync_type} sync completed. Total records: {total_synced:,}")
+            await run_step(sync_type, source, step)
         
         return True
         
@@ -45,4 +77,5 @@ async def run_sync() -> bool:
         return False
 
 if __name__ == "__main__":
-    asyncio.run(run_sync())
+    # A non-zero exit lets Cloud Run retry the task, which resumes from the checkpoint
+    sys.exit(0 if asyncio.run(run_sync()) else 1)
@@ -0,0 +1,165 @@
+"""Record one ArcGIS query page as both ``f=pbf`` and ``f=json``, for the decoder tests.
+
+    python tests/fixtures/arcgis/record_query_page.py --url <layer>/query [--where ...] [--count 25]
+
+fetches the same page in both formats from a live layer. Without
+``--url`` the pair is built offline from the features below, encoded
+the way ArcGIS encodes FeatureCollection.proto: coordinates quantized
+against an upper-left origin, delta-encoded within each feature and
+zigzag varints. The checked-in pair was built offline.
+"""
+import argparse
+import json
+import struct
+import urllib.parse
+import urllib.request
+from pathlib import Path
+
+HERE = Path(__file__).parent
+DEFAULT_URL = 'https://kort.vd.dk/server/rest/services/Grunddata/Marker_og_Markblokke/MapServer/12/query'
+
+FIELDS = [
+    ('OBJECTID', 'esriFieldTypeOID', 6),
+    ('Marknr', 'esriFieldTypeString', 4),
+    ('IMK_areal', 'esriFieldTypeDouble', 3),
+    ('CVR', 'esriFieldTypeInteger', 1),
+    ('Afgkode', 'esriFieldTypeSmallInteger', 0),
+    ('Journalnr', 'esriFieldTypeString', 4),
+    ('Opdateret', 'esriFieldTypeDate', 5),
+]
+SCALE = 0.001
+ORIGIN = (400000.0, 6400000.0)
+
+
+def _ring(*points):
+    return [list(point) for point in points] + [list(points[0])]
+
+
+# Exterior rings clockwise, holes counterclockwise, as ArcGIS stores them
+FEATURES = [
+    ({'OBJECTID': 1, 'Marknr': '1-0', 'IMK_areal': 2.52, 'CVR': 12345678, 'Afgkode': 1,
+      'Journalnr': '24-0001', 'Opdateret': 1704067200000},
+     [_ring((500000.0, 6200000.0), (500000.0, 6200150.5), (500168.25, 6200150.5), (500168.25, 6200000.0)),
+      _ring((500040.0, 6200040.0), (500080.125, 6200040.0), (500080.125, 6200080.0), (500040.0, 6200080.0))]),
+    ({'OBJECTID': 2, 'Marknr': '2-0', 'IMK_areal': 0.87, 'CVR': None, 'Afgkode': 216,
+      'Journalnr': None, 'Opdateret': 1706745600000},
+     [_ring((512000.5, 6180000.25), (512000.5, 6180050.0), (512090.0, 6180050.0), (512090.0, 6180000.25)),
+      _ring((512100.0, 6180000.0), (512100.0, 6180030.0), (512150.0, 6180030.0), (512150.0, 6180000.0))]),
+    ({'OBJECTID': 3, 'Marknr': '3-1', 'IMK_areal': 11.003, 'CVR': 87654321, 'Afgkode': 11,
+      'Journalnr': '24-0003', 'Opdateret': None},
+     [_ring((480000.0, 6300000.0), (480010.0, 6300320.75), (480400.0, 6300300.0), (480390.5, 6299990.0))]),
+    ({'OBJECTID': 4, 'Marknr': '4-0', 'IMK_areal': None, 'CVR': 11112222, 'Afgkode': 2,
+      'Journalnr': '24-0004', 'Opdateret': 1709251200000},
+     None),
+]
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _key(number, wire_type):
+    return _varint(number << 3 | wire_type)
+
+
+def _bytes(number, payload):
+    return _key(number, 2) + _varint(len(payload)) + payload
+
+
+def _double(number, value):
+    return _key(number, 1) + struct.pack('<d', value)
+
+
+def _uint(number, value):
+    return _key(number, 0) + _varint(value)
+
+
+def _value(value, field_type):
+    """A FeatureCollectionPBuffer.Value, empty for nulls"""
+    if value is None:
+        return b''
+    if field_type == 'esriFieldTypeString':
+        return _bytes(1, value.encode('utf-8'))
+    if field_type == 'esriFieldTypeDouble':
+        return _double(3, value)
+    if field_type == 'esriFieldTypeOID':
+        return _uint(5, value)
+    if field_type == 'esriFieldTypeDate':
+        return _uint(8, _zigzag(value))
+    return _uint(4, _zigzag(value))
+
+
+def _geometry(rings):
+    lengths = b''.join(_varint(len(ring)) for ring in rings)
+    coords = bytearray()
+    # Deltas run across the rings of a feature and start from zero for every feature
+    previous = (0, 0)
+    for ring in rings:
+        for x, y in ring:
+            step = (round((x - ORIGIN[0]) / SCALE), round((ORIGIN[1] - y) / SCALE))
+            coords += _varint(_zigzag(step[0] - previous[0])) + _varint(_zigzag(step[1] - previous[1]))
+            previous = step
+    return _bytes(2, lengths) + _bytes(3, bytes(coords))
+
+
+def build_pbf():
+    transform = (_uint(1, 0)  # upper-left origin
+                 + _bytes(2, _double(1, SCALE) + _double(2, SCALE))
+                 + _bytes(3, _double(1, ORIGIN[0]) + _double(2, ORIGIN[1])))
+    result = (_bytes(1, b'OBJECTID')
+              + _uint(7, 3)  # esriGeometryTypePolygon
+              + _bytes(8, _uint(1, 25832))
+              + _bytes(12, transform))
+    for name, field_type, type_code in FIELDS:
+        result += _bytes(13, _bytes(1, name.encode('utf-8')) + _uint(2, type_code))
+    for attributes, rings in FEATURES:
+        feature = b''.join(_bytes(1, _value(attributes[name], field_type)) for name, field_type, _ in FIELDS)
+        if rings:
+            feature += _bytes(2, _geometry(rings))
+        result += _bytes(15, feature)
+    return _bytes(1, b'3.0') + _bytes(2, _bytes(1, result))
+
+
+def build_json():
+    return json.dumps({
+        'objectIdFieldName': 'OBJECTID',
+        'geometryType': 'esriGeometryPolygon',
+        'spatialReference': {'wkid': 25832},
+        'fields': [{'name': name, 'type': field_type} for name, field_type, _ in FIELDS],
+        'features': [{'attributes': attributes, 'geometry': {'rings': rings} if rings else None}
+                     for attributes, rings in FEATURES],
+    }, indent=1).encode('utf-8')
+
+
+def record(url, where, count):
+    params = {'where': where, 'outFields': '*', 'returnGeometry': 'true',
+              'orderByFields': 'OBJECTID', 'resultRecordCount': count}
+    bodies = {}
+    for query_format in ('pbf', 'json'):
+        query = urllib.parse.urlencode({**params, 'f': query_format})
+        with urllib.request.urlopen(f'{url}?{query}') as response:
+            bodies[query_format] = response.read()
+    return bodies['pbf'], bodies['json']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help=f'layer query url, e.g. {DEFAULT_URL}')
+    parser.add_argument('--where', default='1=1')
+    parser.add_argument('--count', type=int, default=25)
+    args = parser.parse_args()
+    pbf, json_body = record(args.url, args.where, args.count) if args.url else (build_pbf(), build_json())
+    (HERE / 'query_page.pbf').write_bytes(pbf)
+    (HERE / 'query_page.json').write_bytes(json_body)
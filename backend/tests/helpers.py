@@ -0,0 +1,23 @@
+from contextlib import asynccontextmanager
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+
+def run(coro):
+    """Run a test coroutine on a fresh event loop"""
+    return asyncio.run(coro)
+
+
+@asynccontextmanager
+async def serve(handler, path='/wfs'):
+    """Serve ``handler`` on a local port for the duration of the block, yielding its url"""
+    app = web.Application()
+    app.router.add_get(path, handler)
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        yield str(server.make_url(path))
+    finally:
+        await server.close()
@@ -0,0 +1,27 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from src.sources.utils.arcgis_pbf import decode_json, decode_pbf
+
+FIXTURES = Path(__file__).parent / 'fixtures' / 'arcgis'
+# Quantization step of the recorded PBF page, in metres
+TOLERANCE = 0.001
+
+
+def test_pbf_page_decodes_like_the_json_page():
+    pbf = decode_pbf((FIXTURES / 'query_page.pbf').read_bytes())
+    expected = decode_json((FIXTURES / 'query_page.json').read_bytes())
+
+    pd.testing.assert_frame_equal(pbf.attributes, expected.attributes)
+    assert len(pbf.geometry) == len(expected.geometry)
+    assert list(shapely.get_type_id(pbf.geometry)) == list(shapely.get_type_id(expected.geometry))
+    present = ~shapely.is_missing(expected.geometry)
+    # Several features with geometry, so coordinate deltas must restart for each of them
+    assert present.sum() > 1
+    assert shapely.equals_exact(pbf.geometry[present], expected.geometry[present], tolerance=TOLERANCE).all()
+    # Rings keep their orientation through the upper-left y flip, so holes stay holes
+    assert np.allclose(shapely.area(pbf.geometry[present]), shapely.area(expected.geometry[present]))
+    assert shapely.get_num_interior_rings(pbf.geometry[0]) == 1
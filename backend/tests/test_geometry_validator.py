@@ -0,0 +1,47 @@
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from src.sources.utils.geometry_validator import repair_geometries, validate_and_transform_geometries
+
+BOWTIE = shapely.Polygon([(0, 0), (2, 2), (2, 0), (0, 2), (0, 0)])
+# make_valid turns this into a GeometryCollection holding a MultiPolygon and the spike as a line
+BOWTIE_WITH_SPIKE = shapely.from_wkt('POLYGON ((0 0, 2 2, 2 0, 0 2, 0 0, -1 -1, 0 0))')
+
+
+def test_repair_keeps_polygons_of_nested_multipolygons():
+    assert shapely.get_type_id(shapely.make_valid(BOWTIE_WITH_SPIKE)) == shapely.GeometryType.GEOMETRYCOLLECTION
+
+    repaired = repair_geometries(np.array([BOWTIE_WITH_SPIKE, BOWTIE, shapely.box(0, 0, 1, 1)], dtype=object))
+
+    assert list(shapely.get_type_id(repaired)) == [shapely.GeometryType.MULTIPOLYGON,
+                                                   shapely.GeometryType.MULTIPOLYGON,
+                                                   shapely.GeometryType.POLYGON]
+    assert shapely.is_valid(repaired).all()
+    assert shapely.equals(repaired[0], shapely.make_valid(BOWTIE))
+    assert shapely.area(repaired[0]) == 2
+
+
+def test_validate_drops_missing_and_repairs_invalid():
+    offset = shapely.affinity.translate(BOWTIE_WITH_SPIKE, 500_000, 6_200_000)
+    gdf = gpd.GeoDataFrame({'id': [1, 2, 3, 4]},
+                           geometry=[offset, None, shapely.Polygon(), shapely.box(500_000, 6_200_000, 500_010, 6_200_010)],
+                           crs='EPSG:25832')
+
+    validated = validate_and_transform_geometries(gdf, 'test', keep_source_geometry=True)
+
+    assert list(validated['id']) == [1, 4]
+    assert list(validated['area_m2']) == [2, 100]
+    assert validated.crs.to_epsg() == 4326
+    assert shapely.equals(shapely.from_wkb(validated['geometry_25832'].iloc[1]), gdf.geometry.iloc[3])
+
+
+def test_validate_reprojects_from_the_frame_crs():
+    box = shapely.box(700_000, 6_200_000, 700_100, 6_200_100)
+    utm33 = gpd.GeoDataFrame(geometry=[box], crs='EPSG:25833')
+
+    validated = validate_and_transform_geometries(utm33, 'test', keep_source_geometry=True)
+
+    expected = utm33.to_crs('EPSG:4326').geometry.iloc[0]
+    assert np.allclose(shapely.get_coordinates(validated.geometry.iloc[0]), shapely.get_coordinates(expected))
+    assert 'geometry_25833' in validated.columns
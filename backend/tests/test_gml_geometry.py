@@ -0,0 +1,76 @@
+import xml.etree.ElementTree as ET
+
+import shapely
+
+from src.sources.parsers.wetlands import Wetlands
+from src.sources.utils.gml_geometry import PolygonBatch, make_valid_polygons
+from src.sources.utils.storage import MemoryStorage
+
+GML = 'http://www.opengis.net/gml/3.2'
+
+
+def surface(*polygons):
+    """GML surface with one gml:Polygon per ``(shell, *holes)`` tuple of flat coordinate lists"""
+    rings = []
+    for shell, *holes in polygons:
+        boundaries = [f'<gml:exterior><gml:LinearRing><gml:posList>{" ".join(map(str, shell))}'
+                      f'</gml:posList></gml:LinearRing></gml:exterior>']
+        boundaries += [f'<gml:interior><gml:LinearRing><gml:posList>{" ".join(map(str, hole))}'
+                       f'</gml:posList></gml:LinearRing></gml:interior>' for hole in holes]
+        rings.append(f'<gml:Polygon>{"".join(boundaries)}</gml:Polygon>')
+    return ET.fromstring(f'<gml:MultiSurface xmlns:gml="{GML}">{"".join(rings)}</gml:MultiSurface>')
+
+
+SQUARE = [0, 0, 10, 0, 10, 10, 0, 10, 0, 0]
+HOLE = [2, 2, 4, 2, 4, 4, 2, 4, 2, 2]
+FAR_SQUARE = [20, 0, 30, 0, 30, 10, 20, 10, 20, 0]
+# Crosses itself at (5, 5)
+BOWTIE = [0, 0, 10, 10, 10, 0, 0, 10, 0, 0]
+
+
+def test_build_matches_the_surfaces_added():
+    batch = PolygonBatch()
+    batch.add(surface((SQUARE, HOLE)))
+    batch.add(None)
+    batch.add(surface((SQUARE,), (FAR_SQUARE,)))
+    batch.add(surface(([0, 0, 1, 1, 0, 0],)))  # Too few coordinates for a ring
+
+    built = batch.build()
+
+    assert len(built) == 4
+    assert shapely.get_type_id(built[0]) == 3 and built[0].area == 96
+    assert built[1] is None
+    assert shapely.get_type_id(built[2]) == 6 and built[2].area == 200
+    assert built[3] is None
+
+
+def test_three_dimensional_coordinates_keep_x_and_y():
+    batch = PolygonBatch(dims=3)
+    batch.add(surface(([value for x, y in zip(SQUARE[::2], SQUARE[1::2]) for value in (x, y, 99)],)))
+
+    assert shapely.equals(batch.build()[0], shapely.Polygon(list(zip(SQUARE[::2], SQUARE[1::2]))))
+
+
+def test_bowtie_is_repaired_into_a_multipolygon():
+    batch = PolygonBatch()
+    batch.add(surface((BOWTIE,)))
+
+    repaired = make_valid_polygons(batch.build())
+
+    assert shapely.get_type_id(repaired[0]) == 6
+    assert shapely.is_valid(repaired[0]) and repaired[0].area == 50
+
+
+def test_wetlands_statistics_handle_repaired_multipolygons():
+    batch = PolygonBatch()
+    batch.add(surface((SQUARE,), (FAR_SQUARE,)))
+    batch.add(surface((BOWTIE,)))
+    batch.add(surface(([0, 0, 10.5, 0, 10.5, 10, 0, 10, 0, 0],)))
+    geometries = make_valid_polygons(batch.build())
+    wetlands = Wetlands({'url': 'http://localhost/wfs', 'layer': 'natur:kulstof2022'}, MemoryStorage())
+
+    stats = wetlands.analyze_geometries(geometries)
+
+    assert stats['width'].tolist() == [30, 10, 10.5]
+    assert stats['grid_aligned'].tolist() == [True, False, False]
+    assert stats['vertices'].tolist() == [10, 8, 5]
@@ -0,0 +1,63 @@
+import geopandas as gpd
+import pandas as pd
+import shapely
+
+from src.sources.utils.grid_dissolve import dissolve_grid_cells
+
+CELL = 10.0
+
+
+def cells(*positions, gridcode=1):
+    """10 m cells at the given (column, row) positions"""
+    return gpd.GeoDataFrame(
+        {'gridcode': [gridcode] * len(positions)},
+        geometry=[shapely.box(x * CELL, y * CELL, (x + 1) * CELL, (y + 1) * CELL) for x, y in positions],
+        crs='EPSG:25832'
+    )
+
+
+def concat(*frames):
+    return gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs='EPSG:25832')
+
+
+def test_edge_touching_cells_merge_into_one_region():
+    dissolved = dissolve_grid_cells(cells((0, 0), (1, 0), (1, 1)), 'gridcode')
+
+    assert len(dissolved) == 1
+    assert dissolved['cells'].tolist() == [3]
+    region = dissolved.geometry.iloc[0]
+    assert region.geom_type == 'Polygon' and region.area == 300
+    # Collinear vertices along merged edges are removed
+    assert shapely.get_num_coordinates(region) == 7
+
+
+def test_corner_touching_cells_stay_apart():
+    dissolved = dissolve_grid_cells(cells((0, 0), (1, 1)), 'gridcode')
+
+    assert len(dissolved) == 2
+    assert dissolved['cells'].tolist() == [1, 1]
+
+
+def test_regions_are_dissolved_per_gridcode():
+    dissolved = dissolve_grid_cells(concat(cells((0, 0), (1, 0), gridcode=1), cells((2, 0), gridcode=2)), 'gridcode')
+
+    assert sorted(zip(dissolved['gridcode'], dissolved['cells'])) == [(1, 2), (2, 1)]
+    assert dissolved.crs == 'EPSG:25832'
+
+
+def test_ring_of_cells_keeps_its_hole():
+    ring = [(x, y) for x in range(3) for y in range(3) if (x, y) != (1, 1)]
+    dissolved = dissolve_grid_cells(cells(*ring), 'gridcode')
+
+    assert len(dissolved) == 1
+    assert len(dissolved.geometry.iloc[0].interiors) == 1
+
+
+def test_overlapping_and_unaligned_geometries():
+    frame = cells((0, 0), (0, 0), (1, 0))
+    frame.loc[len(frame)] = [1, shapely.box(50.5, 0, 60.5, 10)]
+    dissolved = dissolve_grid_cells(frame, 'gridcode')
+
+    # Duplicated cells fall back to a full union, the unaligned box is passed through
+    assert sorted(dissolved['cells'].tolist()) == [1, 3]
+    assert sorted(dissolved.area.tolist()) == [100, 200]
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import random
+
+import aiohttp
+from aiohttp import web
+
+from helpers import run, serve
+from src.sources.utils.pagination import PageFetchError, Paginator, WFSPaging
+
+PAGE_SIZE = 10
+
+
+def features_server(count, requests, statuses=None):
+    """Fake WFS returning the ids of a page of ``count`` features, after a random delay.
+
+    ``statuses`` maps an offset to the HTTP status it answers with instead.
+    """
+    async def handler(request):
+        offset, limit = int(request.query['startIndex']), int(request.query['count'])
+        requests.append(offset)
+        await asyncio.sleep(random.uniform(0, 0.02))
+        if offset in (statuses or {}):
+            return web.Response(status=statuses[offset], text='bad request')
+        return web.json_response(list(range(offset, min(offset + limit, count))))
+    return handler
+
+
+async def parse_page(response, offset):
+    return json.loads(await response.read())
+
+
+def fetch_pages(count, total=None, skip=None, statuses=None, parse=parse_page, max_concurrent=4):
+    requests = []
+
+    async def main():
+        async with serve(features_server(count, requests, statuses)) as url, aiohttp.ClientSession() as session:
+            paginator = Paginator(WFSPaging(), url, parse, PAGE_SIZE, max_concurrent=max_concurrent)
+            pages = [page async for page in paginator.pages(session, total, skip=skip)]
+            return paginator, pages
+
+    paginator, pages = run(main())
+    return paginator, pages, requests
+
+
+def test_pages_are_yielded_in_offset_order():
+    random.seed(1)
+    paginator, pages, requests = fetch_pages(95, total=95)
+
+    assert [page.offset for page in pages] == list(range(0, 95, PAGE_SIZE))
+    assert [i for page in pages for i in page.items] == list(range(95))
+    # Concurrent requests finish out of order, the pages still come in order
+    assert sorted(requests) == list(range(0, 95, PAGE_SIZE))
+    assert paginator.failed_offsets == []
+
+
+def test_unknown_total_stops_at_the_first_short_page():
+    paginator, pages, requests = fetch_pages(42)
+
+    assert [i for page in pages for i in page.items] == list(range(42))
+    assert pages[-1].offset == 40
+    # Pages requested past the end are dropped
+    assert all(page.offset < 50 for page in pages)
+
+
+def test_failed_page_is_requeued_and_still_yielded_in_order():
+    failures = {30: 2}
+
+    async def flaky_parse(response, offset):
+        if failures.get(offset):
+            failures[offset] -= 1
+            raise PageFetchError('truncated page', retry_after=0.01)
+        return await parse_page(response, offset)
+
+    paginator, pages, requests = fetch_pages(60, total=60, parse=flaky_parse)
+
+    assert [page.offset for page in pages] == list(range(0, 60, PAGE_SIZE))
+    assert pages[3].attempts == 3
+    assert requests.count(30) == 3
+    assert paginator.stats['errors'] == 2
+    assert paginator.failed_offsets == []
+
+
+def test_non_retryable_page_fails_without_blocking_later_pages():
+    paginator, pages, requests = fetch_pages(50, total=50, statuses={20: 400})
+
+    assert [page.offset for page in pages] == list(range(0, 50, PAGE_SIZE))
+    assert pages[2].items is None
+    assert paginator.failed_offsets == [20]
+    assert requests.count(20) == 1
+
+
+def test_skipped_pages_are_neither_fetched_nor_yielded():
+    done = [[0, 20], [40, 50]]
+
+    def skip(offset, size):
+        return any(start <= offset and offset + size <= end for start, end in done)
+
+    paginator, pages, requests = fetch_pages(70, total=70, skip=skip)
+
+    assert [page.offset for page in pages] == [20, 30, 50, 60]
+    assert sorted(requests) == [20, 30, 50, 60]
@@ -0,0 +1,204 @@
+import io
+import json
+
+import geopandas as gpd
+import pytest
+from shapely.geometry import Point
+
+from helpers import run
+from src.sources.utils.part_sink import PartFileSink
+from src.sources.utils.storage import MemoryStorage
+
+DATASET = 'test'
+
+
+class FlakyStorage(MemoryStorage):
+    """Memory storage whose ``write_bytes`` and ``delete`` raise the errors queued for them (None: succeed)"""
+
+    def __init__(self):
+        super().__init__()
+        self.failures = {'write_bytes': [], 'delete': []}
+        self.calls = {'write_bytes': 0, 'delete': 0}
+
+    def _fail(self, method):
+        self.calls[method] += 1
+        error = self.failures[method].pop(0) if self.failures[method] else None
+        if error is not None:
+            raise error
+
+    def _write_bytes(self, path, data, content_type=None):
+        self._fail('write_bytes')
+        super()._write_bytes(path, data, content_type)
+
+    def _delete(self, path):
+        self._fail('delete')
+        super()._delete(path)
+
+
+def features(ids):
+    return gpd.GeoDataFrame({'id': ids}, geometry=[Point(i, i) for i in ids], crs='EPSG:25832')
+
+
+def parts(storage, sink):
+    return sorted(path for path in storage.objects if path.startswith(f'{sink.prefix}/part-'))
+
+
+def test_failed_manifest_write_does_not_leave_a_duplicate_part():
+    storage = FlakyStorage()
+
+    async def main():
+        sink = PartFileSink(storage, DATASET)
+        await sink.write(features([1, 2]), pages={'layer': [[0, 2]]})
+        storage.failures['write_bytes'].append(PermissionError('denied'))
+        with pytest.raises(PermissionError):
+            await sink.write(features([3, 4]), pages={'layer': [[2, 4]]})
+        # Rolled back, so the retried batch overwrites the part instead of adding one
+        assert len(sink.manifest['parts']) == 1
+        assert sink.completed_ranges('layer') == [[0, 2]]
+        await sink.write(features([3, 4]), pages={'layer': [[2, 4]]})
+        return sink
+
+    sink = run(main())
+    assert parts(storage, sink) == [f'{sink.prefix}/part-000000.parquet', f'{sink.prefix}/part-000001.parquet']
+    manifest = json.loads(storage.objects[f'{sink.prefix}/_manifest.json'])
+    assert [part['name'] for part in manifest['parts']] == ['part-000000.parquet', 'part-000001.parquet']
+    assert manifest['pages'] == {'layer': [[0, 4]]}
+
+
+def test_transient_manifest_write_error_is_retried():
+    storage = FlakyStorage()
+    storage.failures['write_bytes'].append(ConnectionError('reset'))
+
+    sink = PartFileSink(storage, DATASET)
+    run(sink.write(features([1, 2])))
+
+    assert storage.calls['write_bytes'] == 2
+    assert len(json.loads(storage.objects[f'{sink.prefix}/_manifest.json'])['parts']) == 1
+
+
+def test_cleanup_tolerates_missing_objects_and_can_run_again():
+    storage = FlakyStorage()
+
+    async def main():
+        sink = PartFileSink(storage, DATASET)
+        await sink.write(features([1]))
+        await sink.write(features([2]))
+        storage.failures['delete'] += [None, FileNotFoundError('gone'), PermissionError('denied')]
+        with pytest.raises(PermissionError):
+            await sink.cleanup()
+        # The manifest went first, so the half cleaned run is not resumed
+        assert f'{sink.prefix}/_manifest.json' not in storage.objects
+        await sink.cleanup()
+        return sink
+
+    sink = run(main())
+    assert not [path for path in storage.objects if path.startswith(f'{sink.prefix}/')]
+
+
+def test_resume_continues_the_latest_run_and_removes_the_others():
+    storage = MemoryStorage()
+
+    async def main():
+        old = PartFileSink(storage, DATASET, run_id='20260101T000000')
+        await old.write(features([1]))
+        latest = PartFileSink(storage, DATASET, run_id='20260102T000000')
+        latest.state['high_water_mark'] = '2026-01-02'
+        await latest.write(features([1, 2, 3]), pages={'layer': [[0, 3]]})
+        # A run whose cleanup stopped after removing its manifest
+        storage.objects['raw/test/parts/20251231T000000/part-000000.parquet'] = b'orphan'
+        return await PartFileSink.resume(storage, DATASET, max_age_hours=24)
+
+    sink = run(main())
+    assert sink.run_id == '20260102T000000'
+    assert sink.resumed and sink.total_rows == 3
+    assert sink.state == {'high_water_mark': '2026-01-02'}
+    assert sink.skipper('layer')(0, 3) and not sink.skipper('layer')(3, 1)
+    assert all(path.startswith('raw/test/parts/20260102T000000/') for path in storage.objects)
+
+
+def test_resume_starts_over_when_the_latest_run_is_too_old():
+    storage = MemoryStorage()
+
+    async def main():
+        stale = PartFileSink(storage, DATASET, run_id='20200101T000000')
+        stale.manifest['created'] = '2020-01-01T00:00:00+00:00'
+        await stale.write(features([1]))
+        return await PartFileSink.resume(storage, DATASET, max_age_hours=24)
+
+    sink = run(main())
+    assert sink.run_id != '20200101T000000'
+    assert not sink.resumed
+    assert storage.objects == {}
+
+
+def read_published(storage, name='current.parquet'):
+    return gpd.read_parquet(io.BytesIO(storage.objects[f'raw/{DATASET}/{name}']))
+
+
+def test_publish_streams_every_part_and_removes_the_run():
+    storage = MemoryStorage()
+
+    async def main():
+        sink = PartFileSink(storage, DATASET)
+        await sink.write(features([1, 2, 3]))
+        await sink.write(features([4, 5]))
+        return sink, await sink.publish()
+
+    sink, rows = run(main())
+    assert rows == 5
+    published = read_published(storage)
+    assert published['id'].tolist() == [1, 2, 3, 4, 5]
+    assert published.crs == 'EPSG:25832'
+    assert list(storage.objects) == [f'raw/{DATASET}/current.parquet']
+
+
+def test_publish_drops_repeated_keys():
+    storage = MemoryStorage()
+
+    async def main():
+        sink = PartFileSink(storage, DATASET)
+        await sink.write(features([1, 2, 3]))
+        await sink.write(features([3, 4]))
+        return await sink.publish(key='id')
+
+    assert run(main()) == 4
+    assert read_published(storage)['id'].tolist() == [1, 2, 3, 4]
+
+
+def test_publish_fails_when_the_parts_do_not_hold_the_recorded_rows():
+    storage = MemoryStorage()
+
+    async def main():
+        sink = PartFileSink(storage, DATASET)
+        await sink.write(features([1, 2, 3]))
+        sink.manifest['parts'][0]['rows'] = 4
+        with pytest.raises(ValueError, match='recording 4'):
+            await sink.publish()
+        return sink
+
+    sink = run(main())
+    # Nothing is published and the run is left to resume
+    assert f'raw/{DATASET}/current.parquet' not in storage.objects
+    assert f'{sink.prefix}/_manifest.json' in storage.objects
+
+
+def test_publish_merged_upserts_and_deletes_by_key():
+    storage = MemoryStorage()
+
+    async def main():
+        first = PartFileSink(storage, DATASET, run_id='20260101T000000')
+        await first.write(features([1, 2, 3, 4]))
+        await first.publish()
+
+        changes = PartFileSink(storage, DATASET, run_id='20260102T000000')
+        updated = features([2, 5])
+        updated['geometry'] = [Point(100, 100), Point(5, 5)]
+        await changes.write(updated)
+        return await changes.publish_merged('id', keep_keys=[1, 2, 3, 5])
+
+    assert run(main()) == 4
+    published = read_published(storage).sort_values('id')
+    # 4 is no longer in keep_keys, 2 is replaced and 5 is new
+    assert published['id'].tolist() == [1, 2, 3, 5]
+    assert published.geometry.iloc[1].equals(Point(100, 100))
+    assert list(storage.objects) == [f'raw/{DATASET}/current.parquet']
@@ -0,0 +1,50 @@
+import os
+
+import aiohttp
+from aiohttp import web
+import pytest
+
+from helpers import run, serve
+from src.sources.utils import process_pool
+from src.sources.utils.process_pool import spooled_body, spooled_memory
+
+BODY = b'<page>' + b'x' * 1_000_000 + b'</page>'
+
+
+async def body(request):
+    return web.Response(body=BODY)
+
+
+def spool(chunk_size=64 * 1024):
+    async def main():
+        async with serve(body) as url, aiohttp.ClientSession() as session:
+            async with session.get(url) as response:
+                async with spooled_body(response, chunk_size) as path:
+                    with open(path, 'rb') as f:
+                        content = f.read()
+                    held = spooled_memory()
+            return path, content, held
+    return run(main())
+
+
+def test_spooled_body_is_written_and_removed(tmp_path, monkeypatch):
+    monkeypatch.setenv('SPOOL_DIR', str(tmp_path))
+
+    path, content, held = spool()
+
+    assert content == BODY
+    assert os.path.dirname(path) == str(tmp_path)
+    assert not os.path.exists(path)
+    assert held == 0
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='needs a tmpfs mount')
+def test_spooled_body_on_tmpfs_counts_as_memory(monkeypatch):
+    monkeypatch.setenv('SPOOL_DIR', '/dev/shm')
+    assert process_pool._is_memory_backed('/dev/shm')
+
+    _, content, held = spool()
+
+    assert content == BODY
+    assert held == len(BODY)
+    assert spooled_memory() == 0
@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+import asyncio
+import time
+
+from helpers import run
+from src.sources.utils.rate_limit import HostLimiter, get_host_limiter, parse_retry_after
+
+
+def test_parse_retry_after_reads_seconds_and_dates():
+    assert parse_retry_after('120') == 120
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('soon') is None
+    in_a_minute = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=60), usegmt=True)
+    assert 55 < parse_retry_after(in_a_minute) <= 60
+
+
+def test_healthy_responses_raise_the_limit_and_throttling_halves_it():
+    limiter = HostLimiter('example.org', max_concurrency=8, initial_concurrency=4)
+
+    async def main():
+        for _ in range(20):
+            await limiter.acquire()
+            limiter.release(latency=0.1)
+        raised = limiter.limit
+        await limiter.acquire()
+        limiter.release(latency=0.1, throttled=True)
+        return raised
+
+    raised = run(main())
+    assert 4 < raised <= 8
+    assert limiter.limit == raised / 2
+    assert limiter.stats['throttled'] == 1
+
+
+def test_concurrency_is_capped_at_the_limit():
+    limiter = HostLimiter('example.org', max_concurrency=2, initial_concurrency=2)
+    peak = 0
+
+    async def request():
+        nonlocal peak
+        async with limiter.request() as slot:
+            peak = max(peak, limiter.in_flight)
+            await asyncio.sleep(0.01)
+            slot.status = 200
+
+    async def main():
+        await asyncio.gather(*(request() for _ in range(10)))
+
+    run(main())
+    assert peak == 2
+    assert limiter.stats['requests'] == 10
+    assert limiter.in_flight == 0
+
+
+def test_retry_after_pauses_the_host():
+    limiter = HostLimiter('example.org')
+
+    async def main():
+        await limiter.acquire()
+        limiter.release(latency=0.1, throttled=True, retry_after=0.2)
+        start = time.monotonic()
+        await limiter.acquire()
+        return time.monotonic() - start
+
+    assert run(main()) >= 0.15
+
+
+def test_token_bucket_spaces_requests():
+    limiter = HostLimiter('example.org', requests_per_second=20, burst=1, max_concurrency=8)
+
+    async def main():
+        start = time.monotonic()
+        for _ in range(5):
+            await limiter.acquire()
+            limiter.release(latency=0.01)
+        return time.monotonic() - start
+
+    # The first request uses the burst token, the other four wait 50 ms each
+    assert run(main()) >= 0.18
+
+
+def test_sources_on_one_host_share_a_limiter():
+    first = get_host_limiter('https://shared.example.org/wfs', max_concurrency=2)
+    second = get_host_limiter('https://shared.example.org/arcgis/rest', max_concurrency=6)
+
+    assert first is second
+    assert first.max_concurrency == 6
+    assert get_host_limiter('https://other.example.org/wfs') is not first
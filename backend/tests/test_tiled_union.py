@@ -0,0 +1,59 @@
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from helpers import run
+from src.sources.utils.tiled_union import plan_tiles, tiled_union
+
+
+def random_polygons(count, seed=0, extent=1000, size=40):
+    rng = np.random.default_rng(seed)
+    x, y = rng.uniform(0, extent, (2, count))
+    return shapely.buffer(shapely.points(x, y), rng.uniform(size / 4, size, count))
+
+
+def test_plan_tiles_splits_until_tiles_are_small_enough():
+    geometries = random_polygons(500)
+    tiles = plan_tiles(geometries, max_per_tile=50)
+
+    assert len(tiles) > 4
+    # The tiles cover the extent without overlapping
+    boxes = shapely.box(*np.array(tiles).T)
+    assert np.isclose(shapely.area(boxes).sum(), shapely.area(shapely.box(*shapely.total_bounds(geometries))))
+
+
+def test_tiled_union_matches_a_single_union():
+    geometries = random_polygons(400)
+    gdf = gpd.GeoDataFrame(geometry=geometries, crs='EPSG:25832')
+
+    dissolved = run(tiled_union(gdf, max_per_tile=25))
+
+    expected = shapely.get_parts(shapely.union_all(geometries))
+    assert len(dissolved) == len(expected)
+    assert set(dissolved.geom_type) == {'Polygon'}
+    # Stitched across tile borders: no two pieces still meet
+    left, right = shapely.STRtree(dissolved.geometry.values).query(dissolved.geometry.values, predicate='intersects')
+    assert (left == right).all()
+    assert np.isclose(dissolved.area.sum(), shapely.area(expected).sum())
+    assert dissolved.crs == 'EPSG:25832'
+
+
+def test_tiled_union_dissolves_per_group():
+    geometries = random_polygons(200)
+    gdf = gpd.GeoDataFrame({'layer_name': np.where(np.arange(200) % 2, 'a', 'b')}, geometry=geometries, crs='EPSG:25832')
+    gdf.loc[len(gdf)] = ['a', None]
+
+    dissolved = run(tiled_union(gdf, by='layer_name', max_per_tile=20))
+
+    for layer in ('a', 'b'):
+        expected = shapely.union_all(geometries[gdf['layer_name'].to_numpy()[:200] == layer])
+        assert np.isclose(dissolved[dissolved['layer_name'] == layer].area.sum(), expected.area)
+
+
+def test_tiled_union_of_nothing():
+    gdf = gpd.GeoDataFrame({'layer_name': []}, geometry=[], crs='EPSG:25832')
+
+    dissolved = run(tiled_union(gdf, by='layer_name'))
+
+    assert len(dissolved) == 0
+    assert list(dissolved.columns) == ['layer_name', 'geometry']
@@ -0,0 +1,105 @@
+import json
+
+import aiohttp
+from aiohttp import web
+import numpy as np
+
+from helpers import run, serve
+from src.sources.utils.tiling import TileFetcher, TileGrid
+
+EXTENT = (0.0, 0.0, 1024.0, 1024.0)
+CAPACITY = 10
+
+
+def points_server(points, requests):
+    """Fake WFS returning the ids of the points inside the BBOX, up to ``count`` of them"""
+    async def handler(request):
+        minx, miny, maxx, maxy = map(float, request.query['BBOX'].split(','))
+        requests.append(request.query['BBOX'])
+        inside = np.flatnonzero((points[:, 0] >= minx) & (points[:, 0] < maxx) &
+                                (points[:, 1] >= miny) & (points[:, 1] < maxy))
+        return web.json_response([int(i) for i in inside[:int(request.query['count'])]])
+    return handler
+
+
+async def parse_tile(response, label):
+    return json.loads(await response.read())
+
+
+def fetch_all(points, max_depth=16, start_depth=1, handler=None):
+    requests = []
+
+    async def main():
+        async with serve(handler or points_server(points, requests)) as url, aiohttp.ClientSession() as session:
+            fetcher = TileFetcher(url, parse_tile, TileGrid(EXTENT, max_depth=max_depth),
+                                  lambda bounds: {'BBOX': ','.join(map(str, bounds))}, capacity=CAPACITY)
+            results = [result async for result in fetcher.tiles(session, fetcher.grid.tiles(start_depth))]
+            return fetcher, results
+
+    fetcher, results = run(main())
+    return fetcher, results, requests
+
+
+def test_dense_tiles_are_split_until_every_feature_fits():
+    rng = np.random.default_rng(0)
+    # A dense cluster in one corner and a sparse scatter elsewhere
+    points = np.vstack([rng.uniform(0, 64, (200, 2)), rng.uniform(0, 1024, (40, 2))])
+
+    fetcher, results, requests = fetch_all(points)
+
+    ids = [i for result in results for i in result.items]
+    assert sorted(ids) == list(range(len(points)))
+    assert fetcher.stats['splits'] > 0
+    assert fetcher.failed_tiles == []
+    assert all(result.key_range is not None and len(result.items) < CAPACITY for result in results)
+    # Leaf ranges tile the key space without overlapping
+    ranges = sorted(result.key_range for result in results)
+    assert all(a[1] <= b[0] for a, b in zip(ranges, ranges[1:]))
+
+
+def test_tile_full_at_max_depth_counts_as_failed():
+    # More features on one spot than a request returns, no split can separate them
+    points = np.vstack([np.full((CAPACITY + 5, 2), 10.0), [[900.0, 900.0]]])
+
+    fetcher, results, _ = fetch_all(points, max_depth=3)
+
+    assert len(fetcher.failed_tiles) == 1
+    truncated = [result for result in results if result.tile == fetcher.failed_tiles[0]]
+    # Its first page is still passed on, but without a range so it is never checkpointed as done
+    assert len(truncated) == 1 and truncated[0].key_range is None
+    assert len(truncated[0].items) == CAPACITY
+    assert all(result.key_range is not None for result in results if result is not truncated[0])
+
+
+def test_tile_with_a_client_error_is_failed_without_retries():
+    points = np.array([[10.0, 10.0], [900.0, 900.0]])
+    requests = []
+    serve_points = points_server(points, requests)
+
+    async def handler(request):
+        if request.query['BBOX'].startswith('512.0,512.0'):
+            return web.Response(status=400, text='InvalidParameterValue')
+        return await serve_points(request)
+
+    fetcher, results, _ = fetch_all(points, handler=handler)
+
+    assert fetcher.failed_tiles == [(1, 1, 1)]
+    assert [i for result in results for i in result.items] == [0]
+
+
+def test_completed_ranges_are_skipped():
+    points = np.array([[10.0, 10.0], [900.0, 900.0]])
+    grid = TileGrid(EXTENT)
+    requests = []
+
+    async def main():
+        async with serve(points_server(points, requests)) as url, aiohttp.ClientSession() as session:
+            fetcher = TileFetcher(url, parse_tile, grid, lambda bounds: {'BBOX': ','.join(map(str, bounds))},
+                                  capacity=CAPACITY)
+            done = [grid.key_range((1, 0, 0))]
+            return fetcher, [r async for r in fetcher.tiles(session, grid.tiles(1), completed=done)]
+
+    fetcher, results = run(main())
+    assert fetcher.stats['skipped'] == 1
+    assert len(requests) == 3
+    assert [i for result in results for i in result.items] == [1]